@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+ENTRY_MODULES = ['streamd.run_md', 'streamd.run_gbsa', 'streamd.prolif.run_prolif', 'streamd.run_status']
+# packages which should be imported only by code paths using them
+HEAVY_MODULES = ['MDAnalysis', 'rdkit', 'parmed', 'dask', 'distributed', 'pandas', 'prolif', 'matplotlib', 'pyedr',
+                 'numpy']
+
+CODE = '''
+import json, sys, time
+t = time.perf_counter()
+import {module}
+print(json.dumps({{'time': time.perf_counter() - t, 'heavy': [i for i in {heavy} if i in sys.modules]}}))
+'''
+
+
+def measure_import(module, repeats):
+    '''
+    Each import is measured in a fresh interpreter
+    :return: median import time in seconds, list of heavy modules loaded by the import
+    '''
+    times, heavy = [], []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', CODE.format(module=module, heavy=HEAVY_MODULES)])
+        res = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(res['time'])
+        heavy = res['heavy']
+    return statistics.median(times), heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time of streamd command line tools. '
+                                                 'Fails if an entry module imports heavy packages at load or '
+                                                 'is imported longer than --max_time')
+    parser.add_argument('-m', '--modules', metavar='MODULE', nargs='+', default=ENTRY_MODULES,
+                        help='modules to import')
+    parser.add_argument('-n', '--repeats', metavar='INTEGER', default=5, type=int,
+                        help='number of imports of each module in fresh interpreters')
+    parser.add_argument('--max_time', metavar='SECONDS', default=0.5, type=float,
+                        help='max median import time of a module')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        import_time, heavy = measure_import(module, args.repeats)
+        print(f'{module}\t{import_time * 1000:.1f} ms\t{", ".join(heavy) if heavy else "no heavy imports"}')
+        if heavy or import_time > args.max_time:
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,15 @@
 from glob import glob
+import logging
 import os
+import shutil
+import statistics
 
 from streamd.scripts.xvg2png import convertxvg2png
-from streamd.utils.utils import get_index, make_group_ndx, get_mol_resid_pair, run_check_subprocess
+from streamd.utils.convergence import is_plateau, relative_drift
+from streamd.utils.edr import write_production_energies
+from streamd.utils.utils import get_index, make_group_ndx, get_mol_resid_pair, run_check_subprocess, \
+    get_trajectory_segments, read_xvg
+from streamd.utils.xtc import get_number_of_frames, scan_xtc
 
 
 def md_lig_rmsd_analysis(molid, resid, tpr, xtc, wdir, tu, bash_log, project_dir):
@@ -18,6 +25,76 @@ def md_lig_rmsd_analysis(molid, resid, tpr, xtc, wdir, tu, bash_log, project_dir
     run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log))
 
 
+def fit_trajectory(wdir, tpr, xtc, deffnm, index_group, project_dir, bash_log):
+    '''
+    Create md_fit.xtc without PBC and fitted on the index_group.
+    If the trajectory consists of segments (see --extend_mode segments) only segments which were not processed yet are
+    fitted and appended to the existing md_fit.xtc. Processed segments are listed in .md_fit_processed.txt.
+    The last frame after -pbc nojump is saved to .md_fit_nojump_reference.gro and used as the nojump reference of the
+    next segment, so molecules are unwrapped continuously over segments as in a single pass over the whole trajectory
+    :return: True or False
+    '''
+    def run_md_fit(xtc, noj_xtc, center_xtc, fit_xtc, noj_reference):
+        cmd = f'wdir={wdir} tpr={tpr} xtc={xtc} index_group={index_group} noj_reference={noj_reference} ' \
+              f'noj_xtc={noj_xtc} center_xtc={center_xtc} fit_xtc={fit_xtc} ' \
+              f'bash {os.path.join(project_dir, "scripts/script_sh/md_fit.sh")} >> {os.path.join(wdir, bash_log)} 2>&1'
+        if not run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log)):
+            return False
+        # the frame index of temporary files is not cached
+        last_time = scan_xtc(os.path.join(wdir, noj_xtc))['times'][-1]
+        cmd = f'cd {wdir}; echo System | gmx trjconv -s {tpr} -f {noj_xtc} -dump {last_time} -o {reference_fname} ' \
+              f'>> {os.path.join(wdir, bash_log)} 2>&1'
+        return run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log))
+
+    fit_xtc = os.path.join(wdir, 'md_fit.xtc')
+    # the name should not be {deffnm}_segments.txt, which would be read as segments of md_fit.xtc
+    processed_fname = os.path.join(wdir, '.md_fit_processed.txt')
+    reference_fname = os.path.join(wdir, '.md_fit_nojump_reference.gro')
+    # the state file of previous versions
+    if os.path.isfile(os.path.join(wdir, 'md_fit_segments.txt')):
+        os.remove(os.path.join(wdir, 'md_fit_segments.txt'))
+
+    # segments are stored relative to wdir, so the directory can be moved or staged to a scratch directory
+    segments = [f'{os.path.relpath(i, wdir)}\t{os.path.getsize(i)}' for i in get_trajectory_segments(xtc)]
+    processed = []
+    if os.path.isfile(fit_xtc) and os.path.isfile(processed_fname) and os.path.isfile(reference_fname):
+        with open(processed_fname) as inp:
+            processed = [i.strip('\n') for i in inp if i.strip()]
+    if processed != segments[:len(processed)]:
+        processed = []
+
+    if not processed:
+        first_xtc = os.path.join(wdir, segments[0].split('\t')[0])
+        if not run_md_fit(first_xtc, noj_xtc=f'{deffnm}_noj_noPBC.xtc', center_xtc='md_centermolsnoPBC.xtc',
+                          fit_xtc=fit_xtc, noj_reference=tpr):
+            return False
+        processed = segments[:1]
+
+    for segment in segments[len(processed):]:
+        segment_xtc = os.path.join(wdir, segment.split('\t')[0])
+        name = os.path.splitext(os.path.basename(segment_xtc))[0]
+        tmp_files = [os.path.join(wdir, f'{name}_noj_noPBC.xtc'), os.path.join(wdir, f'{name}_centermolsnoPBC.xtc'),
+                     os.path.join(wdir, f'{name}_fit.xtc')]
+        # the reference is replaced by the last frame of this segment, so it is copied
+        noj_reference = os.path.join(wdir, f'{name}_nojump_reference.gro')
+        shutil.copy(reference_fname, noj_reference)
+        if not run_md_fit(segment_xtc, *tmp_files, noj_reference=noj_reference):
+            return False
+        # xtc frames are independent records, so the fitted segment is simply appended to the existing file
+        with open(fit_xtc, 'ab') as out, open(tmp_files[-1], 'rb') as inp:
+            shutil.copyfileobj(inp, out)
+        for f in tmp_files + [noj_reference]:
+            os.remove(f)
+        processed.append(segment)
+        logging.info(f'{wdir}. {segment_xtc} was appended to {fit_xtc}')
+
+    with open(processed_fname, 'w') as out:
+        out.write('\n'.join(processed) + '\n')
+    # the frame index of the fitted trajectory is cached beside it and reused by run_gbsa and run_prolif
+    logging.info(f'{wdir}. {fit_xtc} has {get_number_of_frames(fit_xtc)} frames')
+    return True
+
+
 def run_md_analysis(wdir, deffnm, mdtime_ns, project_dir, bash_log, ligand_resid='UNL', ligand_list_file_prev=None):
     if ligand_list_file_prev is None:
         molid_resid_pairs_fname = os.path.join(wdir, 'all_ligand_resid.txt')
@@ -56,7 +133,11 @@ def run_md_analysis(wdir, deffnm, mdtime_ns, project_dir, bash_log, ligand_resid
     tpr = os.path.join(wdir, f'{deffnm}.tpr')
     xtc = os.path.join(wdir, f'{deffnm}.xtc')
 
-    cmd = f'wdir={wdir} index_group={index_group} tu={tu} dtstep={dtstep} deffnm={deffnm} tpr={tpr} xtc={xtc} ' \
+    if not fit_trajectory(wdir=wdir, tpr=tpr, xtc=xtc, deffnm=deffnm, index_group=index_group,
+                          project_dir=project_dir, bash_log=bash_log):
+        return None
+
+    cmd = f'wdir={wdir} tu={tu} dtstep={dtstep} tpr={tpr} ' \
            f'bash {os.path.join(project_dir, "scripts/script_sh/md_analysis.sh")} >> {os.path.join(wdir, bash_log)} 2>&1'
 
     if not run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log)):
@@ -67,6 +148,98 @@ def run_md_analysis(wdir, deffnm, mdtime_ns, project_dir, bash_log, ligand_resid
     for molid, resid in molid_resid_pairs:
         md_lig_rmsd_analysis(molid=molid, resid=resid, xtc=os.path.join(wdir, f'md_fit.xtc'), tpr=tpr, wdir=wdir, tu=tu, bash_log=bash_log, project_dir=project_dir)
 
+    # potential_{deffnm}.xvg, temperature_{deffnm}.xvg, pressure_{deffnm}.xvg and density_{deffnm}.xvg
+    write_production_energies(wdir, deffnm)
+
     for xvg_file in glob(os.path.join(wdir, '*.xvg')):
         convertxvg2png(xvg_file)
     return wdir
+
+
+def check_md_convergence(wdir, deffnm, bash_log, ligand_resid='UNL', rmsd_tolerance=0.05, unbound_rmsd=1.0,
+                         energy_drift=0.001):
+    '''
+    Check observables of the trajectory analysed by run_md_analysis
+    :param rmsd_tolerance: nm. Max difference of block averaged RMSD of the ligand (or protein backbone if there is no ligand)
+                           in the second half of the trajectory
+    :param unbound_rmsd: nm. RMSD of the ligand after which the ligand is considered as left the binding pocket
+    :param energy_drift: max relative drift of block averaged potential energy over the last part of the trajectory
+    :return: unbound, converged or None if the simulation should be continued
+    '''
+    rmsd_xvg = os.path.join(wdir, 'rmsd.xvg')
+    molid_resid_pairs_fname = os.path.join(wdir, 'all_ligand_resid.txt')
+    if os.path.isfile(molid_resid_pairs_fname) and os.path.getsize(molid_resid_pairs_fname) > 0:
+        for molid, resid in get_mol_resid_pair(molid_resid_pairs_fname):
+            if resid == ligand_resid:
+                rmsd_xvg = os.path.join(wdir, f'rmsd_{molid}.xvg')
+                break
+
+    if not os.path.isfile(rmsd_xvg):
+        logging.warning(f'{wdir}. {rmsd_xvg} does not exist. Convergence cannot be checked')
+        return None
+    rmsd = [i[1] for i in read_xvg(rmsd_xvg)]
+    if rmsd_xvg != os.path.join(wdir, 'rmsd.xvg') and rmsd and rmsd[-1] > unbound_rmsd:
+        logging.warning(f'{wdir}. Ligand RMSD {rmsd[-1]} nm is above {unbound_rmsd} nm. Ligand left the binding pocket')
+        return 'unbound'
+
+    # potential energy is usually extracted from the energy file by run_md_analysis already
+    potential_xvg = os.path.join(wdir, f'potential_{deffnm}.xvg')
+    if not os.path.isfile(potential_xvg):
+        write_production_energies(wdir, deffnm)
+    if not os.path.isfile(potential_xvg):
+        return None
+    potential = read_xvg(potential_xvg)
+    drift = relative_drift([i[0] for i in potential], [i[1] for i in potential])
+
+    rmsd_plateau = is_plateau(rmsd, tolerance=rmsd_tolerance)
+    logging.info(f'{wdir}. {deffnm}: RMSD plateau {rmsd_plateau}, relative drift of potential energy {drift}')
+    if rmsd_plateau and drift is not None and drift < energy_drift:
+        return 'converged'
+    return None
+
+
+def aggregate_replica_analysis(wdir, replica_dirs):
+    '''
+    Average analysis of replicas. For each xvg file present in all replica directories {name}_replicas.xvg file
+    with mean and SD values over replicas is created in wdir
+    :param wdir: directory of the system
+    :param replica_dirs: list of analysed replica directories of the system
+    :return: list of created files
+    '''
+    xvg_names = set.intersection(*[set(os.path.basename(i) for i in glob(os.path.join(replica_wdir, '*.xvg')))
+                                   for replica_wdir in replica_dirs])
+    output_files = []
+    for xvg_name in sorted(xvg_names):
+        data = [read_xvg(os.path.join(replica_wdir, xvg_name)) for replica_wdir in replica_dirs]
+        n_rows = min(len(i) for i in data)
+        if n_rows == 0:
+            continue
+        with open(os.path.join(replica_dirs[0], xvg_name)) as inp:
+            xvg_lines = inp.readlines()
+        header = [i for i in xvg_lines if i.startswith('@') and ('title' in i or 'axis' in i)]
+        legends = [i.split('legend')[-1].strip().strip('"') for i in xvg_lines if i.startswith('@ s') and 'legend' in i]
+        n_columns = len(data[0][0]) - 1
+        if len(legends) != n_columns:
+            legends = [''] * n_columns if n_columns == 1 else [f'column {i}' for i in range(1, n_columns + 1)]
+
+        rows = []
+        for k in range(n_rows):
+            row = [data[0][k][0]]
+            for j in range(1, n_columns + 1):
+                values = [replica[k][j] for replica in data]
+                row.extend([statistics.mean(values), statistics.stdev(values) if len(values) > 1 else 0.0])
+            rows.append(row)
+
+        output = os.path.join(wdir, f'{os.path.splitext(xvg_name)[0]}_replicas.xvg')
+        with open(output, 'w') as out:
+            out.write(f'# mean and SD over {len(replica_dirs)} replicas: {", ".join(replica_dirs)}\n')
+            out.write(''.join(header))
+            n = 0
+            for legend in legends:
+                for stat in ['mean', 'SD']:
+                    out.write(f'@ s{n} legend "{(legend + " " + stat).strip()}"\n')
+                    n += 1
+            out.write('\n'.join(' '.join(f'{v:.6g}' for v in row) for row in rows) + '\n')
+        convertxvg2png(output)
+        output_files.append(output)
+    return output_files
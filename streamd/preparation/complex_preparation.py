@@ -1,11 +1,13 @@
 import logging
 import os
+import re
 import shutil
 import subprocess
 
 from streamd.preparation.ligand_preparation import make_all_itp
 from streamd.preparation.md_files_preparation import prep_md_files, add_ligands_to_topol, \
-    edit_topology_file, prepare_mdp_files, check_if_info_already_added_to_topol
+    edit_topology_file, prepare_mdp_files, check_if_info_already_added_to_topol, run_hydrogen_mass_repartitioning, \
+    HMR_DT_FS
 
 
 def complex_preparation(protein_gro, ligand_gro_list, out_file):
@@ -27,9 +29,56 @@ def complex_preparation(protein_gro, ligand_gro_list, out_file):
         output.write(prot_data[-1])
 
 
+WATER_ATOMS_PER_NM3 = 100  # 3-site water, 33.4 molecules per nm3
+
+
+def get_box_padding(mdp_file, min_padding=1.0):
+    '''
+    :return: distance between the solute and the box in nm which is not less than cut-offs of the mdp file
+    '''
+    with open(mdp_file) as inp:
+        cutoffs = [float(i) for i in re.findall(r'\n\s*r(?:coulomb|vdw)\s*=\s*([0-9.]+)', inp.read())]
+    return max([min_padding] + cutoffs)
+
+
+def read_gro_box(gro):
+    '''
+    :return: list of 9 box vector components v1(x) v2(y) v3(z) v1(y) v1(z) v2(x) v2(z) v3(x) v3(y)
+    '''
+    with open(gro, 'rb') as inp:
+        inp.seek(0, os.SEEK_END)
+        inp.seek(max(0, inp.tell() - 200))
+        last_line = inp.read().decode().strip().split('\n')[-1]
+    box = [float(i) for i in last_line.split()]
+    return box + [0.0] * (9 - len(box))
+
+
+def get_solute_extent(gro):
+    '''
+    :return: sizes of the bounding box of the atoms along x, y, z in nm
+    '''
+    with open(gro) as inp:
+        inp.readline()
+        n_atoms = int(inp.readline())
+        coords = [(float(line[20:28]), float(line[28:36]), float(line[36:44])) for line in (inp.readline() for _ in range(n_atoms))]
+    return [max(i) - min(i) for i in zip(*coords)]
+
+
+def report_box_volume(wdir_md_cur, box_type, box_padding):
+    '''
+    Compare the volume of the created box with the cubic box of the same padding and estimate the number of saved water atoms
+    '''
+    box = read_gro_box(os.path.join(wdir_md_cur, 'solv_ions.gro'))
+    volume = box[0] * box[1] * box[2]
+    cubic_volume = (max(get_solute_extent(os.path.join(wdir_md_cur, 'complex.gro'))) + 2 * box_padding) ** 3
+    logging.info(f'{wdir_md_cur}. {box_type} box: {volume:.1f} nm3, cubic box: {cubic_volume:.1f} nm3. '
+                 f'Approximately {int((cubic_volume - volume) * WATER_ATOMS_PER_NM3)} atoms less than in the cubic box')
+
+
 def run_complex_preparation(wdir_var_ligand,  wdir_system_ligand_list,
                             protein_name, wdir_protein, wdir_md, script_path, project_dir,
-                            mdtime_ns, npt_time_ps, nvt_time_ps, clean_previous, seed, bash_log):
+                            mdtime_ns, npt_time_ps, nvt_time_ps, clean_previous, seed, bash_log, hmr=False,
+                            box_type='cubic'):
 
     wdir_md_cur, md_files_dict = prep_md_files(wdir_var_ligand=wdir_var_ligand, protein_name=protein_name,
                                                wdir_system_ligand_list=wdir_system_ligand_list,
@@ -73,19 +122,27 @@ def run_complex_preparation(wdir_var_ligand,  wdir_system_ligand_list,
         shutil.copy(mdp_file, wdir_md_cur)
 
     if not os.path.isfile(os.path.join(wdir_md_cur, 'solv_ions.gro')):
+        box_padding = get_box_padding(os.path.join(script_path, 'md.mdp'))
         try:
             subprocess.check_output(
-                f'wdir={wdir_md_cur} bash {os.path.join(project_dir, "scripts/script_sh/solv_ions.sh")}'
+                f'wdir={wdir_md_cur} box_type={box_type} box_padding={box_padding} '
+                f'bash {os.path.join(project_dir, "scripts/script_sh/solv_ions.sh")}'
                 f'>> {os.path.join(wdir_md_cur, bash_log)} 2>&1', shell=True)
         except subprocess.CalledProcessError as e:
             logging.exception(f'{wdir_md_cur}\n{e}', stack_info=True)
             return None
+        if box_type != 'cubic':
+            report_box_volume(wdir_md_cur, box_type, box_padding)
     else:
         logging.warning(f'{wdir_md_cur}. Prepared solv_ions.gro file exists. Skip solvation and ion preparation step\n')
 
+    if hmr:
+        run_hydrogen_mass_repartitioning(wdir_md_cur)
+
     if not prepare_mdp_files(wdir_md_cur=wdir_md_cur, all_resids=md_files_dict['resid'],
                              script_path=script_path, nvt_time_ps=nvt_time_ps,
-                             npt_time_ps=npt_time_ps, mdtime_ns=mdtime_ns, seed=seed):
+                             npt_time_ps=npt_time_ps, mdtime_ns=mdtime_ns, seed=seed,
+                             dt_fs=HMR_DT_FS if hmr else 2):
         return None
 
     return wdir_md_cur
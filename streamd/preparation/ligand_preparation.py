@@ -5,16 +5,14 @@ import shutil
 import re
 from glob import glob
 
-import parmed as pmd
-
-from rdkit import Chem
-from rdkit.Chem import rdmolops
-
 from streamd.utils.dask_init import init_dask_cluster, calc_dask
 from streamd.utils.utils import run_check_subprocess
 
 
 def supply_mols_tuple(fname, preset_resid=None, protein_resid_set=None):
+    import parmed as pmd
+    from rdkit import Chem
+
     def generate_resid(protein_resid_list):
         ascii_uppercase_digits = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
         for i in itertools.product(ascii_uppercase_digits, repeat=3):
@@ -63,6 +61,9 @@ def check_mols(fname):
     :param fname:
     :return: number of mols, list of problem_mols
     '''
+    import parmed as pmd
+    from rdkit import Chem
+
     def check_if_problem(mol, n):
         molid = mol.GetProp('_Name') if mol.HasProp('_Name') else n
         try:
@@ -144,6 +145,10 @@ def prepare_gaussian_files(file_template, file_out, ncpu, opt_restart=False, gau
 
 def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, conda_env_path, bash_log, gaussian_exe=None,
                 activate_gaussian=None, gaussian_basis='B3LYP/6-31G*', gaussian_memory='60GB', ncpu=1, mol2_file=None):
+    import parmed as pmd
+    from rdkit import Chem
+    from rdkit.Chem import rdmolops
+
     mol, molid, resid = mol_tuple
 
     wdir_ligand_cur = os.path.join(wdir_ligand, molid)
@@ -231,6 +236,8 @@ def prepare_input_ligands(ligand_fname, preset_resid, protein_resid_set, script_
     :param bash_log:
     :return:
     '''
+    from rdkit import Chem
+
     lig_wdirs = []
 
     if ligand_fname.endswith('.mol2'):
@@ -1,4 +1,6 @@
+import logging
 import os
+import re
 import shutil
 from glob import glob
 
@@ -48,6 +50,86 @@ def edit_mdp(md_file, pattern, replace):
         out.write(''.join(new_mdp))
 
 
+HMR_MARKER = '; Hydrogen masses are repartitioned'
+HMR_FACTOR = 3
+HMR_DT_FS = 4
+HYDROGEN_MAX_MASS = 1.2
+
+
+def repartition_hydrogen_masses(topology_file, factor=HMR_FACTOR):
+    '''
+    Multiply masses of hydrogens of all molecules in the topology by factor and subtract the added mass from
+    the bonded heavy atoms, so the total mass of molecules is preserved. The file is marked and not changed twice
+    :param topology_file: topol.top or itp file
+    :return: True if masses were changed
+    '''
+    with open(topology_file) as inp:
+        lines = inp.readlines()
+    if any(line.startswith(HMR_MARKER) for line in lines):
+        return False
+
+    def set_mass(line, mass):
+        # the mass is the 8th column of [ atoms ] section
+        span = list(re.finditer(r'\S+', line.split(';')[0]))[7].span()
+        return f'{line[:span[0]]}{mass:.5f}{line[span[1]:]}'
+
+    def repartition(atoms, bonds):
+        changed = False
+        for ai, aj in bonds:
+            if ai not in atoms or aj not in atoms:
+                continue
+            (ai_line, ai_mass), (aj_line, aj_mass) = atoms[ai], atoms[aj]
+            if aj_mass < HYDROGEN_MAX_MASS <= ai_mass:
+                (ai_line, ai_mass), (aj_line, aj_mass) = (aj_line, aj_mass), (ai_line, ai_mass)
+            elif not ai_mass < HYDROGEN_MAX_MASS <= aj_mass:
+                continue
+            # ai is hydrogen, aj is heavy atom
+            delta = ai_mass * (factor - 1)
+            lines[ai_line] = set_mass(lines[ai_line], ai_mass + delta)
+            lines[aj_line] = set_mass(lines[aj_line], aj_mass - delta)
+            atoms[aj] = (aj_line, aj_mass - delta)
+            changed = True
+        return changed
+
+    changed = False
+    section, atoms, bonds = None, {}, []
+    for n, line in enumerate(lines):
+        data = line.split(';')[0].strip()
+        if not data or data.startswith('#'):
+            continue
+        header = re.match(r'\[\s*(\w+)\s*\]', data)
+        if header:
+            section = header.group(1)
+            if section == 'moleculetype':
+                changed |= repartition(atoms, bonds)
+                atoms, bonds = {}, []
+        elif section == 'atoms':
+            items = data.split()
+            if len(items) >= 8:
+                atoms[int(items[0])] = (n, float(items[7]))
+        elif section == 'bonds':
+            items = data.split()
+            bonds.append((int(items[0]), int(items[1])))
+    changed |= repartition(atoms, bonds)
+
+    if changed:
+        with open(topology_file, 'w') as out:
+            out.write(f'{HMR_MARKER} (x{factor})\n')
+            out.write(''.join(lines))
+    return changed
+
+
+def run_hydrogen_mass_repartitioning(wdir_md_cur):
+    '''
+    Repartition hydrogen masses of the protein (topol.top and chain itp files) and ligands/cofactors itp files
+    '''
+    for fname in [os.path.join(wdir_md_cur, 'topol.top')] + glob(os.path.join(wdir_md_cur, '*.itp')):
+        if os.path.basename(fname).startswith('posre'):
+            continue
+        if repartition_hydrogen_masses(fname):
+            logging.info(f'{wdir_md_cur}. Hydrogen masses of {os.path.basename(fname)} were repartitioned')
+
+
 def edit_topology_file(topol_file, pattern, add, how='before', n=0):
     with open(topol_file) as input:
         data = input.read()
@@ -99,7 +181,10 @@ def prep_md_files(wdir_var_ligand, protein_name, wdir_system_ligand_list, wdir_p
     os.makedirs(wdir_md_cur, exist_ok=True)
 
     # topol for protein for all chains
-    copy_md_files_to_wdir(glob(os.path.join(wdir_protein, '*.itp')), wdir_copy_to=wdir_md_cur)
+    # don't rewrite existed itp files, they can be edited (e.g. by hydrogen mass repartitioning) and used in topol.top
+    copy_md_files_to_wdir([i for i in glob(os.path.join(wdir_protein, '*.itp'))
+                           if not os.path.isfile(os.path.join(wdir_md_cur, os.path.basename(i)))],
+                          wdir_copy_to=wdir_md_cur)
     # don't rewrite existed topol.top
     if not os.path.isfile(os.path.join(wdir_md_cur, "topol.top")):
         copy_md_files_to_wdir([os.path.join(wdir_protein, "topol.top")], wdir_copy_to=wdir_md_cur)
@@ -132,7 +217,39 @@ def prep_md_files(wdir_var_ligand, protein_name, wdir_system_ligand_list, wdir_p
     return wdir_md_cur, md_files_dict
 
 
-def prepare_mdp_files(wdir_md_cur, all_resids, script_path, nvt_time_ps, npt_time_ps, mdtime_ns, seed):
+def scale_mdp_output(md_file, factor):
+    '''
+    Scale output intervals set in steps, e.g. to keep output intervals in ps after the change of the time step.
+    nstenergy and nstlog are rounded to multiples of the scaled nstcalcenergy (100 by default in GROMACS),
+    otherwise grompp changes them with a warning
+    '''
+    pattern = r'(nst(?:xout|vout|fout|energy|log|calcenergy|xout-compressed)\s*=\s*)([0-9]+)'
+    with open(md_file) as inp:
+        lines = inp.readlines()
+    nstcalcenergy = 100
+    for line in lines:
+        value = re.match(pattern, line)
+        if value and value.group(1).startswith('nstcalcenergy'):
+            nstcalcenergy = max(1, int(int(value.group(2)) * factor))
+    new_mdp = []
+    for line in lines:
+        value = re.match(pattern, line)
+        if value:
+            scaled = int(int(value.group(2)) * factor)
+            if value.group(1).startswith('nstcalcenergy'):
+                scaled = nstcalcenergy
+            elif value.group(1).startswith(('nstenergy', 'nstlog')) and scaled:
+                scaled = max(1, round(scaled / nstcalcenergy)) * nstcalcenergy
+            line = line.replace(value.group(0), f'{value.group(1)}{scaled}', 1)
+        new_mdp.append(line)
+    with open(md_file, 'w') as out:
+        out.write(''.join(new_mdp))
+
+
+def prepare_mdp_files(wdir_md_cur, all_resids, script_path, nvt_time_ps, npt_time_ps, mdtime_ns, seed, dt_fs=2):
+    '''
+    :param dt_fs: time step in fs. Output intervals of mdp templates (set for 2 fs) are scaled to keep them in ps
+    '''
     if not os.path.isfile(os.path.join(wdir_md_cur, 'index.ndx')):
         create_ndx(os.path.join(wdir_md_cur, 'index.ndx'))
 
@@ -151,18 +268,24 @@ def prepare_mdp_files(wdir_md_cur, all_resids, script_path, nvt_time_ps, npt_tim
         edit_mdp(md_file=os.path.join(wdir_md_cur, md_fname),
                  pattern='tc-grps',
                  replace=f'tc-grps                 = {couple_group} {non_couple_group}; two coupling groups')
+        if dt_fs != 2:
+            edit_mdp(md_file=os.path.join(wdir_md_cur, md_fname),
+                     pattern='dt',
+                     replace=f'dt                      = {dt_fs / 1000}     ; {dt_fs} fs')
+            scale_mdp_output(os.path.join(wdir_md_cur, md_fname), factor=2 / dt_fs)
+
         steps = 0
         if md_fname == 'nvt.mdp':
-            steps = int(nvt_time_ps * 1000 / 2)
+            steps = int(nvt_time_ps * 1000 / dt_fs)
             edit_mdp(md_file=os.path.join(wdir_md_cur, md_fname),
                      pattern='gen_seed',
                      replace=f'gen_seed                = {seed}        ;')
 
         if md_fname == 'npt.mdp':
-            steps = int(npt_time_ps * 1000 / 2)
+            steps = int(npt_time_ps * 1000 / dt_fs)
         if md_fname == 'md.mdp':
-            # picoseconds=mdtime*1000; femtoseconds=picoseconds*1000; steps=femtoseconds/2
-            steps = int(mdtime_ns * 1000 * 1000 / 2)
+            # picoseconds=mdtime*1000; femtoseconds=picoseconds*1000; steps=femtoseconds/dt
+            steps = int(mdtime_ns * 1000 * 1000 / dt_fs)
 
         edit_mdp(md_file=os.path.join(wdir_md_cur, md_fname),
                  pattern='nsteps',
@@ -178,3 +301,31 @@ def prepare_mdp_files(wdir_md_cur, all_resids, script_path, nvt_time_ps, npt_tim
             return None
 
     return wdir_md_cur
+
+
+def prepare_replicas(wdir_md_cur, n_replicas, seed):
+    '''
+    Create replica_N subdirectories which share the prepared and minimized system of wdir_md_cur
+    and differ by the seed of the velocity generation
+    :param wdir_md_cur: directory with the minimized system (em.gro)
+    :param n_replicas: int
+    :param seed: int. Replica N uses seed + N. If -1 a random seed will be used for each replica
+    :return: list of replica directories
+    '''
+    replica_dirs = []
+    for n in range(1, n_replicas + 1):
+        wdir_replica = os.path.join(wdir_md_cur, f'replica_{n}')
+        os.makedirs(wdir_replica, exist_ok=True)
+        files = glob(os.path.join(wdir_md_cur, '*.itp')) + \
+                [os.path.join(wdir_md_cur, i) for i in ['topol.top', 'index.ndx', 'solv_ions.gro', 'em.gro', 'em.tpr',
+                                                        'potential.xvg', 'all_ligand_resid.txt']]
+        for file in files:
+            if os.path.isfile(file) and not os.path.isfile(os.path.join(wdir_replica, os.path.basename(file))):
+                shutil.copy(file, wdir_replica)
+        for mdp_fname in ['nvt.mdp', 'npt.mdp', 'md.mdp']:
+            shutil.copy(os.path.join(wdir_md_cur, mdp_fname), wdir_replica)
+        edit_mdp(md_file=os.path.join(wdir_replica, 'nvt.mdp'),
+                 pattern='gen_seed',
+                 replace=f'gen_seed                = {seed + n if seed != -1 else -1}        ;')
+        replica_dirs.append(wdir_replica)
+    return replica_dirs
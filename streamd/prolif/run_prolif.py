@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import logging
+import math
+import multiprocessing
 import os
 import shutil
 from functools import partial
 from glob import glob
 from multiprocessing import cpu_count
 
-import MDAnalysis as mda
-import pandas as pd
-import prolif as plf
+from streamd.utils.dask_init import init_dask_cluster, calc_dask, get_workers_nthreads, CORES_RESOURCE
+from streamd.utils.frame_selection import get_representative_frames
+from streamd.utils.registry import get_systems, run_registered
+from streamd.utils.utils import filepath_type, get_trajectory_segments
+from streamd.utils.xtc import get_number_of_frames, get_xtc_index
 
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
-from streamd.utils.utils import filepath_type
+PROLIF_INTERACTIONS = ['Hydrophobic', 'HBDonor', 'HBAcceptor', 'Anionic', 'Cationic', 'CationPi', 'PiCation',
+                       'PiStacking', 'MetalAcceptor']
+PROLIF_CHUNK_FRAMES = 500
+PROLIF_STATE_FNAME = 'progress.json'
 
 
 class RawTextArgumentDefaultsHelpFormatter(argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter):
@@ -26,23 +34,183 @@ def backup_output(output):
         shutil.move(output, os.path.join(os.path.dirname(output), f'#{os.path.basename(output)}.{n}#'))
 
 
-def run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs):
-    u = mda.Universe(tpr, xtc)
-
-    protein = u.atoms.select_atoms(protein_selection)
-    ligand = u.atoms.select_atoms(ligand_selection)
+def get_chunks_dir(output):
+    '''
+    Chunks of fingerprints are stored beside the output: plifs.csv -> plifs_chunks
+    '''
+    return f'{os.path.splitext(output)[0]}_chunks'
+
+
+def get_trajectory_state(xtc):
+    '''
+    :return: list of [segment name, number of frames, step of the last frame] of all segments of the trajectory
+    '''
+    res = []
+    for xtc_segment in get_trajectory_segments(xtc):
+        steps = get_xtc_index(xtc_segment)['steps']
+        res.append([os.path.basename(xtc_segment), len(steps), steps[-1] if steps else None])
+    return res
+
+
+def is_extended(xtc, trajectory_state):
+    '''
+    :param trajectory_state: get_trajectory_state output saved previously
+    :return: True if frames of the trajectory were not changed since then. New frames can be appended to the last
+             segment and new segments can be added
+    '''
+    segments = get_trajectory_segments(xtc)
+    if len(segments) < len(trajectory_state):
+        return False
+    for n, (xtc_segment, (name, frames, last_step)) in enumerate(zip(segments, trajectory_state), 1):
+        if os.path.basename(xtc_segment) != name or not os.path.isfile(xtc_segment):
+            return False
+        steps = get_xtc_index(xtc_segment)['steps']
+        # frame numbers of the next segments are shifted if a previous segment is changed
+        if len(steps) < frames or (n < len(trajectory_state) and len(steps) != frames):
+            return False
+        if frames and steps[frames - 1] != last_step:
+            return False
+    return True
+
+
+def read_chunks(chunks_dir, settings, xtc):
+    '''
+    Read fingerprints of previously analysed frames. Chunks are removed if the settings are different or frames of
+    the trajectory were changed
+    :param settings: dict of the number of atoms, selections and interactions
+    :return: list of dataframes of chunks
+    '''
+    import pandas as pd
+
+    state_fname = os.path.join(chunks_dir, PROLIF_STATE_FNAME)
+    state = None
+    if os.path.isfile(state_fname):
+        try:
+            with open(state_fname) as inp:
+                state = json.load(inp)
+        except ValueError:
+            state = None
 
-    fp = plf.Fingerprint(['Hydrophobic', 'HBDonor', 'HBAcceptor', 'Anionic', 'Cationic', 'CationPi', 'PiCation',
-                          'PiStacking', 'MetalAcceptor'])
-    fp.run(u.trajectory[::step], ligand, protein, progress=verbose, n_jobs=n_jobs)
-    df = fp.to_dataframe()
-    df.columns = ['.'.join(item.strip().lower() for item in items[1:]) for items in df.columns]
+    df_list = []
+    if state is not None and state['settings'] == settings and is_extended(xtc, state['xtc']):
+        df_list = [pd.read_csv(i, sep='\t', index_col=0) for i in sorted(glob(os.path.join(chunks_dir, 'frames_*.tsv')))]
+    elif os.path.isdir(chunks_dir):
+        logging.info(f'{chunks_dir}. Settings or trajectory were changed. Previous fingerprints will be removed')
+        shutil.rmtree(chunks_dir)
+
+    os.makedirs(chunks_dir, exist_ok=True)
+    with open(state_fname, 'w') as out:
+        json.dump({'settings': settings, 'xtc': get_trajectory_state(xtc)}, out, indent=2)
+    return df_list
+
+
+def write_chunk(df, chunks_dir, first_frame):
+    '''
+    The chunk is replaced atomically, so a killed job does not leave incomplete chunks
+    '''
+    fname = os.path.join(chunks_dir, f'frames_{first_frame:09d}.tsv')
+    df.to_csv(f'{fname}.tmp', sep='\t')
+    os.replace(f'{fname}.tmp', fname)
+
+
+def run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs, frames=None,
+                    chunk_size=PROLIF_CHUNK_FRAMES):
+    '''
+    Frames are fingerprinted in chunks which are saved to the {output}_chunks directory. Frames of saved chunks are
+    not analysed again while the system and selections are the same and the trajectory was only extended.
+    So a killed job is resumed and only new frames of an extended trajectory are analysed
+    :param frames: None or list of 0-based frames to analyse instead of every step-th frame
+    :param chunk_size: number of frames in a chunk
+    '''
+    import MDAnalysis as mda
+    import pandas as pd
+    import prolif as plf
+
+    if frames is None:
+        frames = list(range(0, get_number_of_frames(xtc) or 0, step))
+    # tpr files of continued simulations differ only by run parameters, so the system is identified by its number
+    # of atoms and selections
+    settings = {'natoms': get_xtc_index(get_trajectory_segments(xtc)[0])['natoms'],
+                'protein_selection': protein_selection, 'ligand_selection': ligand_selection,
+                'interactions': PROLIF_INTERACTIONS}
+    chunks_dir = get_chunks_dir(output)
+    df_list = read_chunks(chunks_dir, settings, xtc)
+    done = set(i for df in df_list for i in df.index)
+    todo = [i for i in frames if i not in done]
+
+    if todo:
+        logging.info(f'{xtc}. {len(todo)} of {len(frames)} frames will be analysed by ProLIF')
+        # a trajectory extended in the segments mode is read as a single chained trajectory
+        segments = get_trajectory_segments(xtc)
+        u = mda.Universe(tpr, segments if len(segments) > 1 else xtc)
+
+        protein = u.atoms.select_atoms(protein_selection)
+        ligand = u.atoms.select_atoms(ligand_selection)
+
+        for i in range(0, len(todo), chunk_size):
+            chunk = todo[i:i + chunk_size]
+            fp = plf.Fingerprint(PROLIF_INTERACTIONS)
+            fp.run(u.trajectory[chunk], ligand, protein, progress=verbose, n_jobs=n_jobs)
+            df = fp.to_dataframe()
+            df.columns = ['.'.join(item.strip().lower() for item in items[1:]) for items in df.columns]
+            # frames without interactions are kept to mark them as analysed
+            df = df.reindex(pd.Index(chunk, name='Frame'), fill_value=False)
+            write_chunk(df, chunks_dir, chunk[0])
+            df_list.append(df)
+
+    if not df_list:
+        df_list = [pd.DataFrame(index=pd.Index([], name='Frame'))]
+    df = pd.concat(df_list).fillna(False).astype(bool)
+    df = df[~df.index.duplicated(keep='last') & df.index.isin(frames)].sort_index()
     df = df.reindex(sorted(df.columns), axis=1)
     df.to_csv(output, sep='\t')
     return df
 
 
-def run_prolif_from_wdir(wdir, tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs):
+def get_prolif_frames(wdir, tpr, xtc, ligand_resid, step, rmsd_cutoff):
+    '''
+    :return: representative frames among every step-th frame (see get_representative_frames) or None
+    '''
+    number_of_frames = get_number_of_frames(xtc)
+    if not number_of_frames:
+        return None
+    selection = get_representative_frames(wdir, tpr, xtc, ligand_resid,
+                                          frames=range(0, number_of_frames, step), rmsd_cutoff=rmsd_cutoff)
+    return selection['frames'] if selection else None
+
+
+def allocate_cores(wdir_frames, total_cores, max_cores):
+    '''
+    Split cores between directories proportionally to the numbers of analysed frames. Each directory gets at least
+    one core and not more than max_cores and its number of frames. The remaining cores are given one by one to
+    directories with the most frames per core
+    :param wdir_frames: dict {wdir: number of analysed frames}
+    :param total_cores: number of cores of all nodes
+    :param max_cores: max number of cores of a single task, e.g. cores of the smallest node
+    :return: dict {wdir: number of cores}
+    '''
+    total_frames = max(1, sum(wdir_frames.values()))
+    limits = {wdir: max(1, min(max_cores, frames)) for wdir, frames in wdir_frames.items()}
+    wdir_cores = {wdir: max(1, min(limits[wdir], total_cores * frames // total_frames))
+                  for wdir, frames in wdir_frames.items()}
+    free_cores = total_cores - sum(wdir_cores.values())
+    while free_cores > 0:
+        candidates = [wdir for wdir in wdir_cores if wdir_cores[wdir] < limits[wdir]]
+        if not candidates:
+            break
+        wdir = max(candidates, key=lambda x: wdir_frames[x] / wdir_cores[x])
+        wdir_cores[wdir] += 1
+        free_cores -= 1
+    return wdir_cores
+
+
+def run_prolif_from_wdir(wdir, tpr, xtc, protein_selection, ligand_selection, step, verbose, output, wdir_jobs,
+                         ligand_resid='UNL', rmsd_cutoff=None):
+    '''
+    The task is run in a separate process, so tasks of the same dask worker do not compete for GIL and ProLIF
+    can start its own pool of wdir_jobs[wdir] processes
+    :param wdir_jobs: dict {wdir: number of cores}
+    '''
     tpr = os.path.join(wdir, tpr)
     xtc = os.path.join(wdir, xtc)
     output = os.path.join(wdir, output)
@@ -51,12 +219,26 @@ def run_prolif_from_wdir(wdir, tpr, xtc, protein_selection, ligand_selection, st
     if not os.path.isfile(tpr) or not os.path.isfile(xtc):
         print(f'{wdir}: cannot run gbsa. Check if there are missing files: {tpr} {xtc}. Skip such directory')
         return None
+    # frames are counted by the cached frame index without decoding coordinates
+    if not get_number_of_frames(xtc):
+        print(f'{wdir}: trajectory {xtc} has no complete frames. Skip such directory')
+        return None
 
-    run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs)
+    frames = get_prolif_frames(wdir, tpr, xtc, ligand_resid, step, rmsd_cutoff) if rmsd_cutoff else None
+    process = multiprocessing.get_context('spawn').Process(
+        target=run_prolif_task, args=(tpr, xtc, protein_selection, ligand_selection, step, verbose, output,
+                                      wdir_jobs[wdir]), kwargs={'frames': frames})
+    process.start()
+    process.join()
+    if process.exitcode != 0 or not os.path.isfile(output):
+        logging.warning(f'{wdir}: ProLIF calculation failed with the exit code {process.exitcode}')
+        return None
     return output
 
 
 def collect_outputs(output_list, output):
+    import pandas as pd
+
     df_list = []
     for i in output_list:
         df = pd.read_csv(i, sep='\t')
@@ -72,18 +254,15 @@ def collect_outputs(output_list, output):
     df_aggregated.loc[:, sorted_columns].to_csv(output, sep='\t', index=False)
 
 
-def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection, ligand_resid, hostfile, ncpu, verbose):
+def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection, ligand_resid, hostfile, ncpu, verbose,
+          registry=None, rmsd_cutoff=None):
+    '''
+    :param rmsd_cutoff: None or Å. Analyse only representative frames of pocket and ligand conformations,
+                        their weights are saved to representative_frames.json
+    '''
     output = 'plifs.csv'
     output_aggregated = os.path.join(wdir_output, 'prolif_output.csv')
 
-    # problem with n_jobs
-    # if hostfile:
-    #     with open(hostfile) as f:
-    #         hosts = [line.strip() for line in f if line.strip()]
-    #         n_servers = len(hosts)
-    # else:
-    #     n_servers = 1
-
     if append_protein_selection is None:
         protein_selection = 'protein'
     else:
@@ -93,17 +272,26 @@ def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection, li
 
     if wdir_to_run is not None:
         dask_client, cluster = None, None
-        # n_tasks_per_node = min(math.ceil(len(wdir_to_run) / n_servers), ncpu)
-        n_tasks_per_node = min(len(wdir_to_run), ncpu)
-        njobs_per_task = 1
-        # njobs_per_task = math.floor(ncpu / n_tasks_per_node)
+        wdir_frames = {wdir: math.ceil((get_number_of_frames(os.path.join(wdir, xtc)) or 0) / step)
+                       for wdir in wdir_to_run}
         try:
-            dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=n_tasks_per_node, ncpu=ncpu)
+            dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=1, ncpu=ncpu,
+                                                     cores_resource=True, worker_daemon=False)
+            # cores are allocated by the resources which workers actually advertise, so each task can be placed
+            workers_cores = [nthreads for nthreads, addresses in get_workers_nthreads(dask_client).items()
+                             for _ in addresses]
+            # directories are parallelized over cores of all nodes and frames of a directory over cores of a task
+            wdir_jobs = allocate_cores(wdir_frames, total_cores=sum(workers_cores), max_cores=min(workers_cores))
+            for wdir in wdir_to_run:
+                logging.info(f'{wdir}. {wdir_frames[wdir]} frames will be analysed using {wdir_jobs[wdir]} cores')
             var_prolif_out_files = []
-            for res in calc_dask(run_prolif_from_wdir, wdir_to_run, dask_client=dask_client,
+            # first fit decreasing: the largest jobs are placed first and smaller ones fill the remaining cores
+            for res in calc_dask(run_registered, sorted(wdir_jobs, key=wdir_jobs.get, reverse=True),
+                                 dask_client=dask_client, resources=lambda x: {CORES_RESOURCE: wdir_jobs[x]},
+                                 registry=registry, stage='prolif', stage_task=run_prolif_from_wdir,
                                  tpr=tpr, xtc=xtc, protein_selection=protein_selection,
                                  ligand_selection=ligand_selection, step=step, verbose=verbose, output=output,
-                                 n_jobs=njobs_per_task):
+                                 wdir_jobs=wdir_jobs, ligand_resid=ligand_resid, rmsd_cutoff=rmsd_cutoff):
                 if res:
                     var_prolif_out_files.append(res)
         finally:
@@ -115,7 +303,13 @@ def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection, li
                 cluster.close()
     else:
         output = os.path.join(os.path.dirname(xtc), output)
-        run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs=ncpu)
+        if not get_number_of_frames(xtc):
+            print(f'Trajectory {xtc} is missing or has no complete frames')
+            return None
+        frames = get_prolif_frames(os.path.dirname(xtc), tpr, xtc, ligand_resid, step, rmsd_cutoff) \
+            if rmsd_cutoff else None
+        run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs=ncpu,
+                        frames=frames)
         var_prolif_out_files = [output]
 
     backup_output(output_aggregated)
@@ -138,6 +332,11 @@ def main():
                         help='residue name of a ligand in the input trajectory.')
     parser.add_argument('-s', '--step', metavar='INTEGER', required=False, default=1, type=int,
                         help='step to take every n-th frame. ps')
+    parser.add_argument('--rmsd_cutoff', metavar='ANGSTROM', required=False, default=None, type=float,
+                        help='analyse only representative frames. Conformations of the ligand and pocket residues '
+                             'within 5 Å of every step-th frame are clustered by RMSD with this cutoff and one frame of '
+                             'each cluster is analysed. Frames and weights of clusters are saved to '
+                             'representative_frames.json')
     parser.add_argument('-a', '--append_protein_selection', metavar='STRING', required=False, default=None,
                         help='the string which will be concatenated to the protein selection atoms. '
                              'Example: "resname ZN or resname MG".')
@@ -150,9 +349,15 @@ def main():
                         help='text file with addresses of nodes of dask SSH cluster. The most typical, it can be '
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
                              'will be the address of the scheduler running on the standard port 8786. If omitted, '
-                             'calculations will run on a single machine as usual.')
+                             'calculations will run on a single machine as usual. Each line can set cores and memory of the node '
+                             'and its role: "node1 cores=128 memory=256GB" or "node0 role=scheduler" to run only the '
+                             'scheduler on the node. --ncpu is used for nodes without cores.')
     parser.add_argument('-c', '--ncpu', metavar='INTEGER', required=False, default=cpu_count(), type=int,
                         help='number of CPU per server. Use all cpus by default.')
+    parser.add_argument('--registry', metavar='FILENAME', required=False, default=None, type=filepath_type,
+                        help='SQLite registry of the run_md campaign (md_files/streamd_registry.sqlite). If --wdir_to_run '
+                             'is not set, all systems with finished md analysis will be used. Statuses and timings of '
+                             'ProLIF calculations are recorded in the registry')
 
     args = parser.parse_args()
 
@@ -161,16 +366,21 @@ def main():
     else:
         wdir = args.wdir
 
-    if args.wdir_to_run is not None:
+    wdir_to_run = args.wdir_to_run
+    if wdir_to_run is None and args.registry:
+        wdir_to_run = get_systems(args.registry, stage='analysis', status='done')
+
+    if wdir_to_run is not None:
         tpr = 'md_out.tpr'
         xtc = 'md_fit.xtc'
     else:
         tpr = args.tpr
         xtc = args.xtc
 
-    start(wdir_to_run=args.wdir_to_run, wdir_output=wdir, tpr=tpr,
+    start(wdir_to_run=wdir_to_run, wdir_output=wdir, tpr=tpr,
           xtc=xtc, step=args.step, append_protein_selection=args.append_protein_selection,
-          ligand_resid=args.ligand, hostfile=args.hostfile, ncpu=args.ncpu, verbose=args.verbose)
+          ligand_resid=args.ligand, hostfile=args.hostfile, ncpu=args.ncpu, verbose=args.verbose,
+          registry=args.registry, rmsd_cutoff=args.rmsd_cutoff)
 
 
 if __name__ == '__main__':
@@ -1,39 +1,45 @@
 import argparse
+import json
 import logging
 import math
 import os
 import re
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from multiprocessing import cpu_count
 
-import pandas as pd
-
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
-from streamd.utils.utils import get_index, make_group_ndx, filepath_type, run_check_subprocess
-
-
-def run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append_protein_selection, out_time, bash_log, clean_previous):
-    def calc_gbsa(wdir, tpr, xtc, topol, index, mmpbsa, np, protein_index, ligand_index, out_time, bash_log):
-        output = os.path.join(wdir, f"FINAL_RESULTS_MMPBSA_{out_time}.dat")
-        cmd = f'cd {wdir}; mpirun -np {np} gmx_MMPBSA MPI -O -i {mmpbsa} ' \
-              f' -cs {tpr} -ci {index} -cg {protein_index} {ligand_index} -ct {xtc} -cp {topol} -nogui ' \
-              f'-o {output} ' \
-              f'-eo {os.path.join(wdir, f"FINAL_RESULTS_MMPBSA_{out_time}.csv")}' \
-              f' >> {os.path.join(wdir, bash_log)} 2>&1'
-        if not run_check_subprocess(cmd, key=xtc, log=os.path.join(wdir, bash_log)):
-            return None
-        return output
-
-    if clean_previous:
-        clean_temporary_gmxMMBPSA_files(wdir)
-
-    if not os.path.isfile(tpr) or not os.path.isfile(xtc) or not os.path.isfile(topol) or not os.path.isfile(index):
-        logging.warning(f'{wdir} cannot run gbsa. Check if there are missing files: {tpr} {xtc} {topol} {index}')
+from streamd.utils.dask_init import init_dask_cluster, calc_dask, get_hosts_ncpu, CORES_RESOURCE
+from streamd.utils.mmpbsa_output import read_energy_csv, merge_energy_data, write_energy_csv, summarize_energies, \
+    write_results, get_frame_records, get_summary_records, sort_energy_frames, get_total_sem
+from streamd.utils.frame_selection import get_representative_frames
+from streamd.utils.gbsa_cache import read_cache, write_cache, get_topology_files, get_gbsa_key, get_cached_result, \
+    save_result
+from streamd.utils.registry import get_systems, run_registered, set_stage
+from streamd.utils.utils import get_index, make_group_ndx, filepath_type, run_check_subprocess, get_trajectory_segments
+from streamd.utils.xtc import get_number_of_frames, write_xtc_frames
+
+ADAPTIVE_INITIAL_FRAMES = 16  # number of frames of the first batch of adaptive frame sampling
+
+
+def calc_gbsa(wdir, tpr, xtc, topol, index, mmpbsa, np, protein_index, ligand_index, out_time, bash_log):
+    output = os.path.join(wdir, f"FINAL_RESULTS_MMPBSA_{out_time}.dat")
+    cmd = f'cd {wdir}; mpirun -np {np} gmx_MMPBSA MPI -O -i {mmpbsa} ' \
+          f' -cs {tpr} -ci {index} -cg {protein_index} {ligand_index} -ct {" ".join(get_trajectory_segments(xtc))} -cp {topol} -nogui ' \
+          f'-o {output} ' \
+          f'-eo {os.path.join(wdir, f"FINAL_RESULTS_MMPBSA_{out_time}.csv")}' \
+          f' >> {os.path.join(wdir, bash_log)} 2>&1'
+    if not run_check_subprocess(cmd, key=xtc, log=os.path.join(wdir, bash_log)):
         return None
+    return output
 
+
+def get_gbsa_index_groups(wdir, index, ligand_resid, append_protein_selection):
+    '''
+    :return: numbers of protein (with appended residues) and ligand groups of the index file or None, None
+    '''
     index_list = get_index(index)
     if append_protein_selection is None:
         protein_index = index_list.index('Protein')
@@ -49,7 +55,7 @@ def run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append
             name_query = f"Protein_{'_'.join(add_group_ids.values())}"
             if name_query not in index_list:
                 if not make_group_ndx(query, wdir):
-                    return None
+                    return None, None
                 index_list = get_index(index)
 
             protein_index = index_list.index(name_query)
@@ -60,6 +66,77 @@ def run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append
     logging.warning(f'INFO: {protein_index} number of index selection will be used as a protein system')
 
     ligand_index = index_list.index(ligand_resid)
+    return protein_index, ligand_index
+
+
+def get_gbsa_cache_key(cache, tpr, xtc, topol, index, mmpbsa, protein_index, ligand_index, adaptive=None,
+                       representative=None):
+    '''
+    :param adaptive: None or list of settings of adaptive frame sampling
+    :param representative: None or list of settings of representative frame selection
+    '''
+    files = [tpr] + get_trajectory_segments(xtc) + get_topology_files(topol) + [index, mmpbsa]
+    selection = [protein_index, ligand_index]
+    if adaptive:
+        selection += ['adaptive'] + adaptive
+    if representative:
+        selection += ['representative'] + representative
+    return get_gbsa_key(cache, files, selection=selection)
+
+
+def find_cached_gbsa(wdir, tpr, xtc, topol, index, mmpbsa, ligand_resid, append_protein_selection):
+    '''
+    :param tpr, xtc, topol, index: file names relative to wdir or absolute paths
+    :return: FINAL_RESULTS_MMPBSA.dat of a previous calculation with the same inputs and index groups or None
+    '''
+    tpr, xtc, topol, index = [os.path.join(wdir, i) for i in [tpr, xtc, topol, index]]
+    if not all(os.path.isfile(i) for i in [tpr, xtc, topol, index]):
+        return None
+    protein_index, ligand_index = get_gbsa_index_groups(wdir, index, ligand_resid, append_protein_selection)
+    if protein_index is None:
+        return None
+    cache = read_cache(wdir)
+    key = get_gbsa_cache_key(cache, tpr, xtc, topol, index, mmpbsa, protein_index, ligand_index)
+    # file hashes are saved to be reused by the calculation
+    write_cache(wdir, cache)
+    return get_cached_result(wdir, cache, key)
+
+
+def run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append_protein_selection, out_time, bash_log,
+                  clean_previous, use_cache=True, rmsd_cutoff=None):
+    '''
+    :param use_cache: return the result of a previous calculation if inputs and index groups were not changed
+    :param rmsd_cutoff: None or Å. Calculate only representative frames of pocket and ligand conformations
+                        (see calc_representative_gbsa)
+    '''
+    if not os.path.isfile(tpr) or not os.path.isfile(xtc) or not os.path.isfile(topol) or not os.path.isfile(index):
+        logging.warning(f'{wdir} cannot run gbsa. Check if there are missing files: {tpr} {xtc} {topol} {index}')
+        return None
+
+    protein_index, ligand_index = get_gbsa_index_groups(wdir, index, ligand_resid, append_protein_selection)
+    if protein_index is None:
+        return None
+
+    cache = read_cache(wdir)
+    key = get_gbsa_cache_key(cache, tpr, xtc, topol, index, mmpbsa, protein_index, ligand_index,
+                             representative=[rmsd_cutoff] if rmsd_cutoff else None)
+    if use_cache:
+        output = get_cached_result(wdir, cache, key)
+        if output:
+            logging.info(f'{wdir}. Inputs were not changed, {output} will be used')
+            return output
+
+    if clean_previous:
+        clean_temporary_gmxMMBPSA_files(wdir)
+
+    if rmsd_cutoff:
+        output = calc_representative_gbsa(wdir, tpr=tpr, xtc=xtc, topol=topol, index=index, mmpbsa=mmpbsa, np=np,
+                                          protein_index=protein_index, ligand_index=ligand_index,
+                                          ligand_resid=ligand_resid, rmsd_cutoff=rmsd_cutoff, out_time=out_time,
+                                          bash_log=bash_log)
+        if output:
+            save_result(wdir, cache, key, output)
+        return output
 
     output = calc_gbsa(wdir=wdir, tpr=tpr, xtc=xtc, topol=topol,
                        index=index, mmpbsa=mmpbsa,
@@ -72,15 +149,399 @@ def run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append
 
     clean_temporary_gmxMMBPSA_files(wdir)
 
+    if output:
+        save_result(wdir, cache, key, output)
     return output
 
 
-def run_gbsa_from_wdir(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append_protein_selection, out_time, bash_log, clean_previous):
+def run_gbsa_from_wdir(wdir, tpr, xtc, topol, index, mmpbsa, wdir_np, ligand_resid, append_protein_selection, out_time,
+                       bash_log, clean_previous, use_cache=True, rmsd_cutoff=None):
+    '''
+    :param wdir_np: dict {wdir: number of MPI processes}
+    '''
     tpr = os.path.join(wdir, tpr)
     xtc = os.path.join(wdir, xtc)
     topol = os.path.join(wdir, topol)
     index = os.path.join(wdir, index)
-    return run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, np, ligand_resid, append_protein_selection, out_time, bash_log, clean_previous)
+    return run_gbsa_task(wdir, tpr, xtc, topol, index, mmpbsa, wdir_np[wdir], ligand_resid, append_protein_selection, out_time, bash_log, clean_previous,
+                         use_cache=use_cache, rmsd_cutoff=rmsd_cutoff)
+
+
+def get_max_np(hostfile, ncpu):
+    '''
+    :return: the number of cores of the smallest node, so each task can be run on any node
+    '''
+    return min(get_hosts_ncpu(hostfile, ncpu))
+
+
+def get_used_number_of_frames(number_of_frames, startframe, endframe, interval):
+    return math.ceil((min(number_of_frames, endframe) - (startframe - 1)) / interval)
+
+
+def get_frame_shards(startframe, endframe, interval, n_shards):
+    '''
+    Split frames startframe, startframe + interval, ... <= endframe into consecutive shards of nearly equal size
+    :return: list of (startframe, endframe) of shards
+    '''
+    frames = list(range(startframe, endframe + 1, interval))
+    n_shards = max(1, min(n_shards, len(frames)))
+    size, rest = divmod(len(frames), n_shards)
+    shards, i = [], 0
+    for n in range(n_shards):
+        j = i + size + (1 if n < rest else 0)
+        shards.append((frames[i], frames[j - 1]))
+        i = j
+    return shards
+
+
+def get_adaptive_batches(startframe, endframe, interval, initial_frames=ADAPTIVE_INITIAL_FRAMES):
+    '''
+    Split frames startframe, startframe + interval, ... <= endframe into strided batches. The first batch takes about
+    initial_frames evenly spaced frames, each next batch takes frames in the middle of previous ones, so the trajectory
+    is sampled uniformly after each batch and the number of frames is doubled
+    :return: list of (startframe, endframe, interval) of batches
+    '''
+    n_frames = len(range(startframe, endframe + 1, interval))
+    stride = 1
+    while n_frames // (stride * 2) >= initial_frames:
+        stride *= 2
+    batches = [(startframe, endframe, stride * interval)]
+    while stride > 1:
+        batches.append((startframe + stride // 2 * interval, endframe, stride * interval))
+        stride //= 2
+    return [i for i in batches if i[0] <= i[1]]
+
+
+def write_shard_mmpbsa(mmpbsa, mmpbsa_shard, startframe, endframe, interval=None):
+    '''
+    Copy the mmpbsa input file and set the frame range (and interval) of the shard
+    '''
+    with open(mmpbsa) as inp:
+        data = inp.read()
+    options = [('startframe', startframe), ('endframe', endframe)]
+    if interval is not None:
+        options.append(('interval', interval))
+    for key, value in options:
+        if re.search(rf'\b{key}\s*=', data):
+            data = re.sub(rf'\b{key}\s*=\s*[0-9]*', f'{key}={value}', data)
+        elif re.search(r'&general\s*\n', data):
+            data = re.sub(r'&general\s*\n', lambda x: f'{x.group(0)}{key}={value},\n', data, count=1)
+        else:
+            data += f'\n&general\n{key}={value},\n/\n'
+    with open(mmpbsa_shard, 'w') as out:
+        out.write(data)
+
+
+def calc_gbsa_frames(wdir, wdir_run, tpr, xtc, topol, index, mmpbsa, np, protein_index, ligand_index, startframe,
+                     endframe, interval, out_time, bash_log, log_name):
+    '''
+    Run gmx_MMPBSA for a subset of frames of the trajectory in a separate directory wdir_run
+    :param tpr, xtc, topol, index: file names relative to wdir or absolute paths
+    :param log_name: name of the copy of gmx_MMPBSA.log in wdir
+    :return: csv file with per-frame energies or None
+    '''
+    os.makedirs(wdir_run, exist_ok=True)
+    mmpbsa_run = os.path.join(wdir_run, os.path.basename(mmpbsa))
+    write_shard_mmpbsa(mmpbsa, mmpbsa_run, startframe=startframe, endframe=endframe, interval=interval)
+
+    output = calc_gbsa(wdir=wdir_run, tpr=os.path.join(wdir, tpr), xtc=os.path.join(wdir, xtc),
+                       topol=os.path.join(wdir, topol), index=os.path.join(wdir, index), mmpbsa=mmpbsa_run,
+                       np=np, protein_index=protein_index, ligand_index=ligand_index, out_time=out_time, bash_log=bash_log)
+    if os.path.isfile(os.path.join(wdir_run, 'gmx_MMPBSA.log')):
+        shutil.copy(os.path.join(wdir_run, 'gmx_MMPBSA.log'), os.path.join(wdir, log_name))
+    clean_temporary_gmxMMBPSA_files(wdir_run)
+
+    csv_output = os.path.join(wdir_run, f'FINAL_RESULTS_MMPBSA_{out_time}.csv')
+    if output is None or not os.path.isfile(csv_output):
+        return None
+    return csv_output
+
+
+def run_gbsa_shard(shard, tpr, xtc, topol, index, mmpbsa, out_time, bash_log):
+    '''
+    Run gmx_MMPBSA for a frame range of the trajectory in a separate directory {wdir}/gbsa_shards_{out_time}/shard_N
+    :param shard: wdir, shard number, startframe, endframe, protein index group, ligand index group, NP
+    :return: wdir, shard number, csv file with per-frame energies or None
+    '''
+    wdir, n, startframe, endframe, protein_index, ligand_index, np = shard
+    csv_output = calc_gbsa_frames(wdir, os.path.join(wdir, f'gbsa_shards_{out_time}', f'shard_{n}'), tpr=tpr, xtc=xtc,
+                                  topol=topol, index=index, mmpbsa=mmpbsa, np=np, protein_index=protein_index,
+                                  ligand_index=ligand_index, startframe=startframe, endframe=endframe, interval=None,
+                                  out_time=out_time, bash_log=bash_log, log_name=f'gmx_MMPBSA_{out_time}_shard_{n}.log')
+    if csv_output is None:
+        return None
+    return wdir, n, csv_output
+
+
+def get_weights_fname(fname):
+    '''
+    Weights of frames are stored beside the results: FINAL_RESULTS_MMPBSA.dat -> FINAL_RESULTS_MMPBSA_weights.json
+    '''
+    return f'{os.path.splitext(fname)[0]}_weights.json'
+
+
+def read_frame_weights(fname, data):
+    '''
+    :param fname: FINAL_RESULTS_MMPBSA.dat file
+    :param data: per-frame energies of the results in the read_energy_csv format
+    :return: list of weights in the order of rows or None if frames are not weighted
+    '''
+    weights_fname = get_weights_fname(fname)
+    if not os.path.isfile(weights_fname):
+        return None
+    with open(weights_fname) as inp:
+        frame_weights = json.load(inp)
+    frame_weights = dict(zip(frame_weights['frames'], frame_weights['weights']))
+    for components in data.values():
+        for table in components.values():
+            return [frame_weights[int(row[0])] for row in table['rows']]
+    return None
+
+
+def write_merged_results(wdir, data, mmpbsa, out_time, title, weights=None):
+    '''
+    Write merged per-frame energies to FINAL_RESULTS_MMPBSA_{out_time}.csv and averages, SD, SEM and
+    interaction entropy recalculated from all frames to FINAL_RESULTS_MMPBSA_{out_time}.dat
+    :param weights: None or weights of frames in the order of rows. They are saved to
+                    FINAL_RESULTS_MMPBSA_{out_time}_weights.json and used when results are collected
+    :return: FINAL_RESULTS_MMPBSA_{out_time}.dat file
+    '''
+    write_energy_csv(os.path.join(wdir, f'FINAL_RESULTS_MMPBSA_{out_time}.csv'), data)
+    summary = summarize_energies(data, weights=weights, **get_summary_settings(mmpbsa))
+    output = os.path.join(wdir, f'FINAL_RESULTS_MMPBSA_{out_time}.dat')
+    write_results(output, summary, title=title)
+    if weights is not None:
+        rows = next(iter(next(iter(data.values())).values()))['rows']
+        with open(get_weights_fname(output), 'w') as out:
+            json.dump({'frames': [int(row[0]) for row in rows], 'weights': weights}, out, indent=2)
+    return output
+
+
+def calc_representative_gbsa(wdir, tpr, xtc, topol, index, mmpbsa, np, protein_index, ligand_index, ligand_resid,
+                             rmsd_cutoff, out_time, bash_log):
+    '''
+    Cluster pocket and ligand conformations of frames set by the mmpbsa input file (see get_representative_frames),
+    calculate only representative frames and average energies with weights of their clusters.
+    Interaction entropy is not calculated, because it requires consecutive frames
+    :param rmsd_cutoff: Å
+    :return: FINAL_RESULTS_MMPBSA_{out_time}.dat file or None
+    '''
+    startframe, endframe, interval = get_mmpbsa_start_end_interval(mmpbsa)
+    number_of_frames = get_number_of_frames(xtc)
+    if not number_of_frames:
+        return None
+    frames = range(startframe - 1, min(endframe, number_of_frames), interval)
+    selection = get_representative_frames(wdir, tpr, xtc, ligand_resid, frames=frames, rmsd_cutoff=rmsd_cutoff)
+    if not selection:
+        return None
+    frames = selection['frames']
+    logging.info(f'{wdir}. {len(frames)} representative frames will be calculated')
+
+    wdir_run = os.path.join(wdir, f'gbsa_representative_{out_time}')
+    os.makedirs(wdir_run, exist_ok=True)
+    xtc_run = write_xtc_frames(xtc, frames, os.path.join(wdir_run, 'representative_frames.xtc'))
+    csv_output = calc_gbsa_frames(wdir, wdir_run, tpr=tpr, xtc=xtc_run, topol=topol, index=index, mmpbsa=mmpbsa,
+                                  np=min(np, len(frames)), protein_index=protein_index, ligand_index=ligand_index,
+                                  startframe=1, endframe=len(frames), interval=1, out_time=out_time, bash_log=bash_log,
+                                  log_name=f'gmx_MMPBSA_{out_time}.log')
+    if csv_output is None:
+        return None
+    # gmx_MMPBSA frame numbers are 1-based
+    try:
+        data = merge_energy_data([read_energy_csv(csv_output)], frames=[i + 1 for i in frames])
+    except ValueError as e:
+        logging.warning(f'{wdir}. Energies of some representative frames are missing: {e}')
+        return None
+    output = write_merged_results(wdir, data, mmpbsa=mmpbsa, out_time=out_time, weights=selection['weights'],
+                                  title=f'{len(frames)} representative frames of {len(selection["settings"]["frames"])} '
+                                        f'frames (RMSD cutoff {rmsd_cutoff} Å), energies are averaged with weights '
+                                        f'of clusters')
+    shutil.rmtree(wdir_run, ignore_errors=True)
+    return output
+
+
+def run_adaptive_gbsa(wdir, tpr, xtc, topol, index, mmpbsa, wdir_np, wdir_frames, ligand_resid,
+                      append_protein_selection, out_time, bash_log, clean_previous, target_sem, max_frames=None,
+                      use_cache=True):
+    '''
+    Evaluate frames of the trajectory by strided batches which are progressively refined (see get_adaptive_batches)
+    and stop when SEM of ΔTOTAL falls below target_sem or max_frames are used. Each batch is a separate gmx_MMPBSA run
+    in {wdir}/gbsa_adaptive_{out_time}/batch_N, per-frame energies of batches are merged
+    :param tpr, xtc, topol, index: file names relative to wdir or absolute paths
+    :param wdir_np: dict {wdir: number of MPI processes}
+    :param wdir_frames: dict {wdir: number of frames of the trajectory}
+    :param target_sem: kcal/mol
+    :param max_frames: None or max number of evaluated frames
+    :return: FINAL_RESULTS_MMPBSA_{out_time}.dat file or None
+    '''
+    files = [os.path.join(wdir, i) for i in [tpr, xtc, topol, index]]
+    if not all(os.path.isfile(i) for i in files):
+        logging.warning(f'{wdir} cannot run gbsa. Check if there are missing files: {" ".join(files)}')
+        return None
+    protein_index, ligand_index = get_gbsa_index_groups(wdir, files[3], ligand_resid, append_protein_selection)
+    if protein_index is None:
+        return None
+
+    cache = read_cache(wdir)
+    key = get_gbsa_cache_key(cache, *files, mmpbsa, protein_index, ligand_index,
+                             adaptive=[target_sem, max_frames, ADAPTIVE_INITIAL_FRAMES])
+    if use_cache:
+        output = get_cached_result(wdir, cache, key)
+        if output:
+            logging.info(f'{wdir}. Inputs were not changed, {output} will be used')
+            return output
+    if clean_previous:
+        clean_temporary_gmxMMBPSA_files(wdir)
+
+    startframe, endframe, interval = get_mmpbsa_start_end_interval(mmpbsa)
+    endframe = min(wdir_frames[wdir], endframe)
+    n_total = len(range(startframe, endframe + 1, interval))
+    data_list, used_frames, sem = [], 0, None
+    for n, (batch_start, batch_end, batch_interval) in enumerate(get_adaptive_batches(startframe, endframe, interval)):
+        frames = list(range(batch_start, batch_end + 1, batch_interval))
+        if max_frames:
+            if max_frames <= used_frames:
+                break
+            # the rest of the budget is spread evenly over the batch, which covers the whole trajectory
+            step = math.ceil(len(frames) / (max_frames - used_frames))
+            frames, batch_interval = frames[::step], batch_interval * step
+        csv_output = calc_gbsa_frames(wdir, os.path.join(wdir, f'gbsa_adaptive_{out_time}', f'batch_{n}'), tpr=tpr,
+                                      xtc=xtc, topol=topol, index=index, mmpbsa=mmpbsa,
+                                      np=min(wdir_np[wdir], len(frames)), protein_index=protein_index,
+                                      ligand_index=ligand_index, startframe=frames[0], endframe=frames[-1],
+                                      interval=batch_interval, out_time=out_time, bash_log=bash_log,
+                                      log_name=f'gmx_MMPBSA_{out_time}_batch_{n}.log')
+        if csv_output is None:
+            logging.warning(f'{wdir}. Batch {n} of adaptive frame sampling failed')
+            return None
+        try:
+            data_list.append(merge_energy_data([read_energy_csv(csv_output)], frames=frames))
+        except ValueError as e:
+            logging.warning(f'{wdir}. Energies of some frames of batch {n} are missing: {e}')
+            return None
+        used_frames += len(frames)
+        sem = get_total_sem(merge_energy_data(data_list))
+        logging.info(f'{wdir}. Adaptive frame sampling: {used_frames} of {n_total} frames, SEM of ΔTOTAL {sem}')
+        if sem is not None and sem < target_sem:
+            break
+
+    if not data_list:
+        return None
+    data = sort_energy_frames(merge_energy_data(data_list))
+    title = f'Adaptive frame sampling: {used_frames} of {n_total} frames were used'
+    if sem is not None:
+        title += f', SEM of ΔTOTAL {sem:.2f} kcal/mol'
+    output = write_merged_results(wdir, data, mmpbsa=mmpbsa, out_time=out_time, title=title)
+    shutil.rmtree(os.path.join(wdir, f'gbsa_adaptive_{out_time}'), ignore_errors=True)
+    save_result(wdir, cache, key, output)
+    return output
+
+
+def merge_gbsa_shards(wdir, shard_csv_files, mmpbsa, frames, out_time):
+    '''
+    Merge per-frame energies of shards to FINAL_RESULTS_MMPBSA_{out_time}.csv and recalculate averages, SD, SEM and
+    interaction entropy from all frames to FINAL_RESULTS_MMPBSA_{out_time}.dat
+    :param shard_csv_files: list of csv files in the order of frames
+    :param frames: list of frame numbers of the whole calculation
+    :return: FINAL_RESULTS_MMPBSA_{out_time}.dat file or None if energies of some frames are missing
+    '''
+    try:
+        data = merge_energy_data([read_energy_csv(i) for i in shard_csv_files], frames=frames)
+    except ValueError as e:
+        logging.warning(f'{wdir}. Results of frame shards cannot be merged: {e}')
+        return None
+    output = write_merged_results(wdir, data, mmpbsa=mmpbsa, out_time=out_time,
+                                  title=f'Merged per-frame energies of {len(shard_csv_files)} gmx_MMPBSA frame shards')
+    shutil.rmtree(os.path.join(wdir, f'gbsa_shards_{out_time}'), ignore_errors=True)
+    return output
+
+
+def run_sharded_gbsa(wdir_frames, tpr, xtc, topol, index, mmpbsa, ncpu, n_shards, ligand_resid,
+                     append_protein_selection, hostfile, out_time, bash_log, clean_previous, registry=None,
+                     use_cache=True):
+    '''
+    Split frames of each trajectory into shards, run each shard as a separate gmx_MMPBSA job anywhere in the dask
+    cluster and merge per-frame energies of shards, so a single trajectory can use several nodes.
+    Each shard uses NP equal to its number of frames (up to cores of a node) and shards are packed on free cores
+    :param wdir_frames: dict {wdir: number of frames of the trajectory}
+    :param tpr, xtc, topol, index: file names relative to wdir or absolute paths
+    :param n_shards: number of shards of each trajectory
+    :param use_cache: use results of previous calculations of trajectories with unchanged inputs
+    :return: list of merged FINAL_RESULTS_MMPBSA_*.dat files
+    '''
+    startframe, endframe, interval = get_mmpbsa_start_end_interval(mmpbsa)
+    max_np = get_max_np(hostfile, ncpu)
+    shards, outputs, wdir_caches = [], [], {}
+    for wdir, number_of_frames in wdir_frames.items():
+        files = [os.path.join(wdir, i) for i in [tpr, xtc, topol, index]]
+        if not all(os.path.isfile(i) for i in files):
+            logging.warning(f'{wdir} cannot run gbsa. Check if there are missing files: {" ".join(files)}')
+            continue
+        # index groups are created before shards are run to avoid simultaneous changes of the index file
+        protein_index, ligand_index = get_gbsa_index_groups(wdir, os.path.join(wdir, index), ligand_resid,
+                                                            append_protein_selection)
+        if protein_index is None:
+            continue
+        cache = read_cache(wdir)
+        key = get_gbsa_cache_key(cache, *files, mmpbsa, protein_index, ligand_index)
+        output = get_cached_result(wdir, cache, key) if use_cache else None
+        if output:
+            logging.info(f'{wdir}. Inputs were not changed, {output} will be used')
+            if registry:
+                set_stage(registry, wdir, 'gbsa', 'done')
+            outputs.append(output)
+            continue
+        wdir_caches[wdir] = (cache, key)
+        if clean_previous:
+            clean_temporary_gmxMMBPSA_files(wdir)
+        for n, (shard_start, shard_end) in enumerate(get_frame_shards(startframe, min(number_of_frames, endframe),
+                                                                      interval, n_shards)):
+            shards.append((wdir, n, shard_start, shard_end, protein_index, ligand_index,
+                           min(max_np, (shard_end - shard_start) // interval + 1)))
+    if not shards:
+        return outputs
+
+    wdirs = list(dict.fromkeys(i[0] for i in shards))
+    logging.info(f'{len(shards)} frame shards of {len(wdirs)} trajectories will be calculated, '
+                 f'{sum(i[6] for i in shards)} NP in total')
+    if registry:
+        for wdir in wdirs:
+            set_stage(registry, wdir, 'gbsa', 'running')
+
+    dask_client, cluster = None, None
+    shard_csv_files = {}
+    try:
+        dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=1, ncpu=ncpu, cores_resource=True)
+        # first fit decreasing: the largest jobs are placed first and smaller ones fill the remaining cores
+        for res in calc_dask(run_gbsa_shard, sorted(shards, key=lambda x: x[6], reverse=True), dask_client=dask_client,
+                             resources=lambda x: {CORES_RESOURCE: x[6]}, tpr=tpr, xtc=xtc, topol=topol,
+                             index=index, mmpbsa=mmpbsa, out_time=out_time, bash_log=bash_log):
+            if res:
+                shard_csv_files.setdefault(res[0], {})[res[1]] = res[2]
+    finally:
+        if dask_client:
+            dask_client.retire_workers(dask_client.scheduler_info()['workers'],
+                                       close_workers=True, remove=True)
+            dask_client.shutdown()
+        if cluster:
+            cluster.close()
+
+    for wdir in wdirs:
+        wdir_shards = [i for i in shards if i[0] == wdir]
+        output = None
+        if len(shard_csv_files.get(wdir, {})) == len(wdir_shards):
+            frames = list(range(wdir_shards[0][2], wdir_shards[-1][3] + 1, interval))
+            output = merge_gbsa_shards(wdir, [shard_csv_files[wdir][n] for n in range(len(wdir_shards))],
+                                       mmpbsa=mmpbsa, frames=frames, out_time=out_time)
+            if output:
+                save_result(wdir, *wdir_caches[wdir], output)
+        else:
+            logging.warning(f'{wdir}. Some of frame shards failed. Results cannot be merged')
+        if registry:
+            set_stage(registry, wdir, 'gbsa', 'done' if output else 'failed')
+        if output:
+            outputs.append(output)
+    return outputs
 
 
 def clean_temporary_gmxMMBPSA_files(wdir):
@@ -138,18 +599,6 @@ def parse_gmxMMPBSA_output(fname):
     return out_res
 
 
-def get_number_of_frames(xtc):
-    res = subprocess.run(f'gmx check -f {xtc}', shell=True, capture_output=True)
-    frames = re.findall('Step[ ]*([0-9]*)[ ]*[0-9]*\n', res.stderr.decode("utf-8"))
-    if frames:
-        logging.info(f'{xtc} has {frames} frames')
-        return int(frames[0])
-
-
-def run_get_frames_from_wdir(wdir, xtc):
-    return get_number_of_frames(os.path.join(wdir, xtc))
-
-
 def get_mmpbsa_start_end_interval(mmpbsa):
     with open(mmpbsa) as inp:
         mmpbsa_data = inp.read()
@@ -174,9 +623,80 @@ def get_mmpbsa_start_end_interval(mmpbsa):
     return startframe, endframe, interval
 
 
+def get_mmpbsa_option(mmpbsa, key, default=None):
+    '''
+    :return: string value of the option of the mmpbsa input file or default
+    '''
+    with open(mmpbsa) as inp:
+        for line in inp:
+            if line.startswith('#'):
+                continue
+            # quoted values can contain commas and slashes, e.g. forcefields="oldff/leaprc.ff99SB,leaprc.gaff"
+            value = re.findall(rf'\b{key}[ ]*=[ ]*(?:"([^"]*)"|\'([^\']*)\'|([^,\s/]+))', line)
+            if value:
+                return next(i for i in value[0] if i)
+    return default
+
+
+def get_summary_settings(mmpbsa):
+    '''
+    :param mmpbsa: mmpbsa input file or FINAL_RESULTS_MMPBSA.dat which contains the input file in its header
+    :return: dict of summarize_energies arguments with defaults of gmx_MMPBSA
+    '''
+    return {'temperature': float(get_mmpbsa_option(mmpbsa, 'temperature', 298.15)),
+            'interaction_entropy': int(get_mmpbsa_option(mmpbsa, 'interaction_entropy', 0)) == 1,
+            'ie_segment': float(get_mmpbsa_option(mmpbsa, 'ie_segment', 25))}
+
+
+def parse_gmxMMPBSA_csv(fname, mmpbsa=None):
+    '''
+    Parse per-frame energies of FINAL_RESULTS_MMPBSA.csv next to the FINAL_RESULTS_MMPBSA.dat file. Interaction entropy
+    and ΔG binding are recalculated from per-frame energies. Energies of weighted frames (e.g. representative frames)
+    are averaged with their weights without interaction entropy. If there is no csv file the dat file is parsed
+    :param fname: FINAL_RESULTS_MMPBSA.dat file
+    :param mmpbsa: mmpbsa input file. If None, options are read from the input file stored in the dat file
+    :return: list of per-frame records, dict {'GBSA': dict, 'PBSA': dict} of the parse_gmxMMPBSA_output format
+    '''
+    csv_file = f'{os.path.splitext(fname)[0]}.csv'
+    if not os.path.isfile(csv_file):
+        logging.warning(f'{csv_file} does not exist. Per-frame energies of {fname} will not be collected')
+        return [], parse_gmxMMPBSA_output(fname)
+    data = read_energy_csv(csv_file)
+    weights = read_frame_weights(fname, data)
+    summary = summarize_energies(data, weights=weights, **get_summary_settings(mmpbsa if mmpbsa else fname))
+    return get_frame_records(data, fname, weights=weights), get_summary_records(summary, fname)
+
+
+def write_frames_table(df, output):
+    '''
+    Save per-frame energies as a Parquet table, or as a tab-separated file if pyarrow is not available
+    :return: the created file
+    '''
+    try:
+        df.to_parquet(output, index=False)
+    except ImportError:
+        output = f'{os.path.splitext(output)[0]}.csv'
+        logging.warning(f'pyarrow is not installed. Per-frame energies will be saved to {output}')
+        df.to_csv(output, sep='\t', index=False)
+    return output
+
+
 def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_resid, append_protein_selection,
           hostfile, out_time, bash_log,
-          gmxmmpbsa_out_files=None, clean_previous=False):
+          gmxmmpbsa_out_files=None, clean_previous=False, registry=None, shards=1, use_cache=True,
+          adaptive_sem=None, max_frames=None, rmsd_cutoff=None):
+    '''
+    :param shards: int. Split frames of each trajectory into shards which are calculated by separate gmx_MMPBSA jobs
+                   anywhere in the cluster. Per-frame energies are merged and averages are recalculated
+    :param use_cache: systems with the same content of input files and the same index groups as in a previous run
+                      are not calculated again, their previous FINAL_RESULTS_MMPBSA files are used
+    :param adaptive_sem: None or kcal/mol. Evaluate frames by progressively refined strided batches until SEM of
+                         ΔTOTAL falls below this value (see run_adaptive_gbsa). Shards are not used in this mode
+    :param max_frames: None or max number of frames evaluated by adaptive frame sampling
+    :param rmsd_cutoff: None or Å. Calculate only representative frames of pocket and ligand conformations selected
+                        by RMSD clustering, energies are averaged with weights of clusters (see calc_representative_gbsa).
+                        Shards are not used in this mode
+    '''
     dask_client, cluster = None, None
     var_gbsa_out_files = []
     if gmxmmpbsa_out_files is None:
@@ -189,76 +709,125 @@ def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_re
 
         startframe, endframe, interval = get_mmpbsa_start_end_interval(mmpbsa)
         if wdir_to_run is not None:
-            try:
-                dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=ncpu, ncpu=ncpu)
-                var_number_of_frames = []
-                for res in calc_dask(run_get_frames_from_wdir, wdir_to_run, dask_client=dask_client, xtc=xtc):
-                    if res:
-                        var_number_of_frames.append(res)
-            finally:
-                if dask_client:
-                    dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                               close_workers=True, remove=True)
-                    dask_client.shutdown()
-                if cluster:
-                    cluster.close()
-
-            used_number_of_frames = math.ceil((min(min(var_number_of_frames), endframe) - (startframe - 1)) / interval)
-            n_tasks_per_node = ncpu // min(ncpu, used_number_of_frames)
-            #todo 64 2 mol 32 booked -> 34 use
-
-            logging.info(f'{min(ncpu, used_number_of_frames)} NP will be used')
-            # run energy calculation
-            try:
-                dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=n_tasks_per_node,
-                                                         ncpu=ncpu)
-                var_gbsa_out_files = []
-                for res in calc_dask(run_gbsa_from_wdir, wdir_to_run, dask_client=dask_client,
-                                     tpr=tpr, xtc=xtc, topol=topol, index=index,
-                                     mmpbsa=mmpbsa, np=min(ncpu, used_number_of_frames), ligand_resid=ligand_resid,
-                                     append_protein_selection=append_protein_selection,
-                                     out_time=out_time, bash_log=bash_log, clean_previous=clean_previous):
-                    if res:
-                        var_gbsa_out_files.append(res)
-            finally:
-                if dask_client:
-                    dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                               close_workers=True, remove=True)
-                    dask_client.shutdown()
-                if cluster:
-                    cluster.close()
+            # only frame headers are read, the index is cached beside trajectories and reused by other tools
+            var_number_of_frames = {}
+            for wdir in wdir_to_run:
+                number_of_frames = get_number_of_frames(os.path.join(wdir, xtc))
+                if number_of_frames:
+                    var_number_of_frames[wdir] = number_of_frames
+
+            if shards > 1 and not adaptive_sem and not rmsd_cutoff:
+                var_gbsa_out_files = run_sharded_gbsa(var_number_of_frames, tpr=tpr, xtc=xtc, topol=topol, index=index,
+                                                      mmpbsa=mmpbsa, ncpu=ncpu, n_shards=shards,
+                                                      ligand_resid=ligand_resid,
+                                                      append_protein_selection=append_protein_selection,
+                                                      hostfile=hostfile, out_time=out_time, bash_log=bash_log,
+                                                      clean_previous=clean_previous, registry=registry,
+                                                      use_cache=use_cache)
+            else:
+                # gmx_mmpbsa requires at least as many frames as processors, so each directory gets NP from
+                # its own number of frames and jobs are packed on free cores of nodes
+                max_np = get_max_np(hostfile, ncpu)
+                wdir_np = {}
+                for wdir in wdir_to_run:
+                    if wdir not in var_number_of_frames:
+                        logging.warning(f'{wdir}. The number of frames of the trajectory cannot be determined. '
+                                        f'The directory will be skipped')
+                        continue
+                    # unchanged systems are not dispatched, results of adaptive sampling and representative frames
+                    # are checked by their tasks
+                    output = find_cached_gbsa(wdir, tpr=tpr, xtc=xtc, topol=topol, index=index, mmpbsa=mmpbsa,
+                                              ligand_resid=ligand_resid,
+                                              append_protein_selection=append_protein_selection) \
+                        if use_cache and not adaptive_sem and not rmsd_cutoff else None
+                    if output:
+                        logging.info(f'{wdir}. Inputs were not changed, {output} will be used')
+                        if registry:
+                            set_stage(registry, wdir, 'gbsa', 'done')
+                        var_gbsa_out_files.append(output)
+                        continue
+                    wdir_np[wdir] = min(max_np, get_used_number_of_frames(var_number_of_frames[wdir], startframe,
+                                                                          endframe, interval))
+                    logging.info(f'{wdir}. {wdir_np[wdir]} NP will be used')
+                # run energy calculation
+                if wdir_np:
+                    try:
+                        dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=1, ncpu=ncpu,
+                                                                 cores_resource=True)
+                        if adaptive_sem:
+                            stage_task = partial(run_adaptive_gbsa, wdir_frames=var_number_of_frames,
+                                                 target_sem=adaptive_sem, max_frames=max_frames)
+                        else:
+                            stage_task = partial(run_gbsa_from_wdir, rmsd_cutoff=rmsd_cutoff)
+                        # first fit decreasing: the largest jobs are placed first and smaller ones fill the remaining cores
+                        for res in calc_dask(run_registered, sorted(wdir_np, key=wdir_np.get, reverse=True),
+                                             dask_client=dask_client, resources=lambda x: {CORES_RESOURCE: wdir_np[x]},
+                                             registry=registry, stage='gbsa', stage_task=stage_task,
+                                             tpr=tpr, xtc=xtc, topol=topol, index=index,
+                                             mmpbsa=mmpbsa, wdir_np=wdir_np, ligand_resid=ligand_resid,
+                                             append_protein_selection=append_protein_selection,
+                                             out_time=out_time, bash_log=bash_log, clean_previous=clean_previous,
+                                             use_cache=use_cache):
+                            if res:
+                                var_gbsa_out_files.append(res)
+                    finally:
+                        if dask_client:
+                            dask_client.retire_workers(dask_client.scheduler_info()['workers'],
+                                                       close_workers=True, remove=True)
+                            dask_client.shutdown()
+                        if cluster:
+                            cluster.close()
 
         elif tpr is not None and xtc is not None and topol is not None and index is not None:
             number_of_frames = get_number_of_frames(xtc)
-            used_number_of_frames = math.ceil((min(number_of_frames, endframe) - (startframe - 1)) / interval)
+            used_number_of_frames = get_used_number_of_frames(number_of_frames, startframe, endframe, interval)
             logging.info(f'{min(ncpu, used_number_of_frames)} NP will be used')
             if used_number_of_frames <= 0:
                 logging.error('Used number of frames are less or equal than 0. Run will be interrupted')
                 raise ValueError
-            run_gbsa_task(wdir=os.path.dirname(xtc), tpr=tpr, xtc=xtc, topol=topol, index=index, mmpbsa=mmpbsa,
-                          np=min(ncpu, used_number_of_frames), ligand_resid=ligand_resid, append_protein_selection=append_protein_selection,
-                          out_time=out_time, bash_log=bash_log, clean_previous=clean_previous)
+            if adaptive_sem:
+                wdir = os.path.dirname(xtc)
+                output = run_adaptive_gbsa(wdir, tpr=tpr, xtc=xtc, topol=topol, index=index, mmpbsa=mmpbsa,
+                                           wdir_np={wdir: min(ncpu, used_number_of_frames)},
+                                           wdir_frames={wdir: number_of_frames}, ligand_resid=ligand_resid,
+                                           append_protein_selection=append_protein_selection, out_time=out_time,
+                                           bash_log=bash_log, clean_previous=clean_previous, target_sem=adaptive_sem,
+                                           max_frames=max_frames, use_cache=use_cache)
+                var_gbsa_out_files = [output] if output else []
+            elif shards > 1 and not rmsd_cutoff:
+                var_gbsa_out_files = run_sharded_gbsa({os.path.dirname(xtc): number_of_frames}, tpr=tpr, xtc=xtc,
+                                                      topol=topol, index=index, mmpbsa=mmpbsa, ncpu=ncpu,
+                                                      n_shards=shards, ligand_resid=ligand_resid,
+                                                      append_protein_selection=append_protein_selection,
+                                                      hostfile=hostfile, out_time=out_time, bash_log=bash_log,
+                                                      clean_previous=clean_previous, use_cache=use_cache)
+            else:
+                output = run_gbsa_task(wdir=os.path.dirname(xtc), tpr=tpr, xtc=xtc, topol=topol, index=index,
+                                       mmpbsa=mmpbsa, np=min(ncpu, used_number_of_frames), ligand_resid=ligand_resid,
+                                       append_protein_selection=append_protein_selection, out_time=out_time,
+                                       bash_log=bash_log, clean_previous=clean_previous, use_cache=use_cache,
+                                       rmsd_cutoff=rmsd_cutoff)
+                var_gbsa_out_files = [output] if output else []
 
     else:
         var_gbsa_out_files = gmxmmpbsa_out_files
 
     # collect energies
     if var_gbsa_out_files:
-        GBSA_output_res, PBSA_output_res = [], []
-        try:
-            dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=len(var_gbsa_out_files),
-                                                     ncpu=ncpu)
-            for res in calc_dask(parse_gmxMMPBSA_output, var_gbsa_out_files, dask_client=dask_client):
-                if res:
-                    GBSA_output_res.append(res['GBSA'])
-                    PBSA_output_res.append(res['PBSA'])
-        finally:
-            if dask_client:
-                dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                           close_workers=True, remove=True)
-                dask_client.shutdown()
-            if cluster:
-                cluster.close()
+        import pandas as pd
+
+        GBSA_output_res, PBSA_output_res, frame_records = [], [], []
+        # parsing is light, so files are read by a thread pool of the main process
+        with ThreadPoolExecutor(max_workers=min(ncpu, len(var_gbsa_out_files))) as executor:
+            for records, res in executor.map(partial(parse_gmxMMPBSA_csv, mmpbsa=mmpbsa), var_gbsa_out_files):
+                frame_records.extend(records)
+                GBSA_output_res.append(res['GBSA'])
+                PBSA_output_res.append(res['PBSA'])
+
+        if frame_records:
+            frames_output = write_frames_table(pd.DataFrame(frame_records),
+                                               os.path.join(out_wdir, f'GMXMMPBSA_frames_{out_time}.parquet'))
+            logging.info(f'Per-frame energies of all systems were saved to {frames_output}')
 
         pd_gbsa = pd.DataFrame(GBSA_output_res).sort_values('Name')
         pd_pbsa = pd.DataFrame(PBSA_output_res).sort_values('Name')
@@ -298,7 +867,9 @@ def main():
                         help='text file with addresses of nodes of dask SSH cluster. The most typical, it can be '
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
                              'will be the address of the scheduler running on the standard port 8786. If omitted, '
-                             'calculations will run on a single machine as usual.')
+                             'calculations will run on a single machine as usual. Each line can set cores and memory of the node '
+                             'and its role: "node1 cores=128 memory=256GB" or "node0 role=scheduler" to run only the '
+                             'scheduler on the node. --ncpu is used for nodes without cores.')
     parser.add_argument('-c', '--ncpu', metavar='INTEGER', required=False, default=cpu_count(), type=int,
                         help='number of CPU per server. Use all cpus by default.')
     parser.add_argument('--ligand_id', metavar='UNL', default='UNL', help='Ligand residue ID')
@@ -307,6 +878,34 @@ def main():
                              'Example: ZN MG')
     parser.add_argument('--clean_previous', action='store_true', default=False,
                         help=' Clean previous temporary gmxMMPBSA files')
+    frame_selection = parser.add_mutually_exclusive_group()
+    frame_selection.add_argument('--adaptive_sem', metavar='KCAL/MOL', required=False, default=None, type=float,
+                                 help='adaptive frame sampling. Frames are evaluated by strided batches which are '
+                                      'progressively refined (16, 32, 64, ... frames evenly spread over the trajectory) '
+                                      'until SEM of ΔTOTAL falls below this value. The number of used frames is '
+                                      'reported in the log and FINAL_RESULTS_MMPBSA files. --shards is ignored in this '
+                                      'mode')
+    frame_selection.add_argument('--rmsd_cutoff', metavar='ANGSTROM', required=False, default=None, type=float,
+                                 help='calculate only representative frames. Conformations of the ligand and pocket '
+                                      'residues within 5 Å are clustered by RMSD with this cutoff, one frame of each '
+                                      'cluster is calculated and energies are averaged with weights of clusters. '
+                                      'Interaction entropy is not calculated in this mode. --shards is ignored. '
+                                      'Selected frames are saved to representative_frames.json')
+    parser.add_argument('--max_frames', metavar='INTEGER', required=False, default=None, type=int,
+                        help='max number of frames evaluated by adaptive frame sampling')
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='recalculate all systems. By default, systems with the same content of tpr, xtc, topology, '
+                             'index and mmpbsa input files and the same protein and ligand groups as in a previous run '
+                             'are not calculated again and their previous results are used (see gbsa_cache.json)')
+    parser.add_argument('--registry', metavar='FILENAME', required=False, default=None, type=filepath_type,
+                        help='SQLite registry of the run_md campaign (md_files/streamd_registry.sqlite). If --wdir_to_run '
+                             'is not set, all systems with finished md analysis will be used. Statuses and timings of '
+                             'gbsa calculations are recorded in the registry')
+    parser.add_argument('--shards', metavar='INTEGER', required=False, default=1, type=int,
+                        help='split frames of each trajectory into this number of shards. Each shard is calculated '
+                             'by a separate gmx_MMPBSA job anywhere in the cluster, so a single long trajectory can '
+                             'use several nodes. Per-frame energies of shards are merged to FINAL_RESULTS_MMPBSA_*.csv, '
+                             'averages, SD/SEM and interaction entropy are recalculated from all frames')
 
     args = parser.parse_args()
 
@@ -319,7 +918,11 @@ def main():
     log_file = os.path.join(wdir, f'log_mmpbsa_{out_time}.log')
     bash_log = os.path.join(wdir, f'log_mmpbsa_bash_{out_time}.log')
 
-    if args.wdir_to_run is not None:
+    wdir_to_run = args.wdir_to_run
+    if wdir_to_run is None and args.registry:
+        wdir_to_run = get_systems(args.registry, stage='analysis', status='done')
+
+    if wdir_to_run is not None:
         tpr = 'md_out.tpr'
         xtc = 'md_fit.xtc'
         topol = 'topol.top'
@@ -346,9 +949,11 @@ def main():
     logging.info(args)
     try:
         start(tpr=tpr, xtc=xtc, topol=topol,
-              index=index, out_wdir=wdir, wdir_to_run=args.wdir_to_run,
+              index=index, out_wdir=wdir, wdir_to_run=wdir_to_run,
               mmpbsa=args.mmpbsa, ncpu=args.ncpu, out_time=out_time,
               gmxmmpbsa_out_files=args.out_files, ligand_resid=args.ligand_id, append_protein_selection=args.append_protein_selection,
-              hostfile=args.hostfile, bash_log=bash_log, clean_previous=args.clean_previous)
+              hostfile=args.hostfile, bash_log=bash_log, clean_previous=args.clean_previous, registry=args.registry,
+              shards=args.shards, use_cache=not args.no_cache, adaptive_sem=args.adaptive_sem,
+              max_frames=args.max_frames, rmsd_cutoff=args.rmsd_cutoff)
     finally:
         logging.shutdown()
@@ -7,47 +7,181 @@ from functools import partial
 from glob import glob
 from multiprocessing import cpu_count
 
-from streamd.md_analysis import run_md_analysis
+from streamd.md_analysis import run_md_analysis, check_md_convergence, aggregate_replica_analysis
 from streamd.preparation.complex_preparation import run_complex_preparation
 from streamd.preparation.ligand_preparation import prepare_input_ligands, check_mols
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
-from streamd.utils.utils import filepath_type, run_check_subprocess, get_protein_resid_set
+from streamd.preparation.md_files_preparation import prepare_replicas
+from streamd.utils.dask_init import init_dask_cluster, calc_dask, get_worker_nthreads, get_workers_nthreads
+from streamd.utils.edr import write_equilibration_energies, check_equilibration, check_step, get_mdp_value
+from streamd.utils.planner import plan_simulations, order_by_plan
+from streamd.utils.mdrun_tuning import run_mdrun_benchmark, get_tuned_mdrun_args, load_tuning, save_tuning, \
+    select_representatives, layout_to_args, find_tuning_file, TUNING_FNAME
+from streamd.utils.monitor import run_monitored_subprocess, serve_status
+from streamd.utils.registry import get_registry_fname, register_systems, reset_systems, set_stage, get_systems, \
+    split_finished, run_registered
+from streamd.utils.scratch import run_in_scratch, is_staging_incomplete
+from streamd.utils.utils import filepath_type, run_check_subprocess, get_protein_resid_set, \
+    get_trajectory_segments, write_trajectory_segments
+
+MIN_EQ_SEGMENTS = 2  # minimal number of equilibration segments before convergence is accepted
 
 
 class RawTextArgumentDefaultsHelpFormatter(argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter):
     pass
 
 
-def run_equilibration(wdir, project_dir, bash_log):
-    if os.path.isfile(os.path.join(wdir, 'npt.gro')) and os.path.isfile(os.path.join(wdir, 'npt.cpt')):
-        logging.warning(f'{wdir}. Checkpoint files after Equilibration exist. '
-                        f'Equilibration step will be skipped ')
-        return wdir
-    cmd = f'wdir={wdir} bash {os.path.join(project_dir, "scripts/script_sh/equlibration.sh")}>> {os.path.join(wdir, bash_log)} 2>&1',
+def run_mdrun_subprocess(cmd, wdir, bash_log, log_patterns, monitor):
+    '''
+    :param log_patterns: glob patterns of mdrun log files which will be followed by the monitor
+    :param monitor: boolean. Write progress to mdrun_status.json and kill unstable or stalled simulations
+    :return: True or False
+    '''
+    if monitor:
+        return run_monitored_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log), wdir=wdir, log_patterns=log_patterns)
+    return run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log))
+
+
+def get_mdrun_args(wdir=None, mdrun_tuning=None):
+    '''
+    :param mdrun_tuning: None or json file with the best mdrun layouts for system sizes and number of cores
+    :return: mdrun arguments of the tuned layout or arguments which limit the number of threads
+             to the threads of the current dask worker
+    '''
+    nthreads = get_worker_nthreads()
+    if mdrun_tuning and wdir:
+        tuned_args = get_tuned_mdrun_args(wdir, ncores=nthreads or cpu_count(), tuning_fname=mdrun_tuning)
+        if tuned_args:
+            return tuned_args
+    return f'-nt {nthreads}' if nthreads else ''
+
+
+def run_mdrun_tuning(task, bash_log):
+    '''
+    :param task: tuple of wdir and the number of cores. Layouts are benchmarked and looked up (see get_mdrun_args)
+                 by the number of threads of the worker, so the task should run on a worker with this number of threads
+    '''
+    wdir, ncores = task
+    return run_mdrun_benchmark(wdir, ncores=ncores, bash_log=bash_log)
+
+
+def run_preflight(wdir, project_dir, bash_log):
+    '''
+    Run grompp for minimization and NVT inputs to find broken topologies before simulations are queued
+    :return: wdir or None
+    '''
+    cmd = f'wdir={wdir} bash {os.path.join(project_dir, "scripts/script_sh/preflight.sh")}>> {os.path.join(wdir, bash_log)} 2>&1'
     if not run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log)):
         return None
     return wdir
 
 
-def run_simulation(wdir, project_dir, bash_log):
+def run_minimization(wdir, project_dir, bash_log, monitor=False):
+    if os.path.isfile(os.path.join(wdir, 'em.gro')):
+        logging.warning(f'{wdir}. em.gro exists. Minimization step will be skipped ')
+        return wdir
+    cmd = f'wdir={wdir} mdrun_args="{get_mdrun_args()}" bash {os.path.join(project_dir, "scripts/script_sh/minimization.sh")}>> {os.path.join(wdir, bash_log)} 2>&1'
+    if not run_mdrun_subprocess(cmd, wdir, bash_log, log_patterns=['em.log'], monitor=monitor):
+        return None
+    write_equilibration_energies(wdir, steps=['em'])
+    return wdir
+
+
+def get_step_max_time(wdir, step):
+    '''
+    :return: length of the step in ps defined by nsteps and dt of {step}.mdp
+    '''
+    mdp_file = os.path.join(wdir, f'{step}.mdp')
+    return float(get_mdp_value(mdp_file, 'nsteps')[0]) * float(get_mdp_value(mdp_file, 'dt')[0])
+
+
+def run_segmented_equilibration(wdir, project_dir, bash_log, eq_segment_ps, monitor=False):
+    '''
+    Run NVT and NPT by segments of eq_segment_ps until energy terms converge (see check_step)
+    or the length of the step set in the mdp file is reached. Convergence is accepted after at least
+    MIN_EQ_SEGMENTS segments and only if all checks are assessable and passed.
+    The state is saved in equilibration_segments.txt: step, simulated time in ps and status (running, converged, max_time)
+    :return: wdir or None
+    '''
+    state_fname = os.path.join(wdir, 'equilibration_segments.txt')
+    state = {}
+    if os.path.isfile(state_fname):
+        with open(state_fname) as inp:
+            for line in inp:
+                if line.strip():
+                    step, time_ps, status = line.strip().split('\t')
+                    state[step] = (float(time_ps), status)
+
+    if not run_minimization(wdir, project_dir, bash_log, monitor=monitor):
+        return None
+
+    for step in ['nvt', 'npt']:
+        time_ps, status = state.get(step, (0.0, 'running'))
+        max_time_ps = get_step_max_time(wdir, step)
+        while status == 'running':
+            time_ps = round(min(time_ps + eq_segment_ps, max_time_ps), 6)
+            cmd = f'wdir={wdir} step={step} until_ps={time_ps} mdrun_args="{get_mdrun_args()}" ' \
+                  f'bash {os.path.join(project_dir, "scripts/script_sh/equilibration_segment.sh")}>> {os.path.join(wdir, bash_log)} 2>&1'
+            if not run_mdrun_subprocess(cmd, wdir, bash_log, log_patterns=[f'{step}.log'], monitor=monitor):
+                return None
+            _, checks = check_step(wdir, step)
+            if checks and all(checks.values()) and time_ps >= MIN_EQ_SEGMENTS * eq_segment_ps:
+                status = 'converged'
+            elif time_ps >= max_time_ps:
+                status = 'max_time'
+            state[step] = (time_ps, status)
+            with open(state_fname, 'w') as out:
+                out.write(''.join(f'{k}\t{v[0]}\t{v[1]}\n' for k, v in state.items()))
+        logging.info(f'{wdir}. {step.upper()} equilibration was finished after {time_ps} ps of {max_time_ps} ps ({status})')
+    return wdir
+
+
+def run_equilibration(wdir, project_dir, bash_log, monitor=False, eq_check=True, eq_segment_ps=None):
+    '''
+    :param eq_check: boolean. Check temperature, pressure and density of the equilibrated system,
+                     see check_equilibration. The system fails if checks are not passed
+    :param eq_segment_ps: None or float. Run NVT and NPT by segments of this length and stop each step after
+                          convergence. nvt.mdp and npt.mdp define the max length of steps
+    :return: wdir or None
+    '''
+    if eq_segment_ps:
+        if not run_segmented_equilibration(wdir, project_dir=project_dir, bash_log=bash_log,
+                                           eq_segment_ps=eq_segment_ps, monitor=monitor):
+            return None
+    else:
+        if os.path.isfile(os.path.join(wdir, 'npt.gro')) and os.path.isfile(os.path.join(wdir, 'npt.cpt')):
+            logging.warning(f'{wdir}. Checkpoint files after Equilibration exist. '
+                            f'Equilibration step will be skipped ')
+            return wdir
+        cmd = f'wdir={wdir} mdrun_args="{get_mdrun_args()}" bash {os.path.join(project_dir, "scripts/script_sh/equlibration.sh")}>> {os.path.join(wdir, bash_log)} 2>&1'
+        if not run_mdrun_subprocess(cmd, wdir, bash_log, log_patterns=['em.log', 'nvt.log', 'npt.log'], monitor=monitor):
+            return None
+    write_equilibration_energies(wdir)
+    if not check_equilibration(wdir) and eq_check:
+        return None
+    return wdir
+
+
+def run_simulation(wdir, project_dir, bash_log, monitor=False, mdrun_tuning=None):
     if os.path.isfile(os.path.join(wdir, 'md_out.tpr')) and os.path.isfile(os.path.join(wdir, 'md_out.cpt')) \
-            and os.path.isfile(os.path.join(wdir, 'md_out.xtc')):
+            and os.path.isfile(os.path.join(wdir, 'md_out.xtc')) and not is_staging_incomplete(wdir):
         logging.warning(f'{wdir}. md_out.xtc and md_out.tpr and  md_out.cpt exist. '
                         f'MD simulation step will be skipped. '
                         f'You can rerun the script and use --wdir_to_continue {wdir} --md_time time_in_ns to extend current trajectory.')
         return wdir
-    cmd = f'wdir={wdir} bash {os.path.join(project_dir, "scripts/script_sh/md.sh")}>> {os.path.join(wdir, bash_log)} 2>&1'
-    if not run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log)):
+    cmd = f'wdir={wdir} mdrun_args="{get_mdrun_args(wdir, mdrun_tuning)}" bash {os.path.join(project_dir, "scripts/script_sh/md.sh")}>> {os.path.join(wdir, bash_log)} 2>&1'
+    if not run_mdrun_subprocess(cmd, wdir, bash_log, log_patterns=['md_out.log'], monitor=monitor):
         return None
     return wdir
 
 
-def continue_md_from_dir(wdir_to_continue, tpr, cpt, xtc, deffnm_prev, deffnm_next, mdtime_ns, project_dir, bash_log):
-    def continue_md(tpr, cpt, xtc, wdir, new_mdtime_ps, deffnm_next, project_dir, bash_log):
+def continue_md_from_dir(wdir_to_continue, tpr, cpt, xtc, deffnm_prev, deffnm_next, mdtime_ns, project_dir, bash_log,
+                         extend_mode='trjcat', monitor=False, mdrun_tuning=None):
+    def continue_md(tpr, cpt, xtc, wdir, new_mdtime_ps, deffnm_next, project_dir, bash_log, extend_mode):
         cmd = f'wdir={wdir} tpr={tpr} cpt={cpt} xtc={xtc} new_mdtime_ps={new_mdtime_ps} ' \
-              f'deffnm_next={deffnm_next} bash {os.path.join(project_dir, "scripts/script_sh/continue_md.sh")}' \
+              f'deffnm_next={deffnm_next} extend_mode={extend_mode} mdrun_args="{get_mdrun_args(wdir, mdrun_tuning)}" ' \
+              f'bash {os.path.join(project_dir, "scripts/script_sh/continue_md.sh")}' \
               f'>> {os.path.join(wdir, bash_log)} 2>&1'
-        if not run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log)):
+        if not run_mdrun_subprocess(cmd, wdir, bash_log, log_patterns=[f'{deffnm_next}.part*.log'], monitor=monitor):
             return None
         return wdir
 
@@ -74,8 +208,65 @@ def continue_md_from_dir(wdir_to_continue, tpr, cpt, xtc, deffnm_prev, deffnm_ne
         shutil.move(f, new_f)
         logging.warning(f'Backup previous file {f} to {new_f}')
 
-    return continue_md(tpr=tpr, cpt=cpt, xtc=xtc, wdir=wdir_to_continue,
-                       new_mdtime_ps=new_mdtime_ps, deffnm_next=deffnm_next, project_dir=project_dir, bash_log=bash_log)
+    # the previous trajectory can be already composed of several segments
+    segments = get_trajectory_segments(xtc)
+
+    if not continue_md(tpr=tpr, cpt=cpt, xtc=xtc, wdir=wdir_to_continue,
+                       new_mdtime_ps=new_mdtime_ps, deffnm_next=deffnm_next, project_dir=project_dir,
+                       bash_log=bash_log, extend_mode=extend_mode):
+        return None
+
+    if extend_mode == 'segments':
+        write_trajectory_segments(os.path.join(wdir_to_continue, f'{deffnm_next}.xtc'),
+                                  segments + [os.path.join(wdir_to_continue, f'{deffnm_next}.xtc')])
+    return wdir_to_continue
+
+
+def run_adaptive_simulation(wdir, project_dir, bash_log, md_chunk_ns, mdtime_ns, ligand_resid,
+                            rmsd_tolerance, unbound_rmsd, energy_drift, monitor=False, mdrun_tuning=None):
+    '''
+    Run production MD by chunks of md_chunk_ns until the convergence criteria are met or mdtime_ns is reached.
+    The trajectory is extended in the segments mode and analysed after each chunk.
+    The current state is saved in adaptive_md.txt: deffnm, simulated time in ns and status
+    :return: wdir or None
+    '''
+    state_fname = os.path.join(wdir, 'adaptive_md.txt')
+    if os.path.isfile(state_fname):
+        with open(state_fname) as inp:
+            deffnm, simulated_ns, status = inp.read().strip().split('\t')
+        simulated_ns = float(simulated_ns)
+        logging.warning(f'{wdir}. Adaptive MD simulation will be resumed from {deffnm} ({simulated_ns} ns, {status})')
+    else:
+        if not run_simulation(wdir, project_dir=project_dir, bash_log=bash_log, monitor=monitor,
+                              mdrun_tuning=mdrun_tuning):
+            return None
+        deffnm, simulated_ns, status = 'md_out', md_chunk_ns, 'running'
+
+    while status == 'running':
+        if not run_md_analysis(wdir, deffnm=deffnm, mdtime_ns=simulated_ns, project_dir=project_dir,
+                               bash_log=bash_log, ligand_resid=ligand_resid):
+            return None
+        status = check_md_convergence(wdir, deffnm=deffnm, bash_log=bash_log, ligand_resid=ligand_resid,
+                                      rmsd_tolerance=rmsd_tolerance, unbound_rmsd=unbound_rmsd,
+                                      energy_drift=energy_drift) or 'running'
+        if status == 'running' and simulated_ns >= mdtime_ns:
+            status = 'max_time'
+
+        if status == 'running':
+            next_ns = round(min(simulated_ns + md_chunk_ns, mdtime_ns), 6)
+            deffnm_next = f'md_out_{next_ns}'
+            if not continue_md_from_dir(wdir, tpr=None, cpt=None, xtc=None, deffnm_prev=deffnm,
+                                        deffnm_next=deffnm_next, mdtime_ns=next_ns, project_dir=project_dir,
+                                        bash_log=bash_log, extend_mode='segments', monitor=monitor,
+                                        mdrun_tuning=mdrun_tuning):
+                return None
+            deffnm, simulated_ns = deffnm_next, next_ns
+
+        with open(state_fname, 'w') as out:
+            out.write(f'{deffnm}\t{simulated_ns}\t{status}\n')
+
+    logging.info(f'{wdir}. Adaptive MD simulation was finished after {simulated_ns} ns ({status}). Last part: {deffnm}')
+    return wdir
 
 
 def start(protein, wdir, lfile, system_lfile,
@@ -84,7 +275,11 @@ def start(protein, wdir, lfile, system_lfile,
           wdir_to_continue_list, deffnm_prev,
           tpr_prev, cpt_prev, xtc_prev, ligand_list_file_prev, ligand_resid,
           activate_gaussian, gaussian_exe, gaussian_basis, gaussian_memory,
-          seed, hostfile, ncpu, clean_previous, not_clean_log_files, bash_log=None):
+          seed, hostfile, ncpu, clean_previous, not_clean_log_files, extend_mode='trjcat',
+          md_chunk_ns=None, rmsd_tolerance=0.05, unbound_rmsd=1.0, energy_drift=0.001,
+          monitor=False, replicas=1, scratch_dir=None, registry=None, dry_run=False, skip_preflight=False,
+          hmr=False, box_type='cubic', tune_mdrun=False, skip_eq_check=False, eq_segment_ps=None,
+          bash_log=None):
     '''
     :param protein: protein file - pdb or gro format
     :param wdir: None or path
@@ -105,6 +300,27 @@ def start(protein, wdir, lfile, system_lfile,
     :param ligand_resid: UNL. Used for md analysis only if continue simulation
     :param ligand_list_file_prev: None or file
     :param deffnm_prev: md_out
+    :param extend_mode: trjcat or segments. trjcat concatenates the previous and the new trajectory into a single file,
+                        segments keeps the new part as a separate file and lists all parts in {deffnm}_segments.txt
+    :param md_chunk_ns: None or float. Run production MD by chunks until convergence or mdtime_ns is reached
+    :param rmsd_tolerance: nm. RMSD plateau criterion of the adaptive MD
+    :param unbound_rmsd: nm. RMSD of the ligand to stop the adaptive MD as the ligand left the binding pocket
+    :param energy_drift: max relative drift of the potential energy of the converged adaptive MD chunk
+    :param monitor: boolean. Follow mdrun logs, write mdrun_status.json and kill unstable or stalled simulations
+    :param replicas: int. Number of replicas of each system. Replicas share the minimized system
+                     and are run in replica_N subdirectories with different seeds
+    :param scratch_dir: None or path. Node-local directory to run minimization, equilibration, simulation and analysis.
+                        Results are copied back periodically and on completion
+    :param registry: None or SQLite file of the campaign registry. Statuses, timings and artifacts of systems are
+                     recorded there and finished stages are not submitted again.
+                     {wdir}/md_files/streamd_registry.sqlite is used for new simulations by default
+    :param dry_run: boolean. Stop after complex preparation and report predicted makespan and core-hours
+    :param skip_preflight: boolean. Do not check prepared systems by grompp before equilibration.
+                           Systems which failed the check are quarantined and excluded from the run
+    :param hmr: boolean. Repartition hydrogen masses of the protein and ligands and use 4 fs time step
+    :param box_type: cubic, dodecahedron or oriented (rectangular box along principal axes of the solute)
+    :param tune_mdrun: boolean. Benchmark mdrun layouts for a representative system of each size and use the best one
+                       for production MD. Layouts are cached in {wdir}/md_files/mdrun_tuning.json
     :param hostfile: None or file
     :param ncpu:
     not_clean_log_files: boolean. Remove backup md files (starts with #)
@@ -116,6 +332,7 @@ def start(protein, wdir, lfile, system_lfile,
     script_mdp_path = os.path.join(script_path, 'mdp')
 
     dask_client, cluster = None, None
+    mdrun_tuning = os.path.join(wdir, 'md_files', TUNING_FNAME) if tune_mdrun else None
 
     if wdir_to_continue_list is None and (tpr_prev is None or cpt_prev is None or xtc_prev is None):
         # create dirs
@@ -127,6 +344,8 @@ def start(protein, wdir, lfile, system_lfile,
         wdir_system_ligand = os.path.join(wdir, 'md_files', 'md_preparation', 'cofactors')
 
         wdir_md = os.path.join(wdir, 'md_files', 'md_run')
+        if registry is None:
+            registry = get_registry_fname(wdir)
 
         os.makedirs(wdir_md, exist_ok=True)
         os.makedirs(wdir_protein, exist_ok=True)
@@ -227,11 +446,35 @@ def start(protein, wdir, lfile, system_lfile,
                                  wdir_system_ligand_list=system_lig_wdirs,
                                  protein_name=pname, wdir_protein=wdir_protein,
                                  clean_previous=clean_previous, wdir_md=wdir_md,
-                                 script_path=script_mdp_path, project_dir=project_dir, mdtime_ns=mdtime_ns,
-                                 npt_time_ps=npt_time_ps, nvt_time_ps=nvt_time_ps, seed=seed, bash_log=bash_log):
+                                 script_path=script_mdp_path, project_dir=project_dir,
+                                 mdtime_ns=md_chunk_ns if md_chunk_ns else mdtime_ns,
+                                 npt_time_ps=npt_time_ps, nvt_time_ps=nvt_time_ps, seed=seed, bash_log=bash_log,
+                                 hmr=hmr, box_type=box_type):
                 if res:
                     var_complex_prepared_dirs.append(res)
             logging.info(f'Successfully finished {len(var_complex_prepared_dirs)} complex preparation\n')
+            if clean_previous:
+                reset_systems(registry, var_complex_prepared_dirs)
+            register_systems(registry, var_complex_prepared_dirs)
+            for wdir_system in var_complex_prepared_dirs:
+                set_stage(registry, wdir_system, 'preparation', 'done')
+
+            if not skip_preflight:
+                logging.info('Start Pre-flight check of prepared systems')
+                var_checked_dirs, var_to_run = split_finished(var_complex_prepared_dirs, registry, 'preflight')
+                for res in calc_dask(run_registered, var_to_run, dask_client, registry=registry, stage='preflight',
+                                     stage_task=run_preflight, project_dir=project_dir, bash_log=bash_log):
+                    if res:
+                        var_checked_dirs.append(res)
+                var_checked_dirs = set(var_checked_dirs)
+                var_quarantined_dirs = [i for i in var_complex_prepared_dirs if i not in var_checked_dirs]
+                for wdir_system in var_quarantined_dirs:
+                    set_stage(registry, wdir_system, 'preflight', 'quarantined')
+                if var_quarantined_dirs:
+                    logging.warning(f'{len(var_quarantined_dirs)} systems failed grompp check and will be skipped. '
+                                    f'Check their bash logs: {var_quarantined_dirs}')
+                var_complex_prepared_dirs = [i for i in var_complex_prepared_dirs if i in var_checked_dirs]
+                logging.info(f'Successfully finished {len(var_complex_prepared_dirs)} Pre-flight check\n')
         finally:
             if dask_client:
                 dask_client.retire_workers(dask_client.scheduler_info()['workers'],
@@ -246,19 +489,77 @@ def start(protein, wdir, lfile, system_lfile,
         # Part 3. Equilibration and MD simulation. Run on all cpu
         try:
             dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=1, ncpu=ncpu)
+            # the longest simulations are submitted first to reduce the makespan
+            planned_dirs = plan_simulations(var_complex_prepared_dirs,
+                                            simulation_ns=mdtime_ns + (nvt_time_ps + npt_time_ps) / 1000,
+                                            workers_nthreads=[nthreads for nthreads, addresses
+                                                              in get_workers_nthreads(dask_client).items()
+                                                              for _ in addresses],
+                                            history_wdirs=get_systems(registry, stage='simulation', status='done'),
+                                            replicas=replicas)
+            if dry_run:
+                logging.info('Dry run. Simulations were not started')
+                return None
+
+            if replicas > 1:
+                logging.info('Start Minimization step')
+                var_em_dirs, var_to_run = split_finished(var_complex_prepared_dirs, registry, 'minimization')
+                for res in calc_dask(run_registered, var_to_run, dask_client, registry=registry, stage='minimization',
+                                     stage_task=run_in_scratch, task=run_minimization,
+                                     scratch_dir=scratch_dir, project_dir=project_dir,
+                                     bash_log=bash_log, monitor=monitor):
+                    if res:
+                        var_em_dirs.append(res)
+                var_complex_prepared_dirs = [wdir_replica for wdir_em in order_by_plan(var_em_dirs, planned_dirs)
+                                             for wdir_replica in prepare_replicas(wdir_em, n_replicas=replicas, seed=seed)]
+                logging.info(f'{len(var_complex_prepared_dirs)} replicas of {len(var_em_dirs)} systems will be simulated\n')
             logging.info('Start Equilibration steps')
-            var_eq_dirs = []
-            for res in calc_dask(run_equilibration, var_complex_prepared_dirs, dask_client, project_dir=project_dir,
-                                 bash_log=bash_log):
+            var_eq_dirs, var_to_run = split_finished(order_by_plan(var_complex_prepared_dirs, planned_dirs),
+                                                     registry, 'equilibration')
+            for res in calc_dask(run_registered, var_to_run, dask_client, registry=registry, stage='equilibration',
+                                 stage_task=run_in_scratch, task=run_equilibration,
+                                 scratch_dir=scratch_dir, project_dir=project_dir,
+                                 bash_log=bash_log, monitor=monitor, eq_check=not skip_eq_check,
+                                 eq_segment_ps=eq_segment_ps):
                 if res:
                     var_eq_dirs.append(res)
             logging.info(f'Successfully finished {len(var_eq_dirs)} Equilibration step\n')
 
-            var_md_dirs = []
-            logging.info('Start Simulation step')
-            for res in calc_dask(run_simulation, var_eq_dirs, dask_client, project_dir=project_dir, bash_log=bash_log):
-                if res:
-                    var_md_dirs.append(res)
+            if tune_mdrun:
+                tuning = load_tuning(mdrun_tuning)
+                # representatives are benchmarked for each number of threads of workers of heterogeneous nodes
+                workers_nthreads = get_workers_nthreads(dask_client)
+                var_tuning_tasks = [(wdir_system, ncores) for ncores in workers_nthreads
+                                    for wdir_system in select_representatives(var_eq_dirs, ncores=ncores, tuning=tuning)]
+                logging.info(f'Start mdrun tuning on {len(var_tuning_tasks)} representative systems')
+                for res in calc_dask(run_mdrun_tuning, var_tuning_tasks, dask_client,
+                                     workers=lambda x: workers_nthreads[x[1]], bash_log=bash_log):
+                    if res:
+                        key, layout, _ = res
+                        tuning[key] = layout
+                        logging.info(f'mdrun layout for {key} (atoms_cores): {layout_to_args(layout)}')
+                save_tuning(mdrun_tuning, tuning)
+
+            var_md_dirs, var_to_run = split_finished(order_by_plan(var_eq_dirs, planned_dirs), registry, 'simulation')
+            if md_chunk_ns:
+                logging.info(f'Start Adaptive Simulation step. Chunk {md_chunk_ns} ns, max {mdtime_ns} ns')
+                for res in calc_dask(run_registered, var_to_run, dask_client, registry=registry, stage='simulation',
+                                     stage_task=run_in_scratch, task=run_adaptive_simulation,
+                                     scratch_dir=scratch_dir, project_dir=project_dir,
+                                     bash_log=bash_log, md_chunk_ns=md_chunk_ns, mdtime_ns=mdtime_ns,
+                                     ligand_resid=ligand_resid, rmsd_tolerance=rmsd_tolerance,
+                                     unbound_rmsd=unbound_rmsd, energy_drift=energy_drift, monitor=monitor,
+                                     mdrun_tuning=mdrun_tuning):
+                    if res:
+                        var_md_dirs.append(res)
+            else:
+                logging.info('Start Simulation step')
+                for res in calc_dask(run_registered, var_to_run, dask_client, registry=registry, stage='simulation',
+                                     stage_task=run_in_scratch, task=run_simulation, scratch_dir=scratch_dir,
+                                     project_dir=project_dir, bash_log=bash_log,
+                                     monitor=monitor, mdrun_tuning=mdrun_tuning):
+                    if res:
+                        var_md_dirs.append(res)
 
         finally:
             if dask_client:
@@ -280,11 +581,19 @@ def start(protein, wdir, lfile, system_lfile,
             #  continue simulations not created by tool
             if tpr_prev and cpt_prev and xtc_prev:
                 wdir_to_continue_list = [wdir]
-
-            for res in calc_dask(continue_md_from_dir, wdir_to_continue_list, dask_client,
+            # layouts tuned for the campaign are used without --tune_mdrun
+            if not (mdrun_tuning and os.path.isfile(mdrun_tuning)):
+                mdrun_tuning = next((i for i in map(find_tuning_file, wdir_to_continue_list) if i), None)
+            if mdrun_tuning:
+                logging.info(f'mdrun layouts from {mdrun_tuning} will be used')
+
+            for res in calc_dask(run_registered, wdir_to_continue_list, dask_client, registry=registry,
+                                 stage=f'extension_{mdtime_ns}', stage_task=run_in_scratch,
+                                 task=continue_md_from_dir, scratch_dir=scratch_dir,
                                  tpr=tpr_prev, cpt=cpt_prev, xtc=xtc_prev,
                                  deffnm_prev=deffnm_prev, deffnm_next=deffnm, mdtime_ns=mdtime_ns,
-                                 project_dir=project_dir, bash_log=bash_log):
+                                 project_dir=project_dir, bash_log=bash_log, extend_mode=extend_mode, monitor=monitor,
+                                 mdrun_tuning=mdrun_tuning):
                 if res:
                     var_md_dirs.append(res)
 
@@ -302,35 +611,46 @@ def start(protein, wdir, lfile, system_lfile,
         return None
 
     # Part 3. MD Analysis. Run on each cpu
-    try:
-        dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=min(ncpu, len(var_md_dirs)), ncpu=ncpu)
-        logging.info('Start Analysis of the simulations')
-        var_md_analysis_dirs = []
-        # os.path.dirname(var_lig)
-        for res in calc_dask(run_md_analysis, var_md_dirs,
-                             dask_client, deffnm=deffnm, mdtime_ns=mdtime_ns, project_dir=project_dir,
-                             bash_log=bash_log, ligand_resid=ligand_resid, ligand_list_file_prev=ligand_list_file_prev):
-            if res:
-                var_md_analysis_dirs.append(res)
-    finally:
-        if dask_client:
-            dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                       close_workers=True, remove=True)
-            dask_client.shutdown()
-        if cluster:
-            cluster.close()
+    if wdir_to_continue_list is None and md_chunk_ns:
+        # adaptive simulations were analysed after each chunk
+        var_md_analysis_dirs = var_md_dirs
+        for wdir_system in var_md_analysis_dirs:
+            set_stage(registry, wdir_system, 'analysis', 'done')
+    else:
+        try:
+            dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=min(ncpu, len(var_md_dirs)), ncpu=ncpu)
+            logging.info('Start Analysis of the simulations')
+            var_md_analysis_dirs = []
+            # os.path.dirname(var_lig)
+            for res in calc_dask(run_registered, var_md_dirs, dask_client, registry=registry, stage='analysis',
+                                 stage_task=run_in_scratch, task=run_md_analysis, scratch_dir=scratch_dir,
+                                 deffnm=deffnm, mdtime_ns=mdtime_ns, project_dir=project_dir,
+                                 bash_log=bash_log, ligand_resid=ligand_resid, ligand_list_file_prev=ligand_list_file_prev):
+                if res:
+                    var_md_analysis_dirs.append(res)
+        finally:
+            if dask_client:
+                dask_client.retire_workers(dask_client.scheduler_info()['workers'],
+                                           close_workers=True, remove=True)
+                dask_client.shutdown()
+            if cluster:
+                cluster.close()
 
     logging.info(
         f'Analysis of md simulation of {len(var_md_analysis_dirs)} were successfully finished\nFinished: {var_md_analysis_dirs}')
 
+    if wdir_to_continue_list is None and replicas > 1:
+        for wdir_system in sorted(set(os.path.dirname(i) for i in var_md_analysis_dirs)):
+            replica_dirs = sorted(i for i in var_md_analysis_dirs if os.path.dirname(i) == wdir_system)
+            if len(replica_dirs) > 1:
+                aggregate_replica_analysis(wdir_system, replica_dirs)
+                logging.info(f'{wdir_system}. Analysis of {len(replica_dirs)} replicas was aggregated')
+
     if not not_clean_log_files:
-        if wdir_to_continue_list is None:
-            for f in glob(os.path.join(wdir_md, '*', '#*#')):
+        # only directories of registered systems are scanned for backups
+        for wdir_system in (get_systems(registry) if wdir_to_continue_list is None else wdir_to_continue_list):
+            for f in glob(os.path.join(wdir_system, '#*#')):
                 os.remove(f)
-        else:
-            for wdir_md in wdir_to_continue_list:
-                for f in glob(os.path.join(wdir_md, '#*#')):
-                    os.remove(f)
 
 
 def main():
@@ -355,7 +675,9 @@ def main():
                         help='text file with addresses of nodes of dask SSH cluster. The most typical, it can be '
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
                              'will be the address of the scheduler running on the standard port 8786. If omitted, '
-                             'calculations will run on a single machine as usual.')
+                             'calculations will run on a single machine as usual. Each line can set cores and memory of the node '
+                             'and its role: "node1 cores=128 memory=256GB" or "node0 role=scheduler" to run only the '
+                             'scheduler on the node. --ncpu is used for nodes without cores.')
     parser1.add_argument('-c', '--ncpu', metavar='INTEGER', required=False, default=cpu_count(), type=int,
                         help='number of CPU per server. Use all cpus by default.')
     parser1.add_argument('--topol', metavar='topol.top', required=False, default=None, type=filepath_type,
@@ -378,8 +700,77 @@ def main():
                         help='time of NVT equilibration in ps')
     parser1.add_argument('--seed', metavar='int', required=False, default=-1, type=int,
                         help='seed')
+    parser1.add_argument('--hmr', action='store_true', default=False,
+                        help='hydrogen mass repartitioning. Masses of hydrogens of the protein, ligands and cofactors are '
+                             'multiplied by 3 (the added mass is taken from the bonded heavy atoms) and NVT, NPT and '
+                             'production MD are run with 4 fs time step (h-bonds constraints). Output intervals in ps '
+                             'are kept. Water and ions are not changed')
+    parser1.add_argument('--box_type', metavar='cubic', required=False, default='cubic',
+                        choices=['cubic', 'dodecahedron', 'oriented'],
+                        help='''box of new systems. The distance between the solute and the box is not less than the cut-offs.
+                                cubic - cubic box.
+                                dodecahedron - rhombic dodecahedron, ~29%% less water than the cubic box.
+                                oriented - principal axes of the solute are aligned with the box vectors and the smallest
+                                rectangular box is used. Use it for elongated solutes which do not rotate during the simulation.
+                                The number of saved atoms is reported for each system''')
+    parser1.add_argument('--tune_mdrun', action='store_true', default=False,
+                        help='run short mdrun benchmarks of thread-MPI/OpenMP layouts, PME ranks and nstlist for '
+                             'a representative equilibrated system of each size and use the fastest layout for production '
+                             'MD. Layouts are cached in WDIR/md_files/mdrun_tuning.json by the number of atoms and cores '
+                             'and are reused by next runs and by extension of simulations (--wdir_to_continue)')
+    parser1.add_argument('--md_chunk', metavar='ns', required=False, default=None, type=float,
+                        help='run production MD by chunks of the given time in ns. After each chunk the simulation is '
+                             'analysed and stopped if the ligand left the binding pocket or RMSD and potential energy '
+                             'converged. --md_time is used as the maximum time of the simulation')
+    parser1.add_argument('--rmsd_tolerance', metavar='nm', required=False, default=0.05, type=float,
+                        help='used with --md_chunk. Max difference of block averaged RMSD of the ligand (or the protein '
+                             'backbone) in the second half of the trajectory to consider it as converged')
+    parser1.add_argument('--unbound_rmsd', metavar='nm', required=False, default=1.0, type=float,
+                        help='used with --md_chunk. RMSD of the ligand to stop the simulation as the ligand left the binding pocket')
+    parser1.add_argument('--energy_drift', metavar='float', required=False, default=0.001, type=float,
+                        help='used with --md_chunk. Max relative drift of block averaged potential energy of the last chunk '
+                             'to consider the simulation as converged')
+    parser1.add_argument('--replicas', metavar='INTEGER', required=False, default=1, type=int,
+                        help='number of replicas of each system. The prepared and minimized system is shared by replicas, '
+                             'NVT, NPT and production MD of each replica are run in replica_N subdirectories with '
+                             'different seeds (seed + N if --seed is set). Mean and SD of the analysis over replicas are '
+                             'saved to *_replicas.xvg files of the system directory')
+    parser1.add_argument('--scratch_dir', metavar='DIRNAME', required=False, default=None, type=str,
+                        help='node-local directory (e.g. \'$TMPDIR\' in single quotes to expand it on each node) to run '
+                             'mdrun and md analysis of each system. Input files are copied to the scratch directory, '
+                             'outputs are copied back every 15 min and on completion. If a worker dies, the rerun of '
+                             'the same command continues from the last copied checkpoint')
+    parser1.add_argument('--monitor', action='store_true', default=False,
+                        help='follow mdrun log and energy files of running simulations and write step, ns/day, ETA '
+                             'and the last energies to mdrun_status.json in each simulation directory. Simulations with LINCS warnings storm, '
+                             'NaN energies or without progress are killed and marked as failed')
+    parser1.add_argument('--monitor_port', metavar='INTEGER', required=False, default=None, type=int,
+                        help='serve status of all simulations as JSON on http://localhost:PORT. Use together with --monitor')
     parser1.add_argument('--not_clean_log_files', action='store_true', default=False,
                         help='Not to remove all backups of md files')
+    parser1.add_argument('--registry', metavar='FILENAME', required=False, default=None,
+                        type=partial(filepath_type, check_exist=False),
+                        help='SQLite file of the campaign registry which keeps systems, statuses and timings of stages '
+                             'and artifact paths. Stages finished according to the registry are not run again. '
+                             'By default WDIR/md_files/streamd_registry.sqlite is used for new simulations. '
+                             'Set it to record continued simulations. Use run_status to get a report')
+    parser1.add_argument('--skip_preflight', action='store_true', default=False,
+                        help='do not check all prepared systems by grompp before equilibration. By default systems which '
+                             'failed the check are quarantined (see run_status) and are not simulated')
+    parser1.add_argument('--skip_eq_check', action='store_true', default=False,
+                        help='continue simulation of systems which failed equilibration checks. By default the NVT '
+                             'temperature should stay close to ref_t and the NPT density should reach a plateau '
+                             'without a drift, otherwise the equilibration stage is marked as failed. '
+                             'Results are saved to equilibration_check.json of each system')
+    parser1.add_argument('--eq_segment', metavar='ps', required=False, default=None, type=float,
+                        help='run NVT and NPT equilibration by segments of this length and stop each step once '
+                             'temperature (NVT), pressure and density (NPT) converge. --nvt_time and --npt_time are '
+                             'used as the max lengths. Actual lengths are saved to equilibration_segments.txt and '
+                             'equilibration_check.json of each system')
+    parser1.add_argument('--dry_run', action='store_true', default=False,
+                        help='prepare systems, estimate the cost of each simulation from the number of atoms, simulation '
+                             'time and performance of finished simulations of the registry, report the predicted '
+                             'makespan and core-hours and exit. Simulations are always submitted from the longest one')
     # continue md
     parser2 = parser.add_argument_group('Continue or Extend Molecular Dynamics Simulation')
     parser2.add_argument('--wdir_to_continue', metavar='DIRNAME', required=False, default=None, nargs='+',
@@ -398,6 +789,11 @@ def main():
                         help='cpt file from previous simulation')
     parser2.add_argument('--xtc', metavar='FILENAME', required=False, default=None, type=filepath_type,
                         help='xtc file from previous simulation')
+    parser2.add_argument('--extend_mode', metavar='trjcat', required=False, default='trjcat',
+                        choices=['trjcat', 'segments'],
+                        help='''trjcat - concatenate the previous and the new parts into a single deffnm.xtc file (rewrites the whole trajectory).
+                                segments - keep the new part as a separate xtc file. All parts are listed in deffnm_segments.txt
+                                and treated as a single trajectory by md analysis, run_gbsa and run_prolif. Only new data is written''')
     parser2.add_argument('--ligand_list_file', metavar='all_ligand_resid.txt', default=None, type=filepath_type,
                         help='''If you want automatic md analysis for ligands was run after continue of simulation you should set ligand_list file. 
                                  Format of the file (no headers): user_ligand_id\tgromacs_ligand_id. Example: my_ligand\tUNL.
@@ -443,6 +839,10 @@ def main():
     logging.getLogger('bockeh').setLevel('WARNING')
 
     logging.info(args)
+    status_server = None
+    if args.monitor_port:
+        status_server = serve_status(wdir if args.wdir_to_continue is None else os.path.commonpath(args.wdir_to_continue),
+                                     port=args.monitor_port)
     try:
         start(protein=args.protein,
               lfile=args.ligand, system_lfile=args.cofactor,
@@ -455,6 +855,14 @@ def main():
               gaussian_basis=args.gaussian_basis, gaussian_memory=args.gaussian_memory,
               hostfile=args.hostfile, ncpu=args.ncpu, wdir=wdir, seed=args.seed,
               clean_previous=args.clean_previous_md, not_clean_log_files=args.not_clean_log_files,
-              bash_log=bash_log)
+              extend_mode=args.extend_mode, md_chunk_ns=args.md_chunk, rmsd_tolerance=args.rmsd_tolerance,
+              unbound_rmsd=args.unbound_rmsd, energy_drift=args.energy_drift,
+              monitor=args.monitor, replicas=args.replicas, scratch_dir=args.scratch_dir,
+              registry=args.registry, dry_run=args.dry_run,
+              skip_preflight=args.skip_preflight, hmr=args.hmr,
+              box_type=args.box_type, tune_mdrun=args.tune_mdrun, skip_eq_check=args.skip_eq_check,
+              eq_segment_ps=args.eq_segment, bash_log=bash_log)
     finally:
+        if status_server:
+            status_server.shutdown()
         logging.shutdown()
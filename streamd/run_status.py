@@ -0,0 +1,82 @@
+import argparse
+import os
+import time
+from collections import defaultdict
+from functools import partial
+
+from streamd.utils.registry import get_registry_fname, get_stages
+from streamd.utils.utils import filepath_type
+
+STAGE_ORDER = ['preparation', 'minimization', 'equilibration', 'simulation', 'analysis', 'gbsa', 'prolif']
+
+
+def summarize_stages(stages):
+    '''
+    :param stages: list of tuples (wdir, stage, status, host, start_time, end_time)
+    :return: dict {stage: {status: count}}, dict {stage: list of durations of finished stages in seconds}
+    '''
+    counts = defaultdict(lambda: defaultdict(int))
+    durations = defaultdict(list)
+    for wdir, stage, status, host, start_time, end_time in stages:
+        counts[stage][status] += 1
+        if status == 'done' and start_time and end_time:
+            durations[stage].append(end_time - start_time)
+    return counts, durations
+
+
+def print_report(registry, verbose=False, status=None):
+    stages = get_stages(registry)
+    counts, durations = summarize_stages(stages)
+    statuses = sorted({i[2] for i in stages if i[2]})
+    stage_names = sorted(counts, key=lambda x: (STAGE_ORDER.index(x) if x in STAGE_ORDER else len(STAGE_ORDER), x))
+
+    print(f'Registry: {registry}\nSystems: {len({i[0] for i in stages})}\n')
+    print('\t'.join(['stage'] + statuses + ['mean_time_h', 'total_time_h']))
+    for stage in stage_names:
+        times = durations[stage]
+        print('\t'.join([stage] + [str(counts[stage][i]) for i in statuses] +
+                        [f'{sum(times) / len(times) / 3600:.2f}' if times else '-',
+                         f'{sum(times) / 3600:.2f}' if times else '-']))
+
+    if verbose or status:
+        print('\nwdir\tstage\tstatus\thost\tstarted\ttime_h')
+        for wdir, stage, stage_status, host, start_time, end_time in stages:
+            if status and stage_status != status:
+                continue
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)) if start_time else '-'
+            if start_time and end_time:
+                duration = f'{(end_time - start_time) / 3600:.2f}'
+            elif start_time and stage_status == 'running':
+                duration = f'{(time.time() - start_time) / 3600:.2f}+'
+            else:
+                duration = '-'
+            print(f'{wdir}\t{stage}\t{stage_status}\t{host or "-"}\t{started}\t{duration}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report statuses and timings of systems of the run_md campaign '
+                                                 'from its SQLite registry')
+    parser.add_argument('-d', '--wdir', metavar='WDIR', default=None,
+                        type=partial(filepath_type, exist_type='dir'),
+                        help='working directory of run_md. WDIR/md_files/streamd_registry.sqlite will be used. '
+                             'If not set the current directory will be used.')
+    parser.add_argument('--registry', metavar='FILENAME', required=False, default=None, type=filepath_type,
+                        help='registry file. Will be used over --wdir')
+    parser.add_argument('--status', metavar='STRING', required=False, default=None,
+                        help='list only stages with the given status, e.g. failed or running')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='list all stages of all systems')
+
+    args = parser.parse_args()
+
+    registry = args.registry
+    if registry is None:
+        registry = get_registry_fname(args.wdir if args.wdir else os.getcwd())
+        if not os.path.isfile(registry):
+            parser.error(f'Registry {registry} does not exist')
+
+    print_report(registry, verbose=args.verbose, status=args.status)
+
+
+if __name__ == '__main__':
+    main()
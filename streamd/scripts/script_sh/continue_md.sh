@@ -1,5 +1,5 @@
 #!/bin/bash
-#  args: wdir
+#  args: wdir tpr cpt xtc new_mdtime_ps deffnm_next extend_mode mdrun_args
 OMP_NUM_THREADS=2
 cd $wdir
 # MD
@@ -7,8 +7,15 @@ cd $wdir
 >&2 echo 'Run simulation:'
 
 gmx convert-tpr -s $tpr -until $new_mdtime_ps -o $deffnm_next\.tpr
-gmx mdrun -s $deffnm_next\.tpr -v -deffnm $deffnm_next -cpi $cpt -noappend || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+gmx mdrun -s $deffnm_next\.tpr -v -deffnm $deffnm_next -cpi $cpt -noappend $mdrun_args || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+if [ "$extend_mode" == "segments" ]; then
+# keep the new part as a separate segment of the trajectory instead of rewriting the whole history
+for f in $deffnm_next\.part*.*; do
+mv $f ${f/.part[0-9]*./.}
+done
+else
 gmx trjcat -f $xtc $deffnm_next\.part*.xtc -o $deffnm_next\.xtc -settime -tu fs << INPUT
 0
 c
-INPUT
\ No newline at end of file
+INPUT
+fi
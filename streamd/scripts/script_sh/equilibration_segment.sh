@@ -0,0 +1,20 @@
+#!/bin/bash
+#  args: wdir step until_ps mdrun_args
+OMP_NUM_THREADS=2
+cd $wdir
+>&2 echo "Script running:***************************** $step segment up to $until_ps ps *********************************"
+if [ ! -f $step\.tpr ]; then
+if [ "$step" == "nvt" ]; then
+gmx grompp -f nvt.mdp -c em.gro -r em.gro -p topol.top -n index.ndx -o nvt.tpr -maxwarn 1 || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+else
+gmx grompp -f npt.mdp -c nvt.gro -r nvt.gro -t nvt.cpt -p topol.top -n index.ndx -o npt.tpr  -maxwarn 1 || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+fi
+fi
+# the run is extended segment by segment, output files are appended from the checkpoint
+gmx convert-tpr -s $step\.tpr -until $until_ps -o $step\_segment.tpr || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+mv $step\_segment.tpr $step\.tpr
+if [ -f $step\.cpt ]; then
+gmx mdrun -deffnm $step -s $step\.tpr -cpi $step\.cpt $mdrun_args || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+else
+gmx mdrun -deffnm $step -s $step\.tpr $mdrun_args || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+fi
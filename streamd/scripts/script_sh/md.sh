@@ -1,9 +1,12 @@
 #!/bin/bash
-#  args: wdir
+#  args: wdir mdrun_args
 OMP_NUM_THREADS=2
 cd $wdir
 # MD
 echo 'Script running:***************************** MD simulation *********************************'
 echo 'Run simulation:'
+if [ ! -f md_out.cpt ]; then
 gmx grompp -f md.mdp -c npt.gro -t npt.cpt -p topol.top -n index.ndx -o md_out.tpr -maxwarn 1 || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
-gmx mdrun -deffnm md_out -s md_out.tpr || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
\ No newline at end of file
+fi
+# continue from the checkpoint if the previous run was interrupted
+gmx mdrun -deffnm md_out -s md_out.tpr -cpi md_out.cpt $mdrun_args || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
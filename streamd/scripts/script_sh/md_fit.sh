@@ -0,0 +1,13 @@
+#!/bin/bash
+#  args: wdir tpr xtc index_group noj_xtc center_xtc fit_xtc noj_reference
+cd $wdir
+
+echo 'Script running:***************************** Remove PBC and fit the trajectory *********************************'
+
+# the starting configuration of nojump is taken from noj_reference: tpr or the last frame of the previous segment
+gmx trjconv -s ${noj_reference:-$tpr} -f $xtc -pbc nojump -o $noj_xtc <<< "System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+#gmx trjconv -s $tpr -f $deffnm.xtc -o $deffnm\_noPBC.xtc -pbc mol -center <<< "Protein  System"
+# -ur compact keeps water around the solute in triclinic (dodecahedron) boxes
+gmx trjconv -s $tpr -f $noj_xtc -o $center_xtc -pbc mol -ur compact -center -n index.ndx  <<< "$index_group  System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+# use it for PBSA https://github.com/Valdes-Tresanco-MS/gmx_MMPBSA/issues/33
+gmx trjconv -s $tpr -f $center_xtc -fit rot+trans -o $fit_xtc -n index.ndx <<< "$index_group  System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
@@ -0,0 +1,10 @@
+#!/bin/bash
+#  args: wdir mdrun_args
+OMP_NUM_THREADS=2
+cd $wdir
+#Energy minimization
+if [ ! -f em.gro ]; then
+>&2 echo 'Script running:***************************** Energy minimization *********************************'
+gmx grompp -f minim.mdp -c solv_ions.gro -p topol.top -n index.ndx -o em.tpr -maxwarn 2
+gmx mdrun -v -deffnm em -s em.tpr $mdrun_args || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+fi
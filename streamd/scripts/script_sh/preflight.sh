@@ -0,0 +1,8 @@
+#!/bin/bash
+#  args: wdir
+cd $wdir
+# check topology, index groups and mdp files of the system before the expensive stages are queued
+>&2 echo 'Script running:***************************** Pre-flight grompp check *********************************'
+gmx grompp -f minim.mdp -c solv_ions.gro -p topol.top -n index.ndx -o preflight_em.tpr -po preflight_minim.mdp -maxwarn 2 || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && rm -f preflight_* && exit 1; }
+gmx grompp -f nvt.mdp -c solv_ions.gro -r solv_ions.gro -p topol.top -n index.ndx -o preflight_nvt.tpr -po preflight_nvt.mdp -maxwarn 1 || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && rm -f preflight_* && exit 1; }
+rm -f preflight_*
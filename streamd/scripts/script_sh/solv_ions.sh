@@ -1,11 +1,19 @@
 #!/bin/bash
-# wdir
+# wdir box_type box_padding
 #Solvate
 
 >&2 echo 'Script running:***************************** Solvation step *********************************'
 cd $wdir
-gmx editconf -f complex.gro -o newbox.gro -c -d 1.0 -bt cubic || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
-#gmx editconf -f complex.gro -o newbox.gro -bt dodecahedron -d 1.2 #Warning about bad box - wrong number of atoms (https://gromacs.org-gmx-users.maillist.sys.kth.narkive.com/q4NXMAoY/bad-box-error) Lena version
+box_type=${box_type:-cubic}
+box_padding=${box_padding:-1.0}
+if [ "$box_type" == "oriented" ]; then
+# align principal axes of the solute with the box vectors and use the smallest rectangular box
+echo 0 | gmx editconf -f complex.gro -o complex_princ.gro -princ || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+gmx editconf -f complex_princ.gro -o newbox.gro -c -d $box_padding -bt triclinic || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+else
+# the solute is centered (-c) to avoid bad box errors of triclinic boxes
+gmx editconf -f complex.gro -o newbox.gro -c -d $box_padding -bt $box_type || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+fi
 gmx solvate -cp newbox.gro -cs spc216.gro -p topol.top -o solv.gro || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
 
 #Add ions
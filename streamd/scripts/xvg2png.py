@@ -1,10 +1,11 @@
 import argparse
 import logging
-import matplotlib.pyplot as plt
-import pandas as pd
 
 
 def convertxvg2png(xvg_file, transform_nm_to_A=False):
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
     def check_if_value_found(value):
         if value:
             return value[0]
@@ -0,0 +1,57 @@
+import statistics
+
+
+def block_averages(values, n_blocks):
+    '''
+    :param values: list of float
+    :param n_blocks: number of consecutive blocks of the same size. The rest of values is added to the last block
+    :return: list of block mean values
+    '''
+    block_size = len(values) // n_blocks
+    if block_size == 0:
+        return [statistics.mean(values)] if values else []
+    blocks = [values[i * block_size:(i + 1) * block_size] for i in range(n_blocks - 1)]
+    blocks.append(values[(n_blocks - 1) * block_size:])
+    return [statistics.mean(i) for i in blocks]
+
+
+def linear_slope(x, y):
+    '''
+    :return: slope of the least squares line
+    '''
+    if len(x) < 2:
+        return 0.0
+    mean_x, mean_y = statistics.mean(x), statistics.mean(y)
+    var_x = sum((i - mean_x) ** 2 for i in x)
+    if var_x == 0:
+        return 0.0
+    return sum((i - mean_x) * (j - mean_y) for i, j in zip(x, y)) / var_x
+
+
+def is_plateau(values, tolerance, n_blocks=2):
+    '''
+    The second half of the values is split into blocks. Values reached a plateau if block averages differ less than tolerance
+    :param values: list of float
+    :param tolerance: float
+    :param n_blocks: number of blocks
+    :return: boolean
+    '''
+    last_half = values[len(values) // 2:]
+    if len(last_half) < n_blocks:
+        return False
+    averages = block_averages(last_half, n_blocks)
+    return max(averages) - min(averages) < tolerance
+
+
+def relative_drift(x, y, n_blocks=5):
+    '''
+    :return: change of block averaged values over the whole x range relative to their mean value
+    '''
+    if len(y) < n_blocks:
+        return None
+    averages = block_averages(y, n_blocks)
+    x_averages = block_averages(x, n_blocks)
+    mean_y = statistics.mean(y)
+    if mean_y == 0:
+        return None
+    return abs(linear_slope(x_averages, averages) * (x[-1] - x[0]) / mean_y)
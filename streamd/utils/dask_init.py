@@ -2,8 +2,8 @@ import logging
 import math
 import os
 
-from dask.distributed import Client, SSHCluster
-from rdkit import Chem
+CORES_RESOURCE = 'cores'
+
 
 def set_env(main_os_env):
     os.environ["PATH"] = f'{main_os_env["PATH"]}:{os.environ["PATH"]}'
@@ -13,45 +13,134 @@ def set_env(main_os_env):
     os.environ["CONDA_SHLVL"] = main_os_env["CONDA_SHLVL"]
 
 
-def init_dask_cluster(n_tasks_per_node, ncpu, hostfile=None):
+def parse_hostfile(hostfile, ncpu):
+    '''
+    Each line of the hostfile: host [cores=N] [memory=X] [role=scheduler|worker]
+    Plain lists of hosts (e.g. $PBS_NODEFILE) are supported. Hosts without cores use ncpu.
+    A host with role=scheduler runs only the scheduler, role=worker runs only workers.
+    If there is no scheduler host, the first host runs both the scheduler and workers
+    :return: scheduler host, list of dicts of worker hosts {'host', 'ncpu', 'memory'}
+    '''
+    from dask.utils import parse_bytes
+
+    scheduler, workers = None, []
+    with open(hostfile) as f:
+        for line in f:
+            items = line.split()
+            if not items:
+                continue
+            options = dict(i.split('=', 1) for i in items[1:])
+            unknown = set(options) - {'cores', 'memory', 'role'}
+            if unknown or options.get('role', 'worker') not in ('scheduler', 'worker'):
+                raise ValueError(f'Wrong line of the hostfile {hostfile}: {line.strip()}')
+            if options.get('role') == 'scheduler':
+                scheduler = items[0]
+                continue
+            workers.append({'host': items[0], 'ncpu': int(options.get('cores', ncpu)),
+                            'memory': parse_bytes(options['memory']) if 'memory' in options else None})
+    if scheduler is None:
+        scheduler = workers[0]['host']
+    return scheduler, workers
+
+
+def get_hosts_ncpu(hostfile, ncpu):
+    '''
+    :return: list of numbers of cores of worker nodes. [ncpu] if there is no hostfile
+    '''
+    if hostfile is None:
+        return [ncpu]
+    return [host['ncpu'] for host in parse_hostfile(hostfile, ncpu)[1]]
+
+
+def init_dask_cluster(n_tasks_per_node, ncpu, hostfile=None, cores_resource=False, worker_daemon=True):
     '''
 
-    :param n_tasks_per_node: number of task on a single server
+    :param n_tasks_per_node: number of task on a single server with ncpu cores. The number of tasks on servers with
+                             a different number of cores set in the hostfile is scaled proportionally
     :param ncpu: number of cpu on a single server
     :param hostfile:
+    :param cores_resource: boolean. A single worker is started on each node and declares the resource "cores" equal
+                           to all cores of the node, so tasks requiring different number of cores (up to cores of
+                           the node) can be packed on workers (see calc_dask). n_tasks_per_node is ignored
+    :param worker_daemon: boolean. Worker processes are daemonic by default and cannot start child processes.
+                          Set False for tasks which use multiprocessing. The global dask config is passed to
+                          workers of SSH clusters as well
     :return:
     '''
-    if hostfile:
-        with open(hostfile) as f:
-            hosts = [line.strip() for line in f if line.strip()]
-            n_servers = len(hosts)
-    else:
-        hosts = []
-        n_servers = 1
+    import dask
+    from dask.distributed import Client, SpecCluster
+    from distributed.deploy.ssh import Scheduler, Worker
+
+    dask.config.set({'distributed.worker.daemon': worker_daemon})
 
-    # n_workers = n_servers * n_tasks_per_node
-    n_workers = n_tasks_per_node
-    n_threads = math.ceil(ncpu / n_tasks_per_node)
     if hostfile is not None:
-        logging.warning(f'Dask init,{n_tasks_per_node}, {ncpu}, {n_threads}, {n_workers}, {hosts},{n_servers}')
-        cluster = SSHCluster(
-            [hosts[0]] + hosts,
-            connect_options={"known_hosts": None},
-            worker_options={"nthreads": n_threads, 'n_workers': n_workers},
-            scheduler_options={"port": 0, "dashboard_address": ":8786"},
-        )
+        scheduler_host, worker_hosts = parse_hostfile(hostfile, ncpu)
+        workers = {}
+        for i, host in enumerate(worker_hosts):
+            n_workers = 1 if cores_resource else max(1, round(n_tasks_per_node * host['ncpu'] / ncpu))
+            worker_options = {'nthreads': math.ceil(host['ncpu'] / n_workers), 'n_workers': n_workers}
+            if cores_resource:
+                worker_options['resources'] = {CORES_RESOURCE: worker_options['nthreads']}
+            if host['memory']:
+                worker_options['memory_limit'] = host['memory'] // n_workers
+            workers[i] = {'cls': Worker,
+                          'options': {'address': host['host'], 'connect_options': {'known_hosts': None},
+                                      'kwargs': worker_options, 'worker_class': 'distributed.Nanny',
+                                      'remote_python': None}}
+            logging.warning(f'Dask init, {host["host"]}: {n_workers} workers, {worker_options["nthreads"]} threads')
+        scheduler = {'cls': Scheduler,
+                     'options': {'address': scheduler_host, 'connect_options': {'known_hosts': None},
+                                 'kwargs': {'port': 0, 'dashboard_address': ':8786'}, 'remote_python': None}}
+        logging.warning(f'Dask init, scheduler: {scheduler_host}')
+        cluster = SpecCluster(workers, scheduler, name='SSHCluster')
         dask_client = Client(cluster)
 
     else:
+        n_workers = 1 if cores_resource else n_tasks_per_node
+        n_threads = math.ceil(ncpu / n_workers)
         cluster = None
-        dask_client = Client(n_workers=n_workers, threads_per_worker=n_threads)  # to run dask on a single server
+        resources = {CORES_RESOURCE: n_threads} if cores_resource else None
+        dask_client = Client(n_workers=n_workers, threads_per_worker=n_threads,
+                             resources=resources)  # to run dask on a single server
 
     dask_client.forward_logging(level=logging.INFO)
     dask_client.run(set_env, main_os_env=os.environ.copy())
     return dask_client, cluster
 
 
-def calc_dask(func, main_arg, dask_client, dask_report_fname=None, **kwargs):
+def get_worker_nthreads():
+    '''
+    :return: number of threads of the current dask worker or None outside of dask workers
+    '''
+    from dask.distributed import get_worker
+
+    try:
+        worker = get_worker()
+    except ValueError:
+        return None
+    return worker.state.nthreads if hasattr(worker, 'state') else worker.nthreads
+
+
+def get_workers_nthreads(dask_client):
+    '''
+    :return: dict {number of threads: list of addresses of workers with this number of threads}
+    '''
+    res = {}
+    for address, worker in dask_client.scheduler_info()['workers'].items():
+        res.setdefault(worker['nthreads'], []).append(address)
+    return res
+
+
+def calc_dask(func, main_arg, dask_client, dask_report_fname=None, resources=None, workers=None, **kwargs):
+    '''
+    :param resources: None or function returning resources required by the task of an argument, e.g. {'cores': 8}.
+                      Such tasks are submitted at once and dask runs each of them as soon as a worker has enough free
+                      resources. Otherwise, the number of submitted tasks is limited by the number of workers
+    :param workers: None or function returning addresses of workers allowed to run the task of an argument.
+                    Such tasks are submitted at once as well
+    '''
+    from rdkit import Chem
+
     main_arg = iter(main_arg)
     Chem.SetDefaultPickleProperties(Chem.PropertyPickleOptions.AllProps)
     if dask_client is not None:
@@ -64,9 +153,13 @@ def calc_dask(func, main_arg, dask_client, dask_report_fname=None, **kwargs):
             # logging.warning(f'dask {func}, {dask_client.scheduler_info()}, {nworkers}')
             futures = []
             for i, arg in enumerate(main_arg, 1):
-                futures.append(dask_client.submit(func, arg, **kwargs))
-                if i == nworkers:
-                    break
+                if resources is None and workers is None:
+                    futures.append(dask_client.submit(func, arg, **kwargs))
+                    if i == nworkers:
+                        break
+                else:
+                    futures.append(dask_client.submit(func, arg, resources=resources(arg) if resources else None,
+                                                      workers=workers(arg) if workers else None, **kwargs))
             seq = as_completed(futures, with_results=True)
             for i, (future, results) in enumerate(seq, 1):
                 yield results
@@ -0,0 +1,240 @@
+import json
+import logging
+import math
+import os
+import statistics
+from glob import glob
+
+from streamd.utils.convergence import block_averages, relative_drift
+
+EQ_CHECK_FNAME = 'equilibration_check.json'
+ENERGY_UNITS = {'Potential': 'kJ/mol', 'Kinetic En.': 'kJ/mol', 'Total Energy': 'kJ/mol',
+                'Temperature': 'K', 'Pressure': 'bar', 'Density': 'kg/m^3', 'Volume': 'nm^3'}
+# xvg files of equilibration steps, the same names as were created by gmx energy
+EQUILIBRATION_ENERGIES = {'em': {'potential.xvg': 'Potential'},
+                          'nvt': {'temperature.xvg': 'Temperature'},
+                          'npt': {'pressure.xvg': 'Pressure', 'density.xvg': 'Density'}}
+PRODUCTION_TERMS = ['Potential', 'Temperature', 'Pressure', 'Density']
+MIN_FRAMES = 10  # minimal number of energy frames to compare mean values with references
+MIN_BLOCK_FRAMES = 5  # minimal number of energy frames in a block to compare block averages and drifts
+# block averages of equilibrated systems differ by up to this number of their standard errors due to fluctuations
+BLOCK_NOISE_FACTOR = 4
+
+
+def get_edr_file(wdir, deffnm):
+    '''
+    :return: deffnm.edr or the last deffnm.partNNNN.edr of a simulation continued with -noappend or None
+    '''
+    edr_file = os.path.join(wdir, f'{deffnm}.edr')
+    if os.path.isfile(edr_file):
+        return edr_file
+    parts = sorted(glob(os.path.join(wdir, f'{deffnm}.part*.edr')))
+    return parts[-1] if parts else None
+
+
+def read_energy_terms(edr_file, terms):
+    '''
+    Read all requested terms from the energy file at once
+    :param terms: list of energy term names as in gmx energy, e.g. Potential, Temperature
+    :return: list of times in ps, dict {term: list of values}. Terms absent in the file are skipped
+    '''
+    import pyedr
+
+    energies, names, times = pyedr.read_edr(edr_file)
+    columns = {name: n for n, name in enumerate(names)}
+    missing = [i for i in terms if i not in columns]
+    if missing:
+        logging.warning(f'{edr_file}. Energy terms {missing} are absent')
+    values = {term: [float(frame[columns[term]]) for frame in energies] for term in terms if term in columns}
+    return [float(i) for i in times], values
+
+
+def write_energy_xvg(xvg_file, times, values, term):
+    '''
+    Write a single energy term in the format of gmx energy, so it can be processed by convertxvg2png and read_xvg
+    '''
+    with open(xvg_file, 'w') as out:
+        out.write('# This file was created by streamd from a GROMACS energy file\n'
+                  '@    title "GROMACS Energies"\n'
+                  '@    xaxis  label "Time (ps)"\n'
+                  f'@    yaxis  label "({ENERGY_UNITS.get(term, "")})"\n'
+                  '@TYPE xy\n'
+                  f'@ s0 legend "{term}"\n')
+        for t, v in zip(times, values):
+            out.write(f'{t:12.6f}  {v:12.6f}\n')
+
+
+def extract_energies(edr_file, xvg_terms):
+    '''
+    :param xvg_terms: dict {xvg file: energy term}
+    :return: list of times in ps, dict {term: list of values} or None if the energy file is missing
+    '''
+    if edr_file is None or not os.path.isfile(edr_file):
+        logging.warning(f'Energy file {edr_file} does not exist')
+        return None
+    times, energies = read_energy_terms(edr_file, list(xvg_terms.values()))
+    for xvg_file, term in xvg_terms.items():
+        if term in energies:
+            write_energy_xvg(xvg_file, times, energies[term], term)
+    return times, energies
+
+
+def write_equilibration_energies(wdir, steps=('em', 'nvt', 'npt')):
+    '''
+    Create potential.xvg, temperature.xvg, pressure.xvg and density.xvg of finished equilibration steps.
+    Existing xvg files are kept
+    :return: dict {step: (times, {term: values})} of processed steps
+    '''
+    res = {}
+    for step in steps:
+        xvg_terms = {os.path.join(wdir, xvg): term for xvg, term in EQUILIBRATION_ENERGIES[step].items()}
+        edr_file = os.path.join(wdir, f'{step}.edr')
+        if all(os.path.isfile(i) for i in xvg_terms) or not os.path.isfile(edr_file):
+            continue
+        res[step] = extract_energies(edr_file, xvg_terms)
+    return res
+
+
+def write_production_energies(wdir, deffnm):
+    '''
+    Create {term}_{deffnm}.xvg files of the production simulation, e.g. potential_md_out.xvg
+    :return: list of times in ps, dict {term: list of values} or None
+    '''
+    return extract_energies(get_edr_file(wdir, deffnm),
+                            {os.path.join(wdir, f'{i.lower()}_{deffnm}.xvg'): i for i in PRODUCTION_TERMS})
+
+
+def get_mdp_value(mdp_file, key):
+    '''
+    :return: list of string values of the mdp option or None. Dashes and underscores in names are equivalent
+    '''
+    key = key.replace('-', '_')
+    with open(mdp_file) as inp:
+        for line in inp:
+            line = line.split(';')[0]
+            if '=' in line and line.split('=')[0].strip().replace('-', '_') == key:
+                return line.split('=', 1)[1].split()
+    return None
+
+
+def summarize_term(times, values, n_blocks=5):
+    '''
+    Block averages are calculated over the second half of the values, the drift over all values
+    :return: dict with mean, standard deviation, block averages, number of values in a block,
+             standard error of a block average and relative drift
+    '''
+    last_half = values[len(values) // 2:]
+    std = statistics.pstdev(last_half) if last_half else None
+    block_frames = len(last_half) // n_blocks
+    return {'mean': statistics.mean(last_half) if last_half else None,
+            'std': std,
+            'block_averages': block_averages(last_half, n_blocks),
+            'block_frames': block_frames,
+            'block_sem': std / math.sqrt(block_frames) if block_frames else None,
+            'drift': relative_drift(times, values, n_blocks=n_blocks)}
+
+
+def get_mdp_reference(wdir, step, key):
+    '''
+    :return: the first value of ref_t or ref_p of {step}.mdp as float or None
+    '''
+    mdp_file = os.path.join(wdir, f'{step}.mdp')
+    value = get_mdp_value(mdp_file, key) if os.path.isfile(mdp_file) else None
+    return float(value[0]) if value else None
+
+
+def check_step(wdir, step, temperature_tolerance=5.0, block_temperature_tolerance=2.0, pressure_tolerance=150.0,
+               density_drift=0.02, block_density_tolerance=0.01):
+    '''
+    Check the current state of nvt or npt equilibration step.
+    NVT: the mean temperature is close to ref_t and block averages reached a plateau.
+    NPT: the mean pressure is close to ref_p and density reached a plateau without a drift.
+    Block tolerances are widened to BLOCK_NOISE_FACTOR standard errors of block averages, so fluctuations of
+    short steps are not taken for a missing plateau. A check is not assessable (None) if there are less than
+    MIN_FRAMES energy frames for mean values or MIN_BLOCK_FRAMES frames per block for plateaus and drifts
+    :param temperature_tolerance: K. Max deviation of the mean NVT temperature from ref_t
+    :param block_temperature_tolerance: K. Max difference of block averaged NVT temperature
+    :param pressure_tolerance: bar. Max deviation of the mean NPT pressure from ref_p
+    :param density_drift: max relative drift of NPT density over the whole step
+    :param block_density_tolerance: max difference of block averaged NPT density relative to its mean
+    :return: dict with simulated time and summaries of energy terms, dict {check: True, False or None}
+             or None, None if there are no data
+    '''
+    def assess(check, enough_frames):
+        return bool(check()) if enough_frames else None
+
+    def spread(term):
+        return max(term['block_averages']) - min(term['block_averages'])
+
+    edr_file = os.path.join(wdir, f'{step}.edr')
+    terms = ['Temperature'] if step == 'nvt' else ['Pressure', 'Density']
+    if not os.path.isfile(edr_file):
+        logging.warning(f'{wdir}. {edr_file} does not exist. Equilibration cannot be checked')
+        return None, None
+    times, energies = read_energy_terms(edr_file, terms)
+    if any(i not in energies for i in terms) or not times:
+        logging.warning(f'{wdir}. {edr_file} does not contain energy terms {terms}. Equilibration cannot be checked')
+        return None, None
+
+    res = {'time_ps': times[-1]}
+    res.update({i.lower(): summarize_term(times, energies[i]) for i in terms})
+    enough_frames = len(times) >= MIN_FRAMES
+    if step == 'nvt':
+        temperature = res['temperature']
+        temperature['reference'] = get_mdp_reference(wdir, step, 'ref_t')
+        enough_block_frames = temperature['block_frames'] >= MIN_BLOCK_FRAMES
+        checks = {
+            'temperature_reference': assess(lambda: temperature['reference'] is None or
+                                            abs(temperature['mean'] - temperature['reference']) < temperature_tolerance,
+                                            enough_frames),
+            'temperature_plateau': assess(lambda: spread(temperature) <
+                                          max(block_temperature_tolerance, BLOCK_NOISE_FACTOR * temperature['block_sem']),
+                                          enough_block_frames),
+        }
+    else:
+        pressure, density = res['pressure'], res['density']
+        pressure['reference'] = get_mdp_reference(wdir, step, 'ref_p')
+        enough_block_frames = density['block_frames'] >= MIN_BLOCK_FRAMES
+        checks = {
+            'pressure_reference': assess(lambda: pressure['reference'] is None or
+                                         abs(pressure['mean'] - pressure['reference']) < pressure_tolerance,
+                                         enough_frames),
+            'density_drift': assess(lambda: density['drift'] is not None and density['drift'] < density_drift,
+                                    enough_block_frames),
+            'density_plateau': assess(lambda: spread(density) / density['mean'] <
+                                      max(block_density_tolerance,
+                                          BLOCK_NOISE_FACTOR * density['block_sem'] / density['mean']),
+                                      enough_block_frames),
+        }
+    return res, checks
+
+
+def check_equilibration(wdir, **kwargs):
+    '''
+    Check the finished NVT and NPT steps (see check_step). Results and actual lengths of steps are saved to
+    equilibration_check.json
+    :param kwargs: tolerances of check_step
+    :return: True if all checks passed
+    '''
+    res = {}
+    for step in ['nvt', 'npt']:
+        summary, checks = check_step(wdir, step, **kwargs)
+        if summary is None:
+            return False
+        res[step] = dict(summary, checks=checks)
+    failed = [f'{step}:{k}' for step in ['nvt', 'npt'] for k, v in res[step]['checks'].items() if v is False]
+    not_assessable = [f'{step}:{k}' for step in ['nvt', 'npt'] for k, v in res[step]['checks'].items() if v is None]
+    res['passed'] = not failed
+
+    with open(os.path.join(wdir, EQ_CHECK_FNAME), 'w') as out:
+        json.dump(res, out, indent=2)
+    nvt, npt = res['nvt'], res['npt']
+    logging.info(f'{wdir}. Equilibration: NVT {nvt["time_ps"]:.0f} ps, temperature {nvt["temperature"]["mean"]:.2f} K; '
+                 f'NPT {npt["time_ps"]:.0f} ps, pressure {npt["pressure"]["mean"]:.1f} bar, '
+                 f'density {npt["density"]["mean"]:.2f} kg/m^3, relative density drift {npt["density"]["drift"]}')
+    if not_assessable:
+        logging.warning(f'{wdir}. Equilibration checks {not_assessable} cannot be assessed, because there are too few '
+                        f'energy frames. Increase the length of steps or decrease nstenergy')
+    if failed:
+        logging.warning(f'{wdir}. Equilibration checks failed: {failed}. See {os.path.join(wdir, EQ_CHECK_FNAME)}')
+    return res['passed']
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+
+from streamd.utils.utils import get_trajectory_segments
+from streamd.utils.xtc import get_number_of_frames, get_frame_location
+
+REPRESENTATIVE_FRAMES_FNAME = 'representative_frames.json'
+MAX_CLUSTERS = 1000  # coordinates of leaders are kept in memory, so their number is limited
+
+
+def get_pocket_selection(ligand_resid, pocket_cutoff):
+    '''
+    Heavy atoms of the ligand and protein residues within pocket_cutoff (Å) from it in the first frame
+    '''
+    return f'(resname {ligand_resid} or (protein and same residue as (around {pocket_cutoff} resname {ligand_resid}))) ' \
+           f'and not name H*'
+
+
+def cluster_frames(tpr, xtc, selection, frames, rmsd_cutoff, max_clusters=MAX_CLUSTERS):
+    '''
+    Leader clustering: a frame joins the closest leader within rmsd_cutoff or becomes a new leader.
+    The trajectory should be fitted, so RMSD is calculated without superposition. Only coordinates of leaders are
+    kept in memory. If there are max_clusters leaders already, frames join the closest leader
+    :param selection: MDAnalysis selection of atoms to compare. protein CA atoms are used if it is empty
+    :param frames: list of 0-based frame numbers to cluster
+    :param rmsd_cutoff: Å
+    :return: list of leader frames, list of cluster sizes
+    '''
+    import MDAnalysis as mda
+    import numpy as np
+
+    segments = get_trajectory_segments(xtc)
+    u = mda.Universe(tpr, segments if len(segments) > 1 else xtc)
+    atoms = u.select_atoms(selection)
+    if atoms.n_atoms == 0:
+        logging.warning(f'{xtc}. No atoms were selected by "{selection}". Protein CA atoms will be used')
+        atoms = u.select_atoms('protein and name CA')
+
+    leaders, sizes = [], []
+    coords = np.empty((max_clusters, atoms.n_atoms, 3), dtype=np.float32)
+    for ts in u.trajectory[frames]:
+        positions = atoms.positions
+        if leaders:
+            rmsd = np.sqrt(((coords[:len(leaders)] - positions) ** 2).sum(axis=2).mean(axis=1))
+            n = int(rmsd.argmin())
+            if rmsd[n] <= rmsd_cutoff or len(leaders) == max_clusters:
+                sizes[n] += 1
+                continue
+        coords[len(leaders)] = positions
+        leaders.append(ts.frame)
+        sizes.append(1)
+    return leaders, sizes
+
+
+def get_representative_frames(wdir, tpr, xtc, ligand_resid, frames=None, rmsd_cutoff=1.0, pocket_cutoff=5.0):
+    '''
+    Select representative frames of the pocket and ligand conformations by leader clustering. Weight of a frame is
+    the fraction of frames in its cluster. The selection is saved to representative_frames.json in wdir and is reused
+    while the trajectory and settings are the same
+    :param frames: None or list of 0-based frame numbers to select from. All frames are used by default
+    :param rmsd_cutoff: Å. Max RMSD of a frame from the representative frame of its cluster
+    :param pocket_cutoff: Å
+    :return: dict with lists of 0-based frames, times (ps) and weights of representative frames or None
+    '''
+    number_of_frames = get_number_of_frames(xtc)
+    if not number_of_frames:
+        return None
+    if frames is None:
+        frames = list(range(number_of_frames))
+    frames = sorted(i for i in frames if i < number_of_frames)
+    settings = {'xtc': [[i, os.path.getsize(i), os.path.getmtime(i)] for i in get_trajectory_segments(xtc)],
+                'ligand_resid': ligand_resid, 'frames': frames, 'rmsd_cutoff': rmsd_cutoff,
+                'pocket_cutoff': pocket_cutoff}
+
+    output = os.path.join(wdir, REPRESENTATIVE_FRAMES_FNAME)
+    if os.path.isfile(output):
+        with open(output) as inp:
+            res = json.load(inp)
+        if res['settings'] == settings:
+            return res
+
+    leaders, sizes = cluster_frames(tpr, xtc, get_pocket_selection(ligand_resid, pocket_cutoff), frames,
+                                    rmsd_cutoff=rmsd_cutoff)
+    res = {'settings': settings,
+           'frames': leaders,
+           'times': [get_frame_location(xtc, i)[3] for i in leaders],
+           'weights': [i / len(frames) for i in sizes]}
+    with open(output, 'w') as out:
+        json.dump(res, out, indent=2)
+    logging.info(f'{wdir}. {len(leaders)} representative frames of {len(frames)} were selected with RMSD cutoff '
+                 f'{rmsd_cutoff} Å')
+    return res
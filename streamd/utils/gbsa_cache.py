@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+GBSA_CACHE_FNAME = 'gbsa_cache.json'
+
+
+def read_cache(wdir):
+    cache_fname = os.path.join(wdir, GBSA_CACHE_FNAME)
+    if os.path.isfile(cache_fname):
+        try:
+            with open(cache_fname) as inp:
+                return json.load(inp)
+        except ValueError:
+            logging.warning(f'{cache_fname} is corrupted and will be recreated')
+    return {'files': {}, 'results': {}}
+
+
+def write_cache(wdir, cache):
+    with open(os.path.join(wdir, GBSA_CACHE_FNAME), 'w') as out:
+        json.dump(cache, out, indent=2)
+
+
+def get_file_hash(fname, file_hashes):
+    '''
+    sha256 of the file content. Hashes of large trajectories are reused while size and modification time of
+    the file are the same
+    :param file_hashes: dict {abs path: {'size', 'mtime', 'sha256'}} which is updated
+    '''
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    cached = file_hashes.get(fname)
+    if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+        return cached['sha256']
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as inp:
+        for chunk in iter(lambda: inp.read(1 << 20), b''):
+            sha.update(chunk)
+    file_hashes[fname] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha.hexdigest()}
+    return file_hashes[fname]['sha256']
+
+
+def get_topology_files(topol):
+    '''
+    :return: topol and itp files included into it which are placed next to it (force field files are not included)
+    '''
+    files = [topol]
+    with open(topol) as inp:
+        for line in inp:
+            include = re.findall(r'^\s*#include\s+"([^"]+)"', line)
+            if include and os.path.isfile(os.path.join(os.path.dirname(topol), include[0])):
+                files.append(os.path.join(os.path.dirname(topol), include[0]))
+    return files
+
+
+def get_gbsa_key(cache, files, selection):
+    '''
+    :param files: list of input files: tpr, xtc segments, topology files, index and mmpbsa input files
+    :param selection: list of values of protein and ligand group selection
+    :return: hash of contents of input files and selection
+    '''
+    sha = hashlib.sha256()
+    for fname in files:
+        sha.update(get_file_hash(fname, cache['files']).encode())
+    sha.update(json.dumps([str(i) for i in selection]).encode())
+    return sha.hexdigest()
+
+
+def get_cached_result(wdir, cache, key):
+    '''
+    :return: FINAL_RESULTS_MMPBSA.dat of the previous calculation with the same key or None.
+             The result is used only if its dat and csv files still exist
+    '''
+    output = cache['results'].get(key)
+    if output and os.path.isfile(os.path.join(wdir, output)) and \
+            os.path.isfile(os.path.join(wdir, f'{os.path.splitext(output)[0]}.csv')):
+        return os.path.join(wdir, output)
+    return None
+
+
+def save_result(wdir, cache, key, output):
+    cache['results'][key] = os.path.relpath(output, wdir)
+    write_cache(wdir, cache)
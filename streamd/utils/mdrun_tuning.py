@@ -0,0 +1,144 @@
+import json
+import logging
+import math
+import os
+import shutil
+
+from streamd.utils.planner import get_number_of_atoms, parse_mdrun_performance
+from streamd.utils.utils import run_check_subprocess
+
+TUNING_FNAME = 'mdrun_tuning.json'
+BENCHMARK_STEPS = 5000
+NSTLIST_CANDIDATES = (10, 20, 40)
+MAX_OMP_THREADS = 16
+
+
+def get_tuning_key(n_atoms, ncores):
+    '''
+    Systems are grouped to buckets which differ by the factor of sqrt(2) in the number of atoms
+    '''
+    return f'{2 ** (round(math.log2(n_atoms) * 2) / 2):.0f}_{ncores}'
+
+
+def get_layouts(ncores, nstlist=NSTLIST_CANDIDATES[0]):
+    '''
+    :return: list of candidate dicts of mdrun options: ntmpi, ntomp, npme, nstlist
+    '''
+    layouts = []
+    ntmpi = 1
+    while ntmpi <= ncores:
+        ntomp = ncores // ntmpi
+        if ncores % ntmpi == 0 and ntomp <= MAX_OMP_THREADS:
+            # separate PME ranks are useful only for several ranks
+            for npme in (sorted({-1, 0, ntmpi // 4}) if ntmpi >= 4 else [-1]):
+                layouts.append({'ntmpi': ntmpi, 'ntomp': ntomp, 'npme': npme, 'nstlist': nstlist})
+        ntmpi *= 2
+    if not layouts:
+        layouts = [{'ntmpi': 1, 'ntomp': ncores, 'npme': -1, 'nstlist': nstlist}]
+    return layouts
+
+
+def layout_to_args(layout):
+    return f'-ntmpi {layout["ntmpi"]} -ntomp {layout["ntomp"]} -npme {layout["npme"]} -nstlist {layout["nstlist"]}'
+
+
+def run_mdrun_benchmark(wdir, ncores, bash_log, nsteps=BENCHMARK_STEPS):
+    '''
+    Run short production mdrun of the equilibrated system for each candidate decomposition and then for nstlist
+    candidates of the fastest decomposition.
+    Performance is measured for the second half of steps to skip initial load balancing
+    :param wdir: directory with equilibrated system (npt.gro, npt.cpt)
+    :param ncores: number of cores to use
+    :return: tuning key, the best layout dict, list of tuples (layout, ns/day) or None
+    '''
+    wdir_tuning = os.path.join(wdir, 'mdrun_tuning')
+    os.makedirs(wdir_tuning, exist_ok=True)
+    log = os.path.join(wdir, bash_log)
+    try:
+        cmd = f'cd {wdir}; gmx grompp -f md.mdp -c npt.gro -t npt.cpt -p topol.top -n index.ndx ' \
+              f'-o {wdir_tuning}/bench.tpr -po {wdir_tuning}/bench.mdp -maxwarn 1 >> {log} 2>&1'
+        if not run_check_subprocess(cmd, wdir, log=log):
+            return None
+
+        results = []
+
+        def benchmark(layouts):
+            for layout in layouts:
+                n = len(results)
+                cmd = f'cd {wdir_tuning}; gmx mdrun -s bench.tpr -deffnm bench_{n} -nsteps {nsteps} ' \
+                      f'-resetstep {nsteps // 2} -noconfout {layout_to_args(layout)} >> {log} 2>&1'
+                # some layouts can be incompatible with the system, e.g. too small domains
+                ns_per_day = None
+                if run_check_subprocess(cmd, wdir, log=log):
+                    ns_per_day, _ = parse_mdrun_performance(os.path.join(wdir_tuning, f'bench_{n}.log'))
+                    logging.info(f'{wdir}. mdrun benchmark {layout_to_args(layout)}: {ns_per_day} ns/day')
+                results.append((layout, ns_per_day or 0))
+
+        benchmark(get_layouts(ncores))
+        best = max(results, key=lambda x: x[1])[0]
+        benchmark([dict(best, nstlist=i) for i in NSTLIST_CANDIDATES if i != best['nstlist']])
+    finally:
+        shutil.rmtree(wdir_tuning, ignore_errors=True)
+
+    best, ns_per_day = max(results, key=lambda x: x[1])
+    if not ns_per_day:
+        return None
+    return get_tuning_key(get_number_of_atoms(os.path.join(wdir, 'solv_ions.gro')), ncores), best, results
+
+
+def load_tuning(tuning_fname):
+    if tuning_fname is None or not os.path.isfile(tuning_fname):
+        return {}
+    with open(tuning_fname) as inp:
+        return json.load(inp)
+
+
+def save_tuning(tuning_fname, tuning):
+    tmp_fname = f'{tuning_fname}.tmp'
+    with open(tmp_fname, 'w') as out:
+        json.dump(tuning, out, indent=2)
+    os.replace(tmp_fname, tuning_fname)
+
+
+def select_representatives(wdirs, ncores, tuning):
+    '''
+    :param ncores: number of threads of workers which will run benchmarks and simulations
+    :return: list of wdirs, one for each atom count bucket which is missing in the tuning cache
+    '''
+    representatives = {}
+    for wdir in wdirs:
+        gro = os.path.join(wdir, 'solv_ions.gro')
+        if not os.path.isfile(gro):
+            continue
+        key = get_tuning_key(get_number_of_atoms(gro), ncores)
+        if key not in tuning and key not in representatives:
+            representatives[key] = wdir
+    return list(representatives.values())
+
+
+def find_tuning_file(wdir):
+    '''
+    Search the tuning cache of the campaign in wdir and its parent directories, e.g. md_files/mdrun_tuning.json
+    for a system directory md_files/md_run/protein_ligand
+    :return: file name or None
+    '''
+    path = os.path.abspath(wdir)
+    while True:
+        for fname in [os.path.join(path, TUNING_FNAME), os.path.join(path, 'md_files', TUNING_FNAME)]:
+            if os.path.isfile(fname):
+                return fname
+        if os.path.dirname(path) == path:
+            return None
+        path = os.path.dirname(path)
+
+
+def get_tuned_mdrun_args(wdir, ncores, tuning_fname):
+    '''
+    :return: mdrun arguments of the best layout for the system size and number of cores or None if not tuned
+    '''
+    tuning = load_tuning(tuning_fname)
+    gro = os.path.join(wdir, 'solv_ions.gro')
+    if not tuning or not os.path.isfile(gro):
+        return None
+    layout = tuning.get(get_tuning_key(get_number_of_atoms(gro), ncores))
+    return layout_to_args(layout) if layout else None
@@ -0,0 +1,246 @@
+import math
+import statistics
+
+BOLTZMANN_KCAL = 0.001985875  # kcal/(mol*K), the same constant as in gmx_MMPBSA
+METHOD_NAMES = {'GENERALIZED BORN': 'GB', 'POISSON BOLTZMANN': 'PB'}
+GGAS_COLUMNS = ['GGAS', 'G gas']
+TOTAL_COLUMNS = ['TOTAL']
+
+
+def iter_energy_csv(fname):
+    '''
+    Stream per-frame energies written by gmx_MMPBSA -eo line by line
+    :return: generator of (method, component, columns, row), where row is a list of float values
+    '''
+    method, component, columns = None, None, None
+    with open(fname) as inp:
+        for line in inp:
+            line = line.strip()
+            if not line:
+                continue
+            if line.endswith(':') and ',' not in line:
+                method = line[:-1].strip()
+                continue
+            if line.endswith('Energy Terms'):
+                component = line[:-len('Energy Terms')].strip()
+                continue
+            items = [i.strip() for i in line.split(',')]
+            if items[0].startswith('Frame'):
+                columns = items
+                continue
+            yield method, component, columns, [float(i) for i in items if i]
+
+
+def read_energy_csv(fname):
+    '''
+    Read per-frame energies written by gmx_MMPBSA -eo
+    :return: dict {method: {component: {'columns': list, 'rows': list of lists of float}}},
+             e.g. method GENERALIZED BORN and components Complex, Receptor, Ligand, Delta
+    '''
+    data = {}
+    for method, component, columns, row in iter_energy_csv(fname):
+        data.setdefault(method, {}).setdefault(component, {'columns': columns, 'rows': []})['rows'].append(row)
+    return data
+
+
+def write_energy_csv(fname, data):
+    with open(fname, 'w') as out:
+        for method, components in data.items():
+            if method:
+                out.write(f'{method}:\n')
+            for component, table in components.items():
+                out.write(f'{component} Energy Terms\n{",".join(table["columns"])}\n')
+                for row in table['rows']:
+                    out.write(','.join([str(int(row[0]))] + [f'{i:.2f}' for i in row[1:]]) + '\n')
+                out.write('\n')
+
+
+def merge_energy_data(data_list, frames=None):
+    '''
+    Concatenate per-frame energies of consecutive frame shards
+    :param data_list: list of read_energy_csv outputs in the order of frames
+    :param frames: None or list of frame numbers of the whole trajectory. Used to renumber frames of shards.
+                   ValueError is raised if the number of merged frames is different, e.g. a shard failed partly
+    :return: merged data in the read_energy_csv format
+    '''
+    merged = {}
+    for data in data_list:
+        for method, components in data.items():
+            for component, table in components.items():
+                merged_table = merged.setdefault(method, {}).setdefault(component, {'columns': table['columns'],
+                                                                                    'rows': []})
+                if merged_table['columns'] != table['columns']:
+                    raise ValueError(f'Energy terms of shards are different: {merged_table["columns"]} and '
+                                     f'{table["columns"]}')
+                merged_table['rows'].extend(table['rows'])
+    if frames is not None:
+        for components in merged.values():
+            for table in components.values():
+                if len(table['rows']) != len(frames):
+                    raise ValueError(f'{len(table["rows"])} frames of energies were merged, {len(frames)} frames '
+                                     f'are expected')
+                for row, frame in zip(table['rows'], frames):
+                    row[0] = frame
+    return merged
+
+
+def sort_energy_frames(data):
+    '''
+    Sort rows of all tables by frame numbers, e.g. after merging strided batches of frames
+    '''
+    for components in data.values():
+        for table in components.values():
+            table['rows'].sort(key=lambda x: x[0])
+    return data
+
+
+def get_total_sem(data):
+    '''
+    :return: SEM of ΔTOTAL of GB (or the first available method) or None if there are less than 2 frames
+    '''
+    for method in sorted(data, key=lambda x: x != 'GENERALIZED BORN'):
+        delta = data[method].get('Delta')
+        total = get_column(delta, TOTAL_COLUMNS) if delta else None
+        if total and len(total) > 1:
+            return mean_sd_sem(total)[2]
+    return None
+
+
+def get_column(table, names):
+    for name in names:
+        if name in table['columns']:
+            n = table['columns'].index(name)
+            return [row[n] for row in table['rows']]
+    return None
+
+
+def mean_sd_sem(values, weights=None):
+    '''
+    :param weights: None or weights of values, e.g. fractions of frames represented by each frame.
+                    SEM of weighted values is calculated with the effective number of values (sum w)^2 / sum w^2
+    '''
+    if weights is None:
+        sd = statistics.pstdev(values)
+        return statistics.mean(values), sd, sd / math.sqrt(len(values))
+    total = sum(weights)
+    mean = sum(w * v for v, w in zip(values, weights)) / total
+    sd = math.sqrt(sum(w * (v - mean) ** 2 for v, w in zip(values, weights)) / total)
+    n_eff = total ** 2 / sum(w ** 2 for w in weights)
+    return mean, sd, sd / math.sqrt(n_eff)
+
+
+def calc_interaction_entropy(ggas, temperature, segment):
+    '''
+    Interaction entropy as it is calculated by gmx_MMPBSA: the running value over frames
+    -TΔS(i) = kT ln <exp((ΔEint(j) - <ΔEint>(i)) / kT)>(j <= i) is averaged over the last segment % of frames
+    :param ggas: list of gas phase interaction energies of frames, kcal/mol
+    :param temperature: K
+    :param segment: percent of the last frames used to average the entropy
+    :return: dict with sigma of the interaction energy, average, SD and SEM of the entropy term
+    '''
+    kt = BOLTZMANN_KCAL * temperature
+    running, log_sum, energy_sum = [], None, 0.0
+    for i, energy in enumerate(ggas, 1):
+        energy_sum += energy
+        exponent = (energy - energy_sum / i) / kt
+        # log of the sum of exponents to avoid overflow
+        if log_sum is None:
+            log_sum = exponent
+        else:
+            log_sum = max(log_sum, exponent) + math.log1p(math.exp(-abs(log_sum - exponent)))
+        running.append(kt * (log_sum - math.log(i)))
+    ie = running[-math.ceil(len(running) * segment / 100):]
+    average, sd, sem = mean_sd_sem(ie)
+    return {'sigma': statistics.pstdev(ggas), 'average': average, 'sd': sd, 'sem': sem}
+
+
+def summarize_energies(data, temperature=298.15, interaction_entropy=False, ie_segment=25, weights=None):
+    '''
+    :param data: per-frame energies in the read_energy_csv format
+    :param weights: None or weights of frames (in the order of rows). Interaction entropy is not calculated for
+                    weighted frames, because it requires consecutive frames of the trajectory
+    :return: dict {method: {'frames': int, 'delta': {term: (average, SD, SEM)}, 'ie': dict or None,
+                            'dg': (ΔG binding, SD) or None}}
+    '''
+    res = {}
+    for method, components in data.items():
+        delta = components.get('Delta')
+        if not delta or not delta['rows']:
+            continue
+        summary = {'frames': len(delta['rows']), 'ie': None, 'dg': None,
+                   'delta': {name: mean_sd_sem([row[n] for row in delta['rows']], weights)
+                             for n, name in enumerate(delta['columns']) if n > 0}}
+        ggas, total = get_column(delta, GGAS_COLUMNS), get_column(delta, TOTAL_COLUMNS)
+        if interaction_entropy and ggas and total and weights is None:
+            ie = calc_interaction_entropy(ggas, temperature, ie_segment)
+            total_average, total_sd, _ = mean_sd_sem(total)
+            summary['ie'] = ie
+            summary['dg'] = (total_average + ie['average'], math.sqrt(total_sd ** 2 + ie['sd'] ** 2))
+        res[method] = summary
+    return res
+
+
+def write_results(fname, summary, title=''):
+    '''
+    Write the summary in the layout of FINAL_RESULTS_MMPBSA.dat which can be read by parse_gmxMMPBSA_output
+    '''
+    with open(fname, 'w') as out:
+        if title:
+            out.write(f'| {title}\n\n')
+        for method, res in summary.items():
+            name = METHOD_NAMES.get(method, method)
+            if res['ie']:
+                ie = res['ie']
+                out.write('Energy Method  Entropy  σ(Int. Energy)  Average  SD  SEM\n' + '-' * 60 + '\n'
+                          f'{name}  IE  {ie["sigma"]:.2f}  {ie["average"]:.2f}  {ie["sd"]:.2f}  {ie["sem"]:.2f}\n\n')
+        for method, res in summary.items():
+            out.write(f'{method}:\n\nDelta (Complex - Receptor - Ligand), {res["frames"]} frames:\n'
+                      f'{"Energy Component":<20}{"Average":>12}{"SD":>12}{"SEM":>12}\n' + '-' * 56 + '\n')
+            for term, (average, sd, sem) in res['delta'].items():
+                out.write(f'{"Δ" + term:<20}{average:>12.2f}{sd:>12.2f}{sem:>12.2f}\n')
+            if res['dg']:
+                out.write(f'\nUsing Interaction Entropy Approximation:\n'
+                          f'ΔG binding = {res["dg"][0]:8.2f} +/- {res["dg"][1]:6.2f}\n')
+            out.write('\n')
+
+
+def get_frame_records(data, name, weights=None):
+    '''
+    :param data: per-frame energies in the read_energy_csv format
+    :param name: name of the system stored in each record
+    :param weights: None or weights of frames in the order of rows, stored as the Weight column
+    :return: list of dicts {'Name', 'Method', 'Component', 'Frame', ['Weight'], term: value} for a columnar table
+    '''
+    records = []
+    for method, components in data.items():
+        for component, table in components.items():
+            for n, row in enumerate(table['rows']):
+                record = {'Name': name, 'Method': METHOD_NAMES.get(method, method), 'Component': component,
+                          'Frame': int(row[0])}
+                if weights is not None:
+                    record['Weight'] = weights[n]
+                record.update(zip(table['columns'][1:], row[1:]))
+                records.append(record)
+    return records
+
+
+def get_summary_records(summary, name):
+    '''
+    :param summary: summarize_energies output
+    :return: dict {'GBSA': dict, 'PBSA': dict} with interaction entropy and ΔG binding of the system, the same
+             columns as were parsed from FINAL_RESULTS_MMPBSA.dat, and the average ΔTOTAL with its SD
+    '''
+    res = {'GBSA': {'Name': name}, 'PBSA': {'Name': name}}
+    for method, key in [('GENERALIZED BORN', 'GBSA'), ('POISSON BOLTZMANN', 'PBSA')]:
+        if method not in summary:
+            continue
+        total = [summary[method]['delta'][i] for i in TOTAL_COLUMNS if i in summary[method]['delta']]
+        if total:
+            res[key].update({'ΔTOTAL': round(total[0][0], 2), 'ΔTOTAL SD': round(total[0][1], 2)})
+        if not summary[method]['ie']:
+            continue
+        ie, dg = summary[method]['ie'], summary[method]['dg']
+        res[key].update({'IEσ(Int. Energy)': round(ie['sigma'], 2), 'IEAverage': round(ie['average'], 2),
+                         'IESD': round(ie['sd'], 2), 'IESEM': round(ie['sem'], 2),
+                         'ΔGbinding': round(dg[0], 2), 'ΔGbinding+/-': round(dg[1], 2)})
+    return res
@@ -0,0 +1,223 @@
+import json
+import logging
+import math
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from streamd.utils.scratch import get_source_dir
+
+STATUS_FNAME = 'mdrun_status.json'
+POLL_INTERVAL = 30  # seconds
+STALL_TIMEOUT = 3600  # seconds without a new step in the log
+MAX_LINCS_WARNINGS = 50
+STATUS_ENERGY_TERMS = ['Potential', 'Temperature', 'Pressure']
+
+
+def parse_mdrun_log(log_fname, state):
+    '''
+    Read new lines of the mdrun log file starting from state['offset'] and update the state
+    :param log_fname: md.log like file
+    :param state: dict. Keys: offset, step, time_ps, init_step, nsteps, dt, lincs_warnings, nan_energies
+    :return: updated state
+    '''
+    with open(log_fname, errors='replace') as inp:
+        inp.seek(state['offset'])
+        data = inp.read()
+        state['offset'] = inp.tell()
+
+    for key, pattern in [('nsteps', r'\n\s*nsteps\s*=\s*(-?[0-9]+)'), ('init_step', r'\n\s*init-step\s*=\s*([0-9]+)'),
+                         ('dt', r'\n\s*dt\s*=\s*([0-9.eE+-]+)')]:
+        value = re.findall(pattern, data)
+        if value:
+            state[key] = float(value[0]) if key == 'dt' else int(value[0])
+
+    steps = re.findall(r'Step\s+Time\s*\n\s*([0-9]+)\s+([0-9.eE+-]+)', data)
+    if steps:
+        state['step'] = int(steps[-1][0])
+        state['time_ps'] = float(steps[-1][1])
+
+    state['lincs_warnings'] += len(re.findall('LINCS WARNING', data))
+    for block in re.findall(r'Energies \(kJ/mol\)\n(.*?)\n\n', data, re.S):
+        if re.search(r'(?<![a-zA-Z])(nan|inf)(?![a-zA-Z])', block, re.I):
+            state['nan_energies'] = True
+    return state
+
+
+def parse_mdrun_edr(edr_fname, state):
+    '''
+    Read the energy file if it was changed since the last call and update the state with the last values of
+    STATUS_ENERGY_TERMS. Non-finite values of any energy term in new frames set state['nan_energies']
+    :param edr_fname: energy file written by mdrun along with the log file
+    :param state: dict. Keys: edr_mtime, edr_frames, energies, nan_energies
+    :return: updated state
+    '''
+    import pyedr
+
+    if not os.path.isfile(edr_fname) or os.path.getmtime(edr_fname) == state['edr_mtime']:
+        return state
+    mtime = os.path.getmtime(edr_fname)
+    try:
+        energies, names, times = pyedr.read_edr(edr_fname, verbose=False)
+    except Exception as e:
+        # the last frame can be incomplete while mdrun writes it, the file will be read on the next poll
+        logging.debug(f'{edr_fname} cannot be read: {e}')
+        return state
+    state['edr_mtime'] = mtime
+    new_frames = energies[state['edr_frames']:]
+    state['edr_frames'] = len(energies)
+    if any(not math.isfinite(float(value)) for frame in new_frames for value in frame):
+        state['nan_energies'] = True
+    if len(energies):
+        state['energies'] = {name: round(float(energies[-1][n]), 3) for n, name in enumerate(names)
+                             if name in STATUS_ENERGY_TERMS}
+    return state
+
+
+def write_status(wdir, status):
+    '''
+    Write the status file to wdir and, if wdir is a scratch copy of a simulation directory, to the original directory,
+    so the status of simulations run on node-local disks can be collected from the shared file system
+    '''
+    for dirname in dict.fromkeys([wdir, get_source_dir(wdir)]):
+        if dirname is None:
+            continue
+        tmp_fname = os.path.join(dirname, f'.{STATUS_FNAME}')
+        try:
+            with open(tmp_fname, 'w') as out:
+                json.dump(status, out, indent=2)
+            os.replace(tmp_fname, os.path.join(dirname, STATUS_FNAME))
+        except OSError as e:
+            logging.warning(f'Status file cannot be written to {dirname}: {e}')
+
+
+def run_monitored_subprocess(cmd, key, log, wdir, log_patterns, poll_interval=POLL_INTERVAL,
+                             stall_timeout=STALL_TIMEOUT, max_lincs_warnings=MAX_LINCS_WARNINGS):
+    '''
+    Run mdrun script and follow the newest log file matching log_patterns and the energy file of the same name.
+    Progress (step, ns/day, ETA, the last energies) is written to mdrun_status.json in wdir. The job is killed and marked as failed in case of LINCS warnings storm,
+    NaN energies or if there is no progress during stall_timeout seconds
+    :param cmd: shell command
+    :param key: used in logging
+    :param log: bash log file
+    :param wdir: directory of the simulation
+    :param log_patterns: list of glob patterns of mdrun log files relative to wdir
+    :return: True or False
+    '''
+    proc = subprocess.Popen(cmd, shell=True, start_new_session=True)
+    status = {'wdir': get_source_dir(wdir) or wdir, 'state': 'running', 'stage': None, 'step': None,
+              'time_ps': None, 'ns_per_day': None, 'eta_h': None, 'energies': None, 'reason': None}
+    states = {}
+    last_progress = time.time()
+    failure = None
+
+    while True:
+        try:
+            proc.wait(timeout=poll_interval)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+
+        logs = [i for pattern in log_patterns for i in glob(os.path.join(wdir, pattern))]
+        if not logs:
+            continue
+        log_fname = max(logs, key=os.path.getmtime)
+        if log_fname not in states:
+            states[log_fname] = {'offset': 0, 'step': None, 'time_ps': None, 'init_step': 0, 'nsteps': None,
+                                 'dt': None, 'lincs_warnings': 0, 'nan_energies': False,
+                                 'wall_time': time.time(), 'edr_mtime': None, 'edr_frames': 0, 'energies': None}
+            last_progress = time.time()
+        state = states[log_fname]
+        prev_time_ps, prev_wall_time = state['time_ps'], state['wall_time']
+        parse_mdrun_log(log_fname, state)
+        parse_mdrun_edr(f'{os.path.splitext(log_fname)[0]}.edr', state)
+
+        now = time.time()
+        status['stage'] = os.path.basename(log_fname)
+        status['step'], status['time_ps'] = state['step'], state['time_ps']
+        status['energies'] = state['energies']
+        if state['time_ps'] is not None and prev_time_ps is not None and state['time_ps'] > prev_time_ps:
+            last_progress = now
+            status['ns_per_day'] = round((state['time_ps'] - prev_time_ps) / 1000 / (now - prev_wall_time) * 86400, 3)
+            state['wall_time'] = now
+            if state['nsteps'] and state['nsteps'] > 0 and state['dt']:
+                left_ns = (state['init_step'] + state['nsteps'] - state['step']) * state['dt'] / 1000
+                status['eta_h'] = round(left_ns / status['ns_per_day'] * 24, 2)
+        elif state['time_ps'] is not None and prev_time_ps is None:
+            state['wall_time'] = now
+
+        if state['nan_energies']:
+            failure = f'NaN energies in {log_fname}'
+        elif state['lincs_warnings'] > max_lincs_warnings:
+            failure = f'{state["lincs_warnings"]} LINCS warnings in {log_fname}'
+        elif now - last_progress > stall_timeout:
+            failure = f'no progress in {log_fname} during {stall_timeout} s'
+
+        if failure:
+            logging.error(f'{key}. Watchdog: {failure}. The job will be killed. Check log {log}')
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+                proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+            except ProcessLookupError:
+                pass
+            status.update({'state': 'failed', 'reason': failure, 'eta_h': None})
+            write_status(wdir, status)
+            return False
+
+        write_status(wdir, status)
+
+    if proc.returncode != 0:
+        status.update({'state': 'failed', 'reason': f'exit code {proc.returncode}', 'eta_h': None})
+        write_status(wdir, status)
+        logging.error(f'{key}. Check log {log}\nError: Command {cmd} returned non-zero exit status {proc.returncode}')
+        return False
+
+    status.update({'state': 'finished', 'eta_h': 0})
+    write_status(wdir, status)
+    return True
+
+
+def collect_status(wdir):
+    '''
+    :param wdir: directory to search for mdrun_status.json files recursively
+    :return: list of status dicts
+    '''
+    res = []
+    for fname in sorted(glob(os.path.join(wdir, '**', STATUS_FNAME), recursive=True)):
+        try:
+            with open(fname) as inp:
+                res.append(json.load(inp))
+        except (OSError, ValueError):
+            continue
+    return res
+
+
+def serve_status(wdir, port):
+    '''
+    Serve collected mdrun_status.json files of all simulations in wdir as JSON on http://localhost:port
+    :return: server. Use server.shutdown() to stop it
+    '''
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = json.dumps(collect_status(wdir), indent=2).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'Status of simulations is available at http://localhost:{port}')
+    return server
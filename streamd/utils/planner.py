@@ -0,0 +1,137 @@
+import heapq
+import logging
+import os
+import re
+import statistics
+from collections import Counter
+
+# atoms * ns/day per core of a typical solvated complex, used if there are no finished simulations to learn from
+DEFAULT_PERFORMANCE = 150000
+MAX_HISTORY = 200  # number of the latest finished simulations to learn the performance from
+
+
+def get_number_of_atoms(gro):
+    with open(gro) as inp:
+        inp.readline()
+        return int(inp.readline().strip())
+
+
+def parse_mdrun_performance(log_fname):
+    '''
+    :param log_fname: md.log like file of a finished simulation
+    :return: ns/day and the number of used cores or None, None
+    '''
+    with open(log_fname, errors='replace') as inp:
+        data = inp.read()
+    performance = re.findall(r'\nPerformance:\s+([0-9.]+)', data)
+    if not performance:
+        return None, None
+    mpi_threads = re.findall(r'Using ([0-9]+) MPI (?:thread|process)', data)
+    omp_threads = re.findall(r'Using ([0-9]+) OpenMP thread', data)
+    ncores = (int(mpi_threads[0]) if mpi_threads else 1) * (int(omp_threads[0]) if omp_threads else 1)
+    return float(performance[-1]), ncores
+
+
+def get_performance_history(wdirs):
+    '''
+    Collect the performance of finished production simulations
+    :param wdirs: directories of finished simulations, e.g. systems of the registry
+    :return: list of atoms * ns/day per core values
+    '''
+    history = []
+    for wdir in wdirs:
+        log_fname, gro = os.path.join(wdir, 'md_out.log'), os.path.join(wdir, 'solv_ions.gro')
+        if not os.path.isfile(log_fname) or not os.path.isfile(gro):
+            continue
+        ns_per_day, ncores = parse_mdrun_performance(log_fname)
+        if ns_per_day:
+            history.append(ns_per_day * get_number_of_atoms(gro) / ncores)
+    return history
+
+
+def estimate_cost(n_atoms, simulation_ns, ncores, performance):
+    '''
+    The simulation speed is assumed to be inversely proportional to the number of atoms
+    :param performance: atoms * ns/day per core
+    :return: expected wall time in hours
+    '''
+    return simulation_ns * n_atoms / (performance * ncores) * 24
+
+
+def schedule_lpt(costs, workers_nthreads):
+    '''
+    Longest processing time first: tasks are sorted by decreasing cost and each is given to the worker which becomes
+    free first, which is what dask does with tasks submitted in this order
+    :param costs: dict {task: cost in core-hours}
+    :param workers_nthreads: list of numbers of threads of workers
+    :return: list of tasks in the order of submission, makespan
+    '''
+    order = sorted(costs, key=costs.get, reverse=True)
+    return order, simulate_makespan(order, costs, workers_nthreads)
+
+
+def simulate_makespan(order, costs, workers_nthreads):
+    '''
+    :return: expected wall time of running tasks in the given order. A task runs on all threads of a worker
+    '''
+    workers_nthreads = list(workers_nthreads) or [1]
+    loads = [(0.0, n) for n in range(len(workers_nthreads))]
+    makespan = 0.0
+    for task in order:
+        load, n = heapq.heappop(loads)
+        load += costs[task] / workers_nthreads[n]
+        makespan = max(makespan, load)
+        heapq.heappush(loads, (load, n))
+    return makespan
+
+
+def plan_simulations(wdirs, simulation_ns, workers_nthreads, history_wdirs=(), replicas=1):
+    '''
+    Estimate the cost of each system from the number of atoms of solv_ions.gro, the simulated time and
+    the performance of previous simulations and order systems by the longest processing time first
+    :param wdirs: prepared system directories
+    :param simulation_ns: NVT + NPT + production time in ns
+    :param workers_nthreads: list of numbers of threads of workers, each worker runs a single simulation at a time
+                             on all its threads
+    :param history_wdirs: directories of finished simulations to learn the performance from
+    :param replicas: number of replicas of each system
+    :return: ordered list of wdirs
+    '''
+    history = get_performance_history(list(history_wdirs)[-MAX_HISTORY:])
+    performance = statistics.median(history) if history else DEFAULT_PERFORMANCE
+    logging.info(f'Planning: {performance:.0f} atoms*ns/day per core is used '
+                 f'({"median of " + str(len(history)) + " finished simulations" if history else "default value"})')
+
+    costs, n_atoms = {}, {}
+    for wdir in wdirs:
+        n_atoms[wdir] = get_number_of_atoms(os.path.join(wdir, 'solv_ions.gro'))
+        cost = estimate_cost(n_atoms[wdir], simulation_ns, 1, performance)
+        for n in range(replicas):
+            costs[(wdir, n)] = cost
+
+    order, makespan = schedule_lpt(costs, workers_nthreads)
+    input_order = [(wdir, n) for wdir in wdirs for n in range(replicas)]
+    input_makespan = simulate_makespan(input_order, costs, workers_nthreads)
+    for wdir in sorted(wdirs, key=lambda x: costs[(x, 0)], reverse=True):
+        logging.info(f'Planning: {wdir}\t{n_atoms[wdir]} atoms\t{costs[(wdir, 0)]:.2f} core-hours')
+    workers_summary = ', '.join(f'{n_workers} x {nthreads}' for nthreads, n_workers
+                                in sorted(Counter(workers_nthreads).items(), reverse=True))
+    logging.info(f'Planning: {len(costs)} simulations on {len(workers_nthreads)} workers ({workers_summary} cores). '
+                 f'Predicted makespan {makespan:.2f} h (input order {input_makespan:.2f} h), '
+                 f'{sum(costs.values()):.1f} core-hours')
+
+    res = []
+    for wdir, n in order:
+        if wdir not in res:
+            res.append(wdir)
+    return res
+
+
+def order_by_plan(wdirs, planned_wdirs):
+    '''
+    :param wdirs: system or replica directories
+    :param planned_wdirs: ordered system directories
+    :return: wdirs in the planned order. Replicas follow the order of their systems
+    '''
+    rank = {wdir: n for n, wdir in enumerate(planned_wdirs)}
+    return sorted(wdirs, key=lambda x: rank.get(x, rank.get(os.path.dirname(x), len(rank))))
@@ -0,0 +1,120 @@
+import os
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+REGISTRY_FNAME = 'streamd_registry.sqlite'
+
+# files recorded as artifacts of successfully finished stages
+STAGE_ARTIFACTS = {'preparation': ['solv_ions.gro', 'topol.top', 'index.ndx'],
+                   'minimization': ['em.gro', 'em.tpr'],
+                   'equilibration': ['npt.gro', 'npt.cpt'],
+                   'simulation': ['md_out.tpr', 'md_out.xtc', 'md_out.cpt'],
+                   'analysis': ['md_fit.xtc'],
+                   'prolif': ['plifs.csv']}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS systems (wdir TEXT PRIMARY KEY, name TEXT, created REAL);
+CREATE TABLE IF NOT EXISTS stages (wdir TEXT, stage TEXT, status TEXT, host TEXT, start_time REAL, end_time REAL,
+                                   PRIMARY KEY (wdir, stage));
+CREATE TABLE IF NOT EXISTS artifacts (wdir TEXT, name TEXT, path TEXT, size INTEGER, PRIMARY KEY (wdir, name));
+'''
+
+
+def get_registry_fname(wdir):
+    return os.path.join(wdir, 'md_files', REGISTRY_FNAME)
+
+
+def connect(registry):
+    # long timeout, workers of many nodes can update the registry simultaneously
+    conn = sqlite3.connect(registry, timeout=600)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def register_systems(registry, wdirs):
+    now = time.time()
+    with closing(connect(registry)) as conn, conn:
+        conn.executemany('INSERT OR IGNORE INTO systems (wdir, name, created) VALUES (?, ?, ?)',
+                         [(i, os.path.basename(i), now) for i in wdirs])
+
+
+def reset_systems(registry, wdirs):
+    '''
+    Remove stages and artifacts of systems, e.g. if their simulations were removed to start from scratch
+    '''
+    with closing(connect(registry)) as conn, conn:
+        for table in ['stages', 'artifacts']:
+            conn.executemany(f'DELETE FROM {table} WHERE wdir = ? OR wdir LIKE ?',
+                             [(i, os.path.join(i, '%')) for i in wdirs])
+
+
+def set_stage(registry, wdir, stage, status):
+    '''
+    :param status: running, done, failed, skipped or quarantined. start_time is set for running stage,
+                   end_time for other statuses
+    '''
+    now = time.time()
+    with closing(connect(registry)) as conn, conn:
+        conn.execute('INSERT OR IGNORE INTO systems (wdir, name, created) VALUES (?, ?, ?)',
+                     (wdir, os.path.basename(wdir), now))
+        conn.execute('INSERT OR IGNORE INTO stages (wdir, stage) VALUES (?, ?)', (wdir, stage))
+        if status == 'running':
+            conn.execute('UPDATE stages SET status = ?, host = ?, start_time = ?, end_time = NULL '
+                         'WHERE wdir = ? AND stage = ?', (status, socket.gethostname(), now, wdir, stage))
+        else:
+            conn.execute('UPDATE stages SET status = ?, end_time = ? WHERE wdir = ? AND stage = ?',
+                         (status, now, wdir, stage))
+        if status == 'done':
+            artifacts = [(wdir, i, os.path.join(wdir, i), os.path.getsize(os.path.join(wdir, i)))
+                         for i in STAGE_ARTIFACTS.get(stage, []) if os.path.isfile(os.path.join(wdir, i))]
+            conn.executemany('INSERT OR REPLACE INTO artifacts (wdir, name, path, size) VALUES (?, ?, ?, ?)', artifacts)
+
+
+def get_systems(registry, stage=None, status=None):
+    '''
+    :return: list of system directories. If stage is set only systems with the given status of the stage are returned
+    '''
+    with closing(connect(registry)) as conn:
+        if stage is None:
+            rows = conn.execute('SELECT wdir FROM systems ORDER BY wdir').fetchall()
+        else:
+            rows = conn.execute('SELECT wdir FROM stages WHERE stage = ? AND status = ? ORDER BY wdir',
+                                (stage, status)).fetchall()
+    return [i[0] for i in rows]
+
+
+def split_finished(wdirs, registry, stage):
+    '''
+    :param registry: None or registry file
+    :return: list of wdirs where the stage was finished according to the registry, list of other wdirs
+    '''
+    finished = set(get_systems(registry, stage=stage, status='done')) if registry else set()
+    return [i for i in wdirs if i in finished], [i for i in wdirs if i not in finished]
+
+
+def get_stages(registry):
+    '''
+    :return: list of tuples (wdir, stage, status, host, start_time, end_time)
+    '''
+    with closing(connect(registry)) as conn:
+        return conn.execute('SELECT wdir, stage, status, host, start_time, end_time FROM stages '
+                            'ORDER BY wdir, start_time').fetchall()
+
+
+def run_registered(wdir, registry, stage, stage_task, **kwargs):
+    '''
+    Run stage_task(wdir, **kwargs) and record the status and timings of the stage in the registry
+    :param registry: None or registry file
+    :return: result of stage_task
+    '''
+    if registry is None:
+        return stage_task(wdir, **kwargs)
+    set_stage(registry, wdir, stage, 'running')
+    res = None
+    try:
+        res = stage_task(wdir, **kwargs)
+    finally:
+        set_stage(registry, wdir, stage, 'done' if res else 'failed')
+    return res
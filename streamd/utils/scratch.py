@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import threading
+from contextlib import contextmanager
+
+STAGING_MARKER = '.streamd_scratch'
+SOURCE_FNAME = '.streamd_source'  # keeps the path of the original directory in its scratch copy
+SYNC_INTERVAL = 900  # seconds, the default checkpoint interval of mdrun
+
+
+def sync_files(source_dir, target_dir):
+    '''
+    Copy files of source_dir which are missing or differ by size or modification time in target_dir.
+    Subdirectories are not copied. Checkpoint files are copied first, so the copied trajectories are never shorter than
+    the copied checkpoint expects. Each file is copied to a temporary file and then renamed
+    :return: list of copied file names
+    '''
+    copied = []
+    names = sorted((i for i in os.listdir(source_dir) if os.path.isfile(os.path.join(source_dir, i))
+                    and i not in (STAGING_MARKER, SOURCE_FNAME) and not i.endswith('.streamd_tmp')),
+                   key=lambda x: not x.endswith('.cpt'))
+    for name in names:
+        source, target = os.path.join(source_dir, name), os.path.join(target_dir, name)
+        try:
+            source_stat = os.stat(source)
+            if os.path.isfile(target):
+                target_stat = os.stat(target)
+                if target_stat.st_size == source_stat.st_size and target_stat.st_mtime >= source_stat.st_mtime:
+                    continue
+            tmp_target = os.path.join(target_dir, f'.{name}.streamd_tmp')
+            shutil.copy2(source, tmp_target)
+            os.replace(tmp_target, target)
+            copied.append(name)
+        except FileNotFoundError:
+            # temporary files of running programs can disappear
+            continue
+    return copied
+
+
+def get_source_dir(wdir):
+    '''
+    :return: the original directory if wdir is its scratch copy otherwise None
+    '''
+    try:
+        with open(os.path.join(wdir, SOURCE_FNAME)) as inp:
+            return inp.read().strip() or None
+    except OSError:
+        return None
+
+
+def is_staging_incomplete(wdir):
+    '''
+    :return: True if a previous run staged wdir to a scratch directory and did not copy results back
+    '''
+    return os.path.isfile(os.path.join(wdir, STAGING_MARKER))
+
+
+@contextmanager
+def stage_to_scratch(wdir, scratch_dir, sync_interval=SYNC_INTERVAL):
+    '''
+    Copy files of wdir to a node-local scratch directory and run calculations there. Changed files are copied back
+    every sync_interval seconds in background and on exit. The marker file in wdir keeps the host and the scratch path
+    until all results are copied back, so a run interrupted by a dead worker can be recognized and restarted from
+    the last copied checkpoint.
+    :param wdir: directory on a shared file system
+    :param scratch_dir: None or a directory. Environment variables are expanded on the worker, e.g. $TMPDIR
+    :return: directory to run calculations in
+    '''
+    if not scratch_dir:
+        yield wdir
+        return
+
+    marker = os.path.join(wdir, STAGING_MARKER)
+    if os.path.isfile(marker):
+        with open(marker) as inp:
+            logging.warning(f'{wdir}. Previous run staged to {inp.read().strip()} did not finish. '
+                            f'The last copied files will be used')
+
+    scratch_wdir = os.path.join(os.path.expandvars(scratch_dir),
+                                f'{os.path.basename(wdir)}_{hashlib.md5(wdir.encode()).hexdigest()[:8]}')
+    os.makedirs(scratch_wdir, exist_ok=True)
+    sync_files(wdir, scratch_wdir)
+    if os.path.isfile(marker):
+        # let the staged run know that existing outputs are incomplete
+        shutil.copy(marker, scratch_wdir)
+    with open(marker, 'w') as out:
+        out.write(f'{socket.gethostname()}:{scratch_wdir}\n')
+    with open(os.path.join(scratch_wdir, SOURCE_FNAME), 'w') as out:
+        out.write(f'{wdir}\n')
+
+    stop = threading.Event()
+
+    def sync_periodically():
+        while not stop.wait(sync_interval):
+            sync_files(scratch_wdir, wdir)
+
+    thread = threading.Thread(target=sync_periodically, daemon=True)
+    thread.start()
+    try:
+        yield scratch_wdir
+    finally:
+        stop.set()
+        thread.join()
+        sync_files(scratch_wdir, wdir)
+        shutil.rmtree(scratch_wdir, ignore_errors=True)
+        os.remove(marker)
+
+
+def run_in_scratch(wdir, task, scratch_dir, **kwargs):
+    '''
+    Run task(wdir, **kwargs) in the node-local copy of wdir
+    :return: wdir if the task finished successfully otherwise None
+    '''
+    with stage_to_scratch(wdir, scratch_dir) as wdir_run:
+        res = task(wdir_run, **kwargs)
+    return wdir if res else None
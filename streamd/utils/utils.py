@@ -3,8 +3,6 @@ import os
 import re
 import subprocess
 
-import MDAnalysis as mda
-
 
 def filepath_type(x, ext=None, check_exist=True, exist_type='file', create_dir=False):
     value = os.path.abspath(x) if x else x
@@ -74,6 +72,61 @@ def run_check_subprocess(cmd, key, log):
     return True
 
 def get_protein_resid_set(protein_fname):
-    protein = mda.Universe(protein_fname)
-    protein_resid_set = set(protein.residues.resnames.tolist())
-    return protein_resid_set
\ No newline at end of file
+    '''
+    Residue names are read from fixed columns of PDB (ATOM/HETATM records) and GRO files,
+    other formats are read by MDAnalysis
+    :param protein_fname: pdb or gro file
+    :return: set of residue names
+    '''
+    protein_resid_set = set()
+    if protein_fname.lower().endswith(('.pdb', '.ent')):
+        with open(protein_fname) as inp:
+            for line in inp:
+                if line.startswith(('ATOM', 'HETATM')):
+                    protein_resid_set.add(line[17:21].strip())
+    elif protein_fname.lower().endswith('.gro'):
+        with open(protein_fname) as inp:
+            inp.readline()
+            n_atoms = int(inp.readline().strip())
+            for _ in range(n_atoms):
+                protein_resid_set.add(inp.readline()[5:10].strip())
+    else:
+        import MDAnalysis as mda
+
+        protein = mda.Universe(protein_fname)
+        protein_resid_set = set(protein.residues.resnames.tolist())
+    return protein_resid_set
+
+def get_trajectory_segments(xtc):
+    '''
+    A trajectory extended in the segments mode is described by {deffnm}_segments.txt file placed next to its last segment
+    :param xtc: xtc file
+    :return: ordered list of xtc files which compose the whole trajectory
+    '''
+    segments_fname = f'{os.path.splitext(xtc)[0]}_segments.txt'
+    if not os.path.isfile(segments_fname):
+        return [xtc]
+    with open(segments_fname) as inp:
+        return [os.path.join(os.path.dirname(xtc), i.strip()) for i in inp if i.strip()]
+
+
+def write_trajectory_segments(xtc, segments):
+    '''
+    :param xtc: the last segment of the trajectory
+    :param segments: ordered list of xtc files. Segments from the same directory are stored by their names
+    :return: segments file name
+    '''
+    segments_fname = f'{os.path.splitext(xtc)[0]}_segments.txt'
+    with open(segments_fname, 'w') as out:
+        out.write('\n'.join(os.path.basename(i) if os.path.dirname(os.path.abspath(i)) == os.path.dirname(os.path.abspath(xtc))
+                            else os.path.abspath(i) for i in segments) + '\n')
+    return segments_fname
+
+
+def read_xvg(xvg_file):
+    '''
+    :param xvg_file: xvg file
+    :return: list of rows. Each row is a list of float values
+    '''
+    with open(xvg_file) as inp:
+        return [[float(j) for j in i.split()] for i in inp if i.strip() and not i.startswith(('#', '@'))]
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import struct
+
+from streamd.utils.utils import get_trajectory_segments
+
+XTC_MAGIC = 1995
+XTC_MAGIC_LARGE = 2023  # GROMACS 2023+ frames with 64-bit size of compressed coordinates
+# magic, natoms, step, time, box, natoms (big-endian XDR)
+FRAME_HEADER = struct.Struct('>iiif9fi')
+# precision, minint, maxint, smallidx
+COMPRESSION_HEADER = struct.Struct('>f3i3ii')
+INDEX_VERSION = 1
+
+
+def get_index_fname(xtc):
+    '''
+    The index is stored beside the trajectory as a hidden file: md_fit.xtc -> .md_fit.xtc_frames.json
+    '''
+    return os.path.join(os.path.dirname(xtc), f'.{os.path.basename(xtc)}_frames.json')
+
+
+def read_frame_header(inp, offset):
+    '''
+    :param inp: xtc file opened in the binary mode
+    :param offset: position of the frame in the file
+    :return: natoms, step, time, box (9 floats), offset of the next frame or None if the frame is incomplete
+    '''
+    inp.seek(offset)
+    data = inp.read(FRAME_HEADER.size)
+    if len(data) < FRAME_HEADER.size:
+        return None
+    magic, natoms, step, time, *box, natoms2 = FRAME_HEADER.unpack(data)
+    if magic not in (XTC_MAGIC, XTC_MAGIC_LARGE) or natoms != natoms2:
+        raise ValueError(f'{inp.name}. Wrong xtc frame header at byte {offset}')
+    if natoms <= 9:
+        # coordinates of small systems are not compressed
+        end = offset + FRAME_HEADER.size + natoms * 3 * 4
+    else:
+        inp.seek(offset + FRAME_HEADER.size + COMPRESSION_HEADER.size)
+        size_format = '>q' if magic == XTC_MAGIC_LARGE else '>i'
+        data = inp.read(struct.calcsize(size_format))
+        if len(data) < struct.calcsize(size_format):
+            return None
+        nbytes = struct.unpack(size_format, data)[0]
+        # compressed coordinates are padded to 4 bytes
+        end = inp.tell() + (nbytes + 3) // 4 * 4
+    return natoms, step, time, box, end
+
+
+def scan_xtc(xtc, index=None):
+    '''
+    Read only headers of frames skipping compressed coordinates.
+    An incomplete last frame (e.g. of a running simulation) is not included
+    :param index: None or a previous index of the same file which was appended since then. Scanning is continued
+                  from the end of its last frame
+    :return: dict with natoms, lists of offsets, steps and times of frames and the end offset of the last frame
+    '''
+    if index is None:
+        index = {'natoms': None, 'offsets': [], 'steps': [], 'times': [], 'end': 0}
+    size = os.path.getsize(xtc)
+    with open(xtc, 'rb') as inp:
+        offset = index['end']
+        while offset < size:
+            header = read_frame_header(inp, offset)
+            if header is None or header[4] > size:
+                break
+            natoms, step, time, _, end = header
+            index['natoms'] = natoms
+            index['offsets'].append(offset)
+            index['steps'].append(step)
+            index['times'].append(time)
+            index['end'] = offset = end
+    return index
+
+
+def is_appended(xtc, index):
+    '''
+    :return: True if the file was only appended after the index was created: it is not smaller and
+             the last indexed frame is still in place
+    '''
+    if not index['offsets'] or os.path.getsize(xtc) < index['end']:
+        return False
+    try:
+        with open(xtc, 'rb') as inp:
+            header = read_frame_header(inp, index['offsets'][-1])
+    except ValueError:
+        return False
+    return header is not None and header[1] == index['steps'][-1] and header[4] == index['end']
+
+
+def get_xtc_index(xtc):
+    '''
+    Return the frame index of the xtc file. The index is cached beside the trajectory and is reused while size and
+    modification time of the file are the same. An appended trajectory is scanned from the last indexed frame only
+    :return: dict with natoms, lists of offsets, steps and times of frames
+    '''
+    index_fname = get_index_fname(xtc)
+    stat = os.stat(xtc)
+    index = None
+    if os.path.isfile(index_fname):
+        try:
+            with open(index_fname) as inp:
+                index = json.load(inp)
+        except ValueError:
+            index = None
+        if index is not None and index.get('version') != INDEX_VERSION:
+            index = None
+        if index is not None:
+            if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+                return index
+            if not is_appended(xtc, index):
+                index = None
+
+    index = scan_xtc(xtc, index)
+    index.update({'version': INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime})
+    try:
+        with open(index_fname, 'w') as out:
+            json.dump(index, out)
+    except OSError as e:
+        logging.warning(f'{xtc}. The frame index cannot be saved: {e}')
+    return index
+
+
+def get_number_of_frames(xtc):
+    '''
+    :param xtc: xtc file. A trajectory extended in the segments mode is counted over all its segments
+    :return: number of frames or None if any segment is missing or corrupted
+    '''
+    number_of_frames = 0
+    for xtc_segment in get_trajectory_segments(xtc):
+        if not os.path.isfile(xtc_segment):
+            logging.warning(f'{xtc_segment} does not exist')
+            return None
+        try:
+            frames = len(get_xtc_index(xtc_segment)['offsets'])
+        except ValueError as e:
+            logging.warning(e)
+            return None
+        logging.info(f'{xtc_segment} has {frames} frames')
+        number_of_frames += frames
+    return number_of_frames
+
+
+def get_frame_location(xtc, frame):
+    '''
+    Random access to a frame of the whole trajectory
+    :param frame: 0-based frame number over all segments of the trajectory
+    :return: xtc segment, offset of the frame in the segment, step, time in ps
+    '''
+    for xtc_segment in get_trajectory_segments(xtc):
+        index = get_xtc_index(xtc_segment)
+        if frame < len(index['offsets']):
+            return xtc_segment, index['offsets'][frame], index['steps'][frame], index['times'][frame]
+        frame -= len(index['offsets'])
+    raise IndexError(f'{xtc}. Frame is out of the trajectory')
+
+
+def write_xtc_frames(xtc, frames, output):
+    '''
+    Write the selected frames to a new xtc file. Frames are independent records, so they are copied as is
+    :param frames: list of 0-based frame numbers over all segments of the trajectory
+    :return: output
+    '''
+    segments = [(i, get_xtc_index(i)) for i in get_trajectory_segments(xtc)]
+    with open(output, 'wb') as out:
+        for frame in frames:
+            for xtc_segment, index in segments:
+                if frame < len(index['offsets']):
+                    break
+                frame -= len(index['offsets'])
+            else:
+                raise IndexError(f'{xtc}. Frame is out of the trajectory')
+            offsets = index['offsets'] + [index['end']]
+            with open(xtc_segment, 'rb') as inp:
+                inp.seek(offsets[frame])
+                out.write(inp.read(offsets[frame + 1] - offsets[frame]))
+    return output